@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Measure the events per second the state machine dispatches.
+
+Compares pysm's StateMachine.dispatch (walking the state hierarchy and
+the transitions container for every event) with the compiled transition
+table of UpparatStateMachine.dispatch on the same events: reconnects
+with a lost session (monitor → fetch_jobs), no pending jobs (fetch_jobs
+→ monitor) and events without a transition.
+"""
+import argparse
+import sys
+import time
+from queue import Queue
+
+from pysm import Event
+from pysm import StateMachine
+
+from upparat.events import MQTT_CONNECTED
+from upparat.events import MQTT_DISCONNECTED
+from upparat.events import MQTT_EVENT_SESSION_PRESENT
+from upparat.events import MQTT_EVENT_TOPIC
+from upparat.events import MQTT_SUBSCRIBED
+from upparat.events import NO_JOBS_PENDING
+from upparat.statemachine import UpparatStateMachine
+from upparat.statemachine.machine import create_statemachine
+
+EVENTS = [
+    (MQTT_DISCONNECTED, {}),
+    (MQTT_CONNECTED, {MQTT_EVENT_SESSION_PRESENT: False}),
+    (MQTT_SUBSCRIBED, {MQTT_EVENT_TOPIC: "$aws/things/benchmark/jobs/notify"}),
+    (NO_JOBS_PENDING, {}),
+]
+
+
+class NoopClient:
+    """ Stands in for MQTT, the states only publish / subscribe. """
+
+    def __getattr__(self, name):
+        return self._noop
+
+    def _noop(self, *args, **kwargs):
+        return False
+
+
+def parse_arguments(args):
+    parser = argparse.ArgumentParser(description="State machine dispatch benchmark.")
+    parser.add_argument(
+        "--events", type=int, default=200000, help="Events dispatched per run."
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Runs per dispatcher, the best counts."
+    )
+    return parser.parse_args(args)
+
+
+def measure(name, dispatch, count, repeat):
+    best = None
+
+    for _ in range(repeat):
+        statemachine = create_statemachine(Queue(), NoopClient(), "benchmark")
+        statemachine.dispatch(Event(NO_JOBS_PENDING))
+
+        # Fresh events, handlers clear propagate
+        events = [
+            Event(event, **cargo)
+            for _ in range(count // len(EVENTS))
+            for event, cargo in EVENTS
+        ]
+
+        start = time.perf_counter()
+        for event in events:
+            dispatch(statemachine, event)
+        duration = time.perf_counter() - start
+
+        best = duration if best is None else min(best, duration)
+
+    print(
+        f"{name:>8}: {count / best:10.0f} events/s, {best / count * 1e6:.2f}µs per event"
+    )
+    return count / best
+
+
+def main(args):
+    arguments = parse_arguments(args)
+
+    print(f"Dispatching {arguments.events} events, best of {arguments.repeat}")
+    pysm = measure("pysm", StateMachine.dispatch, arguments.events, arguments.repeat)
+    compiled = measure(
+        "compiled", UpparatStateMachine.dispatch, arguments.events, arguments.repeat
+    )
+    print(f"speedup: {compiled / pysm:.2f}x")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Measure how much a running download delays a keepalive timer.
+
+A ticker thread stands in for Paho's network loop: it wants to wake up
+every --interval seconds and records how late it actually wakes up while
+a download runs in a thread or in a child process (see download_worker).
+"""
+import argparse
+import functools
+import http.server
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from queue import Queue
+
+from upparat.config import settings
+from upparat.jobs import Job
+from upparat.statemachine import download as download_module
+
+FILE_NAME = "artifact.bin"
+# The spawned download process imports this module again (as
+# __mp_main__), the variable tells it to emulate the CPU work too.
+CPU_WORK_VARIABLE = "UPPARAT_BENCHMARK_CPU_WORK"
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *_):
+        pass
+
+
+def parse_arguments(args):
+    parser = argparse.ArgumentParser(description="Keepalive jitter benchmark.")
+    parser.add_argument(
+        "--size-mib", type=int, default=64, help="Size of the downloaded file."
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=0.05,
+        help="Interval of the keepalive ticker in seconds.",
+    )
+    parser.add_argument(
+        "--cpu-work",
+        type=int,
+        default=20000,
+        help="Pure Python iterations per chunk to emulate hashing / decompression.",
+    )
+    parser.add_argument(
+        "--single-core",
+        action="store_true",
+        help="Pin the benchmark to one CPU to emulate a single-core device.",
+    )
+    return parser.parse_args(args)
+
+
+def start_server(directory):
+    # Run the server in its own process so it
+    # doesn't compete for our interpreter lock.
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+
+    def _run():
+        handler = functools.partial(QuietHandler, directory=directory)
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        sender.send(server.server_address[1])
+        server.serve_forever()
+
+    process = multiprocessing.get_context("fork").Process(target=_run, daemon=True)
+    process.start()
+    return process, receiver.recv()
+
+
+class Sink:
+    """ Stands in for the SharedDownload the worker reports to. """
+
+    stop_download = None
+
+    def __init__(self, inbox):
+        self.publish = inbox.put
+
+    def update_job_progress(self, *args, **kwargs):
+        pass
+
+
+def emulate_cpu_work(iterations):
+    os.environ[CPU_WORK_VARIABLE] = str(iterations)
+    fsync = os.fsync
+
+    def _fsync(fd):
+        fsync(fd)
+        checksum = 0
+        for i in range(iterations):
+            checksum = (checksum * 31 + i) & 0xFFFFFFFF
+
+    download_module.os.fsync = _fsync
+
+
+def measure(worker, url, interval):
+    for download_file in os.listdir(settings.service.download_location):
+        os.remove(settings.service.download_location / download_file)
+
+    job = Job(
+        id_=f"upparat_benchmark_{worker}",
+        status="IN_PROGRESS",
+        file_url=url,
+        version="1",
+        force=True,
+        meta=None,
+        status_details=None,
+    )
+
+    inbox = Queue()
+    done = threading.Event()
+    lateness = []
+
+    def ticker():
+        expected = time.perf_counter() + interval
+        while not done.is_set():
+            time.sleep(max(0.0, expected - time.perf_counter()))
+            now = time.perf_counter()
+            lateness.append(now - expected)
+            expected = now + interval
+
+    ticker_thread = threading.Thread(target=ticker, daemon=True)
+    ticker_thread.start()
+
+    start = time.perf_counter()
+
+    if worker == "process":
+        download_module.start_worker_process(job, Sink(inbox))
+    else:
+        download_module.start_worker_thread(job, Sink(inbox))
+
+    inbox.get()
+    duration = time.perf_counter() - start
+
+    done.set()
+    ticker_thread.join()
+
+    lateness_ms = sorted(late * 1000 for late in lateness)
+    p99 = lateness_ms[max(0, int(len(lateness_ms) * 0.99) - 1)]
+
+    print(
+        f"{worker:>8}: {duration:6.2f}s download, ticks={len(lateness_ms)}, "
+        f"jitter median={statistics.median(lateness_ms):.2f}ms "
+        f"p99={p99:.2f}ms max={lateness_ms[-1]:.2f}ms"
+    )
+
+
+def main(args):
+    arguments = parse_arguments(args)
+
+    if arguments.single_core:
+        os.sched_setaffinity(0, {sorted(os.sched_getaffinity(0))[0]})
+
+    with tempfile.TemporaryDirectory() as serve_directory:
+        with open(Path(serve_directory) / FILE_NAME, "wb") as artifact:
+            for _ in range(arguments.size_mib):
+                artifact.write(os.urandom(1024 * 1024))
+
+        server, port = start_server(serve_directory)
+        url = f"http://127.0.0.1:{port}/{FILE_NAME}"
+
+        with tempfile.TemporaryDirectory() as download_location:
+            settings.service.download_location = Path(download_location)
+            emulate_cpu_work(arguments.cpu_work)
+
+            print(
+                f"Downloading {arguments.size_mib} MiB, "
+                f"keepalive ticker every {arguments.interval * 1000:.0f}ms"
+            )
+
+            for worker in ("thread", "process"):
+                measure(worker, url, arguments.interval)
+
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
+elif CPU_WORK_VARIABLE in os.environ:
+    emulate_cpu_work(int(os.environ[CPU_WORK_VARIABLE]))
@@ -31,9 +31,10 @@ setup(
     package_dir={"": "src"},
     include_package_data=True,
     entry_points={"console_scripts": ["upparat=upparat.cli:main"]},
-    install_requires=["paho-mqtt>=1.4.0", "backoff>=1.8.1", "pysm>=0.3.7"],
+    install_requires=["paho-mqtt>=1.6,<2", "backoff>=1.8.1", "pysm>=0.3.7"],
     extras_require={
         "dev": ["pytest", "pytest-mock", "boto3", "ipdb", "coverage"],
         "sentry": ["sentry-sdk"],
+        "orjson": ["orjson"],
     },
 )
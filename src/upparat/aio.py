@@ -0,0 +1,188 @@
+"""
+Single threaded asyncio runtime (runtime = asyncio).
+
+The MQTT client, the hooks and the state machine share one event loop:
+Paho's socket is watched by the loop instead of Paho's network thread
+and events are dispatched without a thread handoff. Only downloads
+still run in their worker (thread or process, see download_worker).
+"""
+import asyncio
+import functools
+import logging
+import threading
+from queue import Empty
+
+from paho.mqtt.client import mqtt_cs_disconnecting
+from paho.mqtt.client import MQTT_ERR_SUCCESS
+
+from upparat.inbox import PriorityInbox
+from upparat.mqtt import MQTT
+from upparat.mqtt import queued_message_info
+
+logger = logging.getLogger(__name__)
+
+# Seconds between Paho's housekeeping (keepalive, timeouts)
+MISC_INTERVAL = 1
+
+
+class Inbox:
+    """
+    Events for the state machine, see cli(). Must be created on the
+    thread running the loop: events put by the loop itself (MQTT,
+    hooks) are queued directly, other threads hand them over.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        # Ordered as PriorityInbox, hooks run on the loop and can't wait
+        self._events = PriorityInbox(high_water=None)
+        self._available = asyncio.Event()
+        self._thread_id = threading.get_ident()
+
+    def put(self, event):
+        if threading.get_ident() == self._thread_id:
+            self._put(event)
+        else:
+            self.loop.call_soon_threadsafe(self._put, event)
+
+    def _put(self, event):
+        self._events.put(event)
+        self._available.set()
+
+    def schedule(self, delay, event, interval=None):
+        """ See PriorityInbox.schedule, from the loop's thread. """
+        timer = self._events.schedule(delay, event, interval)
+        self._available.set()
+        return timer
+
+    async def get(self):
+        while True:
+            try:
+                return self._events.get_nowait()
+            except Empty:
+                pass
+
+            self._available.clear()
+            try:
+                await asyncio.wait_for(
+                    self._available.wait(), self._events.timers.timeout()
+                )
+            except asyncio.TimeoutError:
+                pass
+
+    def empty(self):
+        return self._events.empty()
+
+    def qsize(self):
+        return self._events.qsize()
+
+
+class AsyncioMQTT(MQTT):
+    """
+    MQTT client driven by the event loop, see Paho's loop_asyncio example.
+
+    Subscriptions, the mid tracking and the outbox work as in MQTT,
+    only the network loop differs: reads and writes are loop callbacks,
+    loop_misc() runs as task and reconnects are scheduled by the loop
+    (connecting in its executor).
+    """
+
+    def __init__(self, *args, loop, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self._loop = loop
+        self._loop_thread_id = threading.get_ident()
+        self._misc = None
+        self._connection = None
+        self._disconnected = asyncio.Event()
+
+        self.on_socket_open = self._on_socket_open_handler
+        self.on_socket_close = self._on_socket_close_handler
+        self.on_socket_register_write = self._on_socket_register_write_handler
+        self.on_socket_unregister_write = self._on_socket_unregister_write_handler
+
+    def run(self, host, port):
+        self.enable_logger()
+        logger.debug(f"Connect to {host}:{port}")
+        self.connect_async(host, port)
+        self._connection = self._loop.create_task(self._maintain_connection())
+
+    def publish(self, topic, payload=None, qos=0, retain=False, **kwargs):
+        # Downloads report their progress from their own thread
+        if threading.get_ident() != self._loop_thread_id:
+            self._loop.call_soon_threadsafe(
+                functools.partial(
+                    super().publish, topic, payload, qos, retain, **kwargs
+                )
+            )
+            return queued_message_info()
+
+        return super().publish(topic, payload, qos, retain, **kwargs)
+
+    async def _maintain_connection(self):
+        while self._state != mqtt_cs_disconnecting:
+            self._disconnected.clear()
+
+            # The probes block, keep dispatching meanwhile
+            if self._endpoints is not None and self._endpoints.probing:
+                await self._loop.run_in_executor(None, self._endpoints.probe_all)
+
+            # TCP connect and TLS handshake block as well
+            try:
+                await self._loop.run_in_executor(None, self.reconnect)
+            except OSError as e:
+                logger.warning(f"Connection failed: {e}")
+            else:
+                await self._disconnected.wait()
+
+            if self._state == mqtt_cs_disconnecting:
+                break
+
+            await asyncio.sleep(self._next_reconnect_delay())
+
+    async def _misc_loop(self):
+        while self.loop_misc() == MQTT_ERR_SUCCESS:
+            await asyncio.sleep(MISC_INTERVAL)
+
+    def _call_on_loop(self, callback, *args):
+        # The socket callbacks also come from reconnect() in the executor
+        if threading.get_ident() == self._loop_thread_id:
+            callback(*args)
+        else:
+            self._loop.call_soon_threadsafe(callback, *args)
+
+    # The handlers pass on the file descriptor: handed over to the loop,
+    # Paho might have closed the socket by the time they run.
+
+    def _on_socket_open_handler(self, _, __, sock):
+        self._call_on_loop(self._socket_opened, sock.fileno())
+
+    def _on_socket_close_handler(self, _, __, sock):
+        self._call_on_loop(self._socket_closed, sock.fileno())
+
+    def _on_socket_register_write_handler(self, _, __, sock):
+        self._call_on_loop(self._loop.add_writer, sock.fileno(), self.loop_write)
+
+    def _on_socket_unregister_write_handler(self, _, __, sock):
+        self._call_on_loop(self._loop.remove_writer, sock.fileno())
+
+    def _socket_opened(self, fd):
+        self._loop.add_reader(fd, self.loop_read)
+        self._misc = self._loop.create_task(self._misc_loop())
+
+    def _socket_closed(self, fd):
+        self._loop.remove_reader(fd)
+        self._loop.remove_writer(fd)
+
+        if self._misc:
+            self._misc.cancel()
+
+        self._disconnected.set()
+
+
+async def dispatch(inbox, state_machine):
+    """ The asyncio counterpart of the inbox loop in cli(). """
+    while True:
+        event = await inbox.get()
+        logger.debug(f"---> Event in inbox {event}")
+        state_machine.dispatch(event)
@@ -1,16 +1,34 @@
+import asyncio
 import logging
 import signal
-import ssl
 from pathlib import Path
-from queue import Queue
 
 from pysm import Event
 
+from upparat import aio
 from upparat import config
+from upparat.aio import AsyncioMQTT
+from upparat.config import BROKER_SECTION
+from upparat.config import Endpoint
+from upparat.config import RUNTIME_ASYNCIO
 from upparat.config import settings
+from upparat.endpoints import Endpoints
 from upparat.events import EXIT_SIGNAL_SENT
+from upparat.gateway import Gateway
+from upparat.health import ConnectionHealth
+from upparat.inbox import PriorityInbox
+from upparat.jobs import JobTopicIndex
+from upparat.jobs import update_job_execution
+from upparat.jobs import update_job_execution_response
+from upparat.journal import Journal
+from upparat.journal import JOURNAL_FILE
+from upparat.metrics import metrics
 from upparat.mqtt import MQTT
+from upparat.outbox import Outbox
+from upparat.outbox import OUTBOX_FILE
+from upparat.serialization import dumps
 from upparat.statemachine.machine import create_statemachine
+from upparat.tls import create_context
 
 BASE = Path(__file__).parent
 
@@ -18,10 +36,21 @@ logger = logging.getLogger(__name__)
 
 
 def cli(inbox=None):
+    # Single threaded runtime, see upparat.aio
+    if settings.service.runtime == RUNTIME_ASYNCIO:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
 
-    if not inbox:
-        inbox = Queue()
+        try:
+            return run(aio.Inbox(loop), loop)
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    return run(inbox or PriorityInbox())
 
+
+def run(inbox, loop=None):
     if settings.service.sentry:
         import sentry_sdk
 
@@ -31,37 +60,102 @@ def cli(inbox=None):
     def _exit(_, __):
         inbox.put(Event(EXIT_SIGNAL_SENT))
 
-    signal.signal(signal.SIGINT, _exit)
-    signal.signal(signal.SIGTERM, _exit)
-
-    client = MQTT(client_id=settings.broker.client_id, queue=inbox)
-
-    cafile = settings.broker.cafile
-    certfile = settings.broker.certfile
-    keyfile = settings.broker.keyfile
-
-    host = settings.broker.host
-    port = settings.broker.port
+    # Dump the metrics on demand, e.g. kill -USR1 <pid>
+    def _log_metrics(_, __):
+        # warning to be visible with the default log level
+        logger.warning(f"Metrics: {dumps(metrics.snapshot())}")
+
+    if loop:
+        # Wakes up the loop, unlike a plain signal handler
+        loop.add_signal_handler(signal.SIGINT, _exit, None, None)
+        loop.add_signal_handler(signal.SIGTERM, _exit, None, None)
+        loop.add_signal_handler(signal.SIGUSR1, _log_metrics, None, None)
+    else:
+        signal.signal(signal.SIGINT, _exit)
+        signal.signal(signal.SIGTERM, _exit)
+        signal.signal(signal.SIGUSR1, _log_metrics)
+
+    # Gateway mode: the things share this connection, see upparat.gateway
+    thing_names = settings.broker.thing_names or [settings.broker.thing_name]
+    thing_filter = "+" if settings.broker.thing_names else settings.broker.thing_name
+
+    # Job updates survive disconnects and restarts
+    outbox = Outbox(
+        settings.service.state_location / OUTBOX_FILE,
+        update_job_execution(thing_filter, "+"),
+        update_job_execution_response(thing_filter, "+"),
+    )
+
+    # Jobs in processing survive restarts, e.g. the one to install an update
+    journal = Journal(settings.service.state_location / JOURNAL_FILE)
+
+    # Brokers to fail over between, see upparat.endpoints
+    endpoints = settings.broker.endpoints or [
+        Endpoint(
+            BROKER_SECTION,
+            settings.broker.host,
+            settings.broker.port,
+            settings.broker.cafile,
+            settings.broker.certfile,
+            settings.broker.keyfile,
+        )
+    ]
+    ssl_contexts = {}
 
     # for client certificate authentication use the TLS
     # APLN extension which requires 443 or 8883.
-    if cafile or certfile or keyfile:
-        try:
-            if port not in [443, 8883]:
-                raise Exception(
-                    "Port must be 443/8883 for TLS APLN client certificate authentication."  # noqa
+    for endpoint in endpoints:
+        if endpoint.cafile or endpoint.certfile or endpoint.keyfile:
+            try:
+                if endpoint.port not in [443, 8883]:
+                    raise Exception(
+                        "Port must be 443/8883 for TLS APLN client certificate authentication."  # noqa
+                    )
+                # Kept for all reconnects, which resume the TLS session
+                ssl_contexts[endpoint.name] = create_context(
+                    endpoint.cafile, endpoint.certfile, endpoint.keyfile
                 )
-            ssl_context = ssl.create_default_context()
-            ssl_context.set_alpn_protocols(["x-amzn-mqtt-ca"])
-            ssl_context.load_verify_locations(cafile=cafile)
-            ssl_context.load_cert_chain(certfile=certfile, keyfile=keyfile)
-            client.tls_set_context(context=ssl_context)
-        except Exception as e:
-            logger.exception("Error in TLS ALPN extension setup.")
-            raise e
-
-    client.run(host, port)
-    state_machine = create_statemachine(inbox, client)
+            except Exception as e:
+                logger.exception("Error in TLS ALPN extension setup.")
+                raise e
+
+    client_kwargs = dict(
+        client_id=settings.broker.client_id,
+        queue=inbox,
+        clean_session=settings.broker.clean_session,
+        topic_index=JobTopicIndex(*thing_names),
+        outbox=outbox,
+        endpoints=Endpoints(endpoints, ssl_contexts),
+        health=ConnectionHealth(
+            settings.broker.keepalive_min,
+            settings.broker.keepalive_max,
+            settings.broker.max_ping_rtt,
+        ),
+    )
+
+    if loop:
+        client = AsyncioMQTT(loop=loop, **client_kwargs)
+    else:
+        client = MQTT(**client_kwargs)
+
+    client.reconnect_delay_set(
+        settings.broker.reconnect_min_delay, settings.broker.reconnect_max_delay
+    )
+    client.run(endpoints[0].host, endpoints[0].port)
+
+    if settings.broker.thing_names:
+        state_machine = Gateway(
+            [
+                create_statemachine(inbox, client, thing_name, journal=journal)
+                for thing_name in thing_names
+            ]
+        )
+    else:
+        state_machine = create_statemachine(inbox, client, journal=journal)
+
+    if loop:
+        loop.run_until_complete(aio.dispatch(inbox, state_machine))
+        return
 
     while True:
         event = inbox.get()
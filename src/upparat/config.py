@@ -11,21 +11,52 @@ NAME = "upparat"
 
 USE_SYS_ARGV = False
 
+LOG_FORMAT = "[%(asctime)s] %(levelname)s in %(module)s: %(message)s"
+
 # settings
 SERVICE_SECTION = "service"
 LOG_LEVEL = "log_level"
 DOWNLOAD_LOCATION = "download_location"
+STATE_LOCATION = "state_location"
 SENTRY = "sentry"
+DOWNLOAD_WORKER = "download_worker"
+FAST_JOB_SELECTION = "fast_job_selection"
+PREFETCH_DOWNLOADS = "prefetch_downloads"
+SUPERSEDE_JOBS = "supersede_jobs"
+RUNTIME = "runtime"
+
+# download workers
+DOWNLOAD_WORKER_THREAD = "thread"
+DOWNLOAD_WORKER_PROCESS = "process"
+DOWNLOAD_WORKERS = (DOWNLOAD_WORKER_THREAD, DOWNLOAD_WORKER_PROCESS)
+
+# runtimes
+RUNTIME_THREAD = "thread"
+RUNTIME_ASYNCIO = "asyncio"
+RUNTIMES = (RUNTIME_THREAD, RUNTIME_ASYNCIO)
 
 # broker
 BROKER_SECTION = "broker"
 HOST = "host"
 PORT = "port"
 THING_NAME = "thing_name"
+THING_NAMES = "thing_names"
 CLIENT_ID = "client_id"
+CLEAN_SESSION = "clean_session"
 CAFILE = "cafile"
 CERTFILE = "certfile"
 KEYFILE = "keyfile"
+RECONNECT_MIN_DELAY = "reconnect_min_delay"
+RECONNECT_MAX_DELAY = "reconnect_max_delay"
+ENDPOINTS = "endpoints"
+KEEPALIVE_MIN = "keepalive_min"
+KEEPALIVE_MAX = "keepalive_max"
+MAX_PING_RTT = "max_ping_rtt"
+FETCH_JOBS_DEADLINE = "fetch_jobs_deadline"
+SELECT_JOB_DEADLINE = "select_job_deadline"
+
+# broker endpoints, see upparat.endpoints
+ENDPOINT_SECTION = "endpoint:{}"
 
 # hooks
 HOOKS_SECTION = "hooks"
@@ -61,19 +92,52 @@ def _argument_parser():
 
 class Service:
     download_location: str
+    state_location: str
     log_level: str
     sentry: str  # todo: remove for release
+    download_worker: str
+    runtime: str
+    fast_job_selection: bool
+    prefetch_downloads: int
+    supersede_jobs: bool
 
 
 class Broker:
     host: str
     port: int
     thing_name: str
+    thing_names: list
     client_id: str
+    clean_session: bool
+    cafile: str
+    certfile: str
+    keyfile: str
+    reconnect_min_delay: int
+    reconnect_max_delay: int
+    endpoints: list
+    keepalive_min: int
+    keepalive_max: int
+    max_ping_rtt: float
+    fetch_jobs_deadline: int
+    select_job_deadline: int
+
+
+class Endpoint:
+    name: str
+    host: str
+    port: int
     cafile: str
     certfile: str
     keyfile: str
 
+    def __init__(self, name, host, port, cafile=None, certfile=None, keyfile=None):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.cafile = cafile
+        self.certfile = certfile
+        self.keyfile = keyfile
+
 
 class Hooks:
     version: str
@@ -97,9 +161,7 @@ def _service_section(config, verbose):
 
     service.log_level = log_level
 
-    logging.basicConfig(
-        format="[%(asctime)s] %(levelname)s in %(module)s: %(message)s", level=log_level
-    )
+    logging.basicConfig(format=LOG_FORMAT, level=log_level)
 
     # Append service name to be able to easily cleanup this whole directory
     download_location = config.get(
@@ -120,7 +182,65 @@ def _service_section(config, verbose):
         )
 
     service.download_location = Path(download_location)
+
+    # Persistent state such as the outbox of job updates, separate
+    # from the download location which gets cleaned up.
+    state_location = config.get(
+        SERVICE_SECTION,
+        STATE_LOCATION,
+        fallback=str(Path(tempfile.gettempdir()) / f"{NAME}-state"),
+    )
+    state_location = str(Path(state_location).resolve())
+
+    try:
+        os.makedirs(state_location, exist_ok=True)
+    except PermissionError:
+        raise PermissionError(f"Unable to create state location: {state_location}")
+
+    if not os.access(state_location, os.W_OK | os.X_OK):
+        raise PermissionError(
+            f"Insufficient permissions to write to state location: {state_location}"
+        )
+
+    service.state_location = Path(state_location)
     service.sentry = config.get(SERVICE_SECTION, SENTRY, fallback=None)
+
+    download_worker = config.get(
+        SERVICE_SECTION, DOWNLOAD_WORKER, fallback=DOWNLOAD_WORKER_THREAD
+    )
+
+    if download_worker not in DOWNLOAD_WORKERS:
+        raise ValueError(
+            f"Invalid config: {DOWNLOAD_WORKER} must be one of {', '.join(DOWNLOAD_WORKERS)}."
+        )
+
+    service.download_worker = download_worker
+    service.fast_job_selection = config.getboolean(
+        SERVICE_SECTION, FAST_JOB_SELECTION, fallback=False
+    )
+
+    # Artifacts of queued jobs downloaded while installing, 0 to disable
+    service.prefetch_downloads = config.getint(
+        SERVICE_SECTION, PREFETCH_DOWNLOADS, fallback=0
+    )
+
+    if service.prefetch_downloads < 0:
+        raise ValueError(f"Invalid config: {PREFETCH_DOWNLOADS} >= 0.")
+
+    # Only install the newest of the queued jobs
+    service.supersede_jobs = config.getboolean(
+        SERVICE_SECTION, SUPERSEDE_JOBS, fallback=False
+    )
+
+    runtime = config.get(SERVICE_SECTION, RUNTIME, fallback=RUNTIME_THREAD)
+
+    if runtime not in RUNTIMES:
+        raise ValueError(
+            f"Invalid config: {RUNTIME} must be one of {', '.join(RUNTIMES)}."
+        )
+
+    service.runtime = runtime
+
     return service
 
 
@@ -134,26 +254,95 @@ def _broker_section(config, thing_name=None):
             BROKER_SECTION, THING_NAME, fallback=socket.gethostname()
         )
 
+    # Gateway mode: update several things over one connection
+    thing_names = config.get(BROKER_SECTION, THING_NAMES, fallback="")
+    broker.thing_names = [
+        name.strip() for name in thing_names.split(",") if name.strip()
+    ]
+
     broker.host = config.get(BROKER_SECTION, HOST, fallback="127.0.0.1")
     broker.port = config.getint(BROKER_SECTION, PORT, fallback=1883)
     broker.client_id = config.get(BROKER_SECTION, CLIENT_ID, fallback=NAME)
+    broker.clean_session = config.getboolean(
+        BROKER_SECTION, CLEAN_SESSION, fallback=True
+    )
 
-    broker.cafile = config.get(BROKER_SECTION, CAFILE, fallback=None)
-    broker.certfile = config.get(BROKER_SECTION, CERTFILE, fallback=None)
-    broker.keyfile = config.get(BROKER_SECTION, KEYFILE, fallback=None)
+    broker.cafile, broker.certfile, broker.keyfile = _tls_files(config, BROKER_SECTION)
 
-    set_files_count = sum(
-        filepath is None
-        for filepath in [broker.cafile, broker.certfile, broker.keyfile]
+    broker.reconnect_min_delay = config.getint(
+        BROKER_SECTION, RECONNECT_MIN_DELAY, fallback=1
+    )
+    broker.reconnect_max_delay = config.getint(
+        BROKER_SECTION, RECONNECT_MAX_DELAY, fallback=120
+    )
+
+    if not 0 < broker.reconnect_min_delay <= broker.reconnect_max_delay:
+        raise ValueError(
+            f"Invalid config: 0 < {RECONNECT_MIN_DELAY} <= {RECONNECT_MAX_DELAY}."
+        )
+
+    # Ping often while processing a job, rarely otherwise (upparat.health),
+    # by default as Paho's keepalive (60) when idle.
+    broker.keepalive_min = config.getint(BROKER_SECTION, KEEPALIVE_MIN, fallback=30)
+    broker.keepalive_max = config.getint(BROKER_SECTION, KEEPALIVE_MAX, fallback=60)
+
+    if not 0 < broker.keepalive_min <= broker.keepalive_max:
+        raise ValueError(f"Invalid config: 0 < {KEEPALIVE_MIN} <= {KEEPALIVE_MAX}.")
+
+    broker.max_ping_rtt = config.getfloat(BROKER_SECTION, MAX_PING_RTT, fallback=10)
+
+    # Ask again if the broker didn't respond in time, 0 to wait forever
+    broker.fetch_jobs_deadline = config.getint(
+        BROKER_SECTION, FETCH_JOBS_DEADLINE, fallback=30
+    )
+    broker.select_job_deadline = config.getint(
+        BROKER_SECTION, SELECT_JOB_DEADLINE, fallback=30
     )
 
+    if broker.fetch_jobs_deadline < 0 or broker.select_job_deadline < 0:
+        raise ValueError(
+            f"Invalid config: {FETCH_JOBS_DEADLINE} / {SELECT_JOB_DEADLINE} >= 0."
+        )
+
+    # Failover between several brokers, default: host / port
+    endpoints = config.get(BROKER_SECTION, ENDPOINTS, fallback="")
+    broker.endpoints = [
+        _endpoint_section(config, name.strip())
+        for name in endpoints.split(",")
+        if name.strip()
+    ]
+
+    return broker
+
+
+def _endpoint_section(config, name):
+    section = ENDPOINT_SECTION.format(name)
+
+    if not config.has_option(section, HOST):
+        raise ValueError(f"Invalid config: Set {HOST} of endpoint in [{section}].")
+
+    return Endpoint(
+        name,
+        config.get(section, HOST),
+        config.getint(section, PORT, fallback=1883),
+        *_tls_files(config, section),
+    )
+
+
+def _tls_files(config, section):
+    cafile = config.get(section, CAFILE, fallback=None)
+    certfile = config.get(section, CERTFILE, fallback=None)
+    keyfile = config.get(section, KEYFILE, fallback=None)
+
+    set_files_count = sum(filepath is None for filepath in [cafile, certfile, keyfile])
+
     # optional, but if one is giving all are expected
     if set_files_count not in [0, 3]:
-        raise Exception(
+        raise ValueError(
             "Invalid config: Either set all (cafile|certfile|keyfile) or none."
         )
 
-    return broker
+    return cafile, certfile, keyfile
 
 
 def _hooks_section(config):
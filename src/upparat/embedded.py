@@ -0,0 +1,127 @@
+"""
+Embedded mode: Upparat inside an application that already has a
+connected Paho client, e.g. for its telemetry. Upparat uses that
+connection instead of opening its own, see the README (Embedding).
+
+The application keeps owning the client and its network loop:
+job messages are taken from the client with message_callback_add
+and Upparat's callbacks are chained in front of the application's.
+"""
+from paho.mqtt.client import MQTT_ERR_SUCCESS
+
+from upparat.config import settings
+from upparat.jobs import JobTopicIndex
+from upparat.mqtt import ClientAdapter
+from upparat.statemachine.machine import create_statemachine
+
+# Messages of the Jobs service, the rest stays with the application
+JOB_TOPICS = "$aws/things/+/jobs/#"
+
+# Callbacks of the application, chained behind ours
+CALLBACKS = (
+    "on_connect",
+    "on_disconnect",
+    "on_subscribe",
+    "on_unsubscribe",
+    "on_publish",
+)
+
+
+class EmbeddedMQTT(ClientAdapter):
+    """
+    Upparat's subscriptions, outbox and ingress on an application's
+    Paho client. Acknowledgements of Upparat's subscriptions and
+    publishes are handled here, all others are passed on to the
+    callbacks the application set before creating it.
+
+    There is no network loop of our own: subscriptions not acknowledged
+    in time expire on the next callback instead of within a second.
+    """
+
+    def __init__(self, client, queue, **kwargs):
+        super().__init__(client, queue, **kwargs)
+
+        # mids of our publishes, their PUBACK isn't the application's
+        self._published_mids = set()
+
+        self._callbacks = {name: getattr(client, name) for name in CALLBACKS}
+
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        client.on_subscribe = self._on_subscribe
+        client.on_unsubscribe = self._on_unsubscribe
+        client.on_publish = self._on_publish
+        client.message_callback_add(JOB_TOPICS, self._on_message)
+
+    def disconnect(self):
+        """
+        Detach from the client (e.g. on shutdown), the connection
+        stays up and belongs to the application.
+        """
+        self._client.message_callback_remove(JOB_TOPICS)
+        for name, callback in self._callbacks.items():
+            setattr(self._client, name, callback)
+
+    def _client_publish(self, *args, **kwargs):
+        # Paho calls on_publish holding this lock, so the PUBACK
+        # can't be handled before the mid is known (see (A) in mqtt).
+        with self._client._out_message_mutex:
+            info = self._client.publish(*args, **kwargs)
+            if info.rc == MQTT_ERR_SUCCESS or info.mid in self._client._out_messages:
+                self._published_mids.add(info.mid)
+        return info
+
+    def _forward(self, name, *args):
+        callback = self._callbacks[name]
+        if callback:
+            callback(*args)
+
+    def _on_connect(self, client, userdata, flags, rc, *args):
+        self._on_connect_handler(client, userdata, flags, rc)
+        self._forward("on_connect", client, userdata, flags, rc, *args)
+
+    def _on_disconnect(self, client, userdata, rc, *args):
+        self._on_disconnect_handler(client, userdata, rc)
+        self._forward("on_disconnect", client, userdata, rc, *args)
+
+    def _on_message(self, client, userdata, message):
+        self._expire_mids()
+        self._on_message_handler(client, userdata, message)
+
+    def _on_subscribe(self, client, userdata, mid, granted_qos, *args):
+        self._expire_mids()
+        if mid in self._subscription_mid:
+            self._on_subscribe_handler(client, userdata, mid, granted_qos)
+        else:
+            self._forward("on_subscribe", client, userdata, mid, granted_qos, *args)
+
+    def _on_unsubscribe(self, client, userdata, mid, *args):
+        self._expire_mids()
+        if mid in self._unsubscription_mid:
+            self._on_unsubscribe_handler(client, userdata, mid)
+        else:
+            self._forward("on_unsubscribe", client, userdata, mid, *args)
+
+    def _on_publish(self, client, userdata, mid):
+        self._expire_mids()
+        if mid in self._published_mids:
+            self._published_mids.discard(mid)
+            self._on_publish_handler(client, userdata, mid)
+        else:
+            self._forward("on_publish", client, userdata, mid)
+
+
+def create_embedded_statemachine(
+    client, inbox, thing_name=None, outbox=None, journal=None
+):
+    """
+    State machine of thing_name (default: broker thing_name) on the
+    connection of the application's Paho client. The application
+    dispatches the events of the inbox, see cli(). With a journal
+    (upparat.journal) the job in processing is resumed on startup.
+    """
+    thing_name = thing_name or settings.broker.thing_name
+    mqtt_client = EmbeddedMQTT(
+        client, inbox, topic_index=JobTopicIndex(thing_name), outbox=outbox
+    )
+    return create_statemachine(inbox, mqtt_client, thing_name, journal=journal)
@@ -0,0 +1,100 @@
+"""
+Failover between several brokers (broker endpoints), e.g. an on-prem
+bridge and AWS IoT Core directly.
+
+When the current endpoint failed to connect (or there is none yet) the
+endpoints are probed (TCP connect) before the reconnect and the fastest
+one without failed connects since is chosen. The MQTT client
+stays the same, so subscriptions, the outbox and the state machine
+carry over to the other endpoint, see MQTT.reconnect().
+"""
+import logging
+import socket
+import time
+
+from .metrics import metrics
+from .metrics import MQTT_FAILOVERS
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for an endpoint to accept the TCP connection
+PROBE_TIMEOUT = 2
+
+
+class Endpoints:
+    def __init__(self, endpoints, ssl_contexts=None, probe_timeout=PROBE_TIMEOUT):
+        self.endpoints = list(endpoints)
+        # endpoint name → SSLContext, none for plain MQTT
+        self.ssl_contexts = ssl_contexts or {}
+        self.current = None
+        self._probe_timeout = probe_timeout
+        # endpoint name → failed connects since last connected
+        self._failures = {endpoint.name: 0 for endpoint in self.endpoints}
+        # endpoint name → latency of probe_all() for the next select()
+        self._latencies = None
+
+    def probe(self, endpoint):
+        """ Connect latency of endpoint in seconds, None if unreachable. """
+        start = time.monotonic()
+
+        try:
+            address = (endpoint.host, endpoint.port)
+            socket.create_connection(address, self._probe_timeout).close()
+        except OSError as e:
+            logger.info(f"Endpoint {endpoint.name} unreachable: {e}")
+            return None
+
+        latency = time.monotonic() - start
+        logger.debug(f"Endpoint {endpoint.name} latency {latency * 1000:.0f}ms.")
+        return latency
+
+    @property
+    def probing(self):
+        """ Whether select() chooses among the endpoints by probing them. """
+        if len(self.endpoints) < 2:
+            return False
+
+        # Stay with an endpoint as long as it connects
+        return self.current is None or self._failures[self.current.name] > 0
+
+    def probe_all(self):
+        """
+        Probe the endpoints for the next select() ahead of time, e.g. in
+        a thread as the probes block for up to probe_timeout each.
+        """
+        self._latencies = {e.name: self.probe(e) for e in self.endpoints}
+
+    def select(self):
+        """ The endpoint to connect to next. """
+        endpoint = self.current or self.endpoints[0]
+
+        if self.probing:
+            if self._latencies is None:
+                self.probe_all()
+
+            latencies, self._latencies = self._latencies, None
+            reachable = [e for e in self.endpoints if latencies[e.name] is not None]
+
+            # Unreachable as well, they might just have been slow to answer:
+            # endpoints are tried in turn as their failures add up.
+            endpoint = min(
+                reachable or self.endpoints,
+                key=lambda e: (self._failures[e.name], latencies[e.name] or 0),
+            )
+
+        if endpoint is not self.current:
+            if self.current is not None:
+                logger.warning(
+                    f"Failing over from endpoint {self.current.name} to {endpoint.name}."
+                )
+                metrics.increment(MQTT_FAILOVERS)
+
+            self.current = endpoint
+
+        return endpoint
+
+    def connected(self):
+        self._failures[self.current.name] = 0
+
+    def failed(self):
+        self._failures[self.current.name] += 1
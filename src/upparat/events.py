@@ -30,14 +30,29 @@ JOB = "job"
 MQTT_MESSAGE_RECEIVED = "mqtt-message-received"
 MQTT_SUBSCRIBED = "mqtt-subscribed"
 MQTT_UNSUBSCRIBED = "mqtt-unsubscribed"
+MQTT_CONNECTED = "mqtt-connected"
+MQTT_DISCONNECTED = "mqtt-disconnected"
+MQTT_SUBSCRIBE_TIMEOUT = "mqtt-subscribe-timeout"
 
 # MQTT event data
 MQTT_EVENT_TOPIC = "topic"
 MQTT_EVENT_PAYLOAD = "payload"
+MQTT_EVENT_JOB_TOPIC = "job_topic"
+MQTT_EVENT_JOB_ID = "job_id"
+MQTT_EVENT_SESSION_PRESENT = "session_present"
+MQTT_EVENT_QOS = "qos"
 
 # Service
 EXIT_SIGNAL_SENT = "exit-signal"
 
+# No response in time, see BaseState.set_deadline
+DEADLINE_EXPIRED = "deadline-expired"
+DEADLINE_SECONDS = "deadline_seconds"
+DEADLINE_RETRIES = "deadline_retries"
+
+# Thing the event belongs to, see upparat.gateway
+THING_NAME = "thing_name"
+
 # Hooks
 HOOK = "hook"
 HOOK_COMMAND = "hook-command"
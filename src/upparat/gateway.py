@@ -0,0 +1,43 @@
+"""
+Gateway mode (broker thing_names): a state machine per thing, all
+sharing the MQTT connection, the inbox and the hooks of the gateway.
+
+Messages are routed by the $aws/things/<thing_name>/ prefix of their
+topic, events of states and hooks carry the thing name (THING_NAME).
+"""
+import logging
+
+from upparat.events import MQTT_EVENT_TOPIC
+from upparat.events import THING_NAME
+from upparat.jobs import thing_name_from_topic
+
+logger = logging.getLogger(__name__)
+
+
+class Gateway:
+    """ Dispatches the events of the inbox to the state machine of their thing. """
+
+    def __init__(self, state_machines):
+        self.state_machines = {
+            state_machine.thing_name: state_machine for state_machine in state_machines
+        }
+
+    def dispatch(self, event):
+        thing_name = event.cargo.get(THING_NAME)
+
+        if thing_name is None and MQTT_EVENT_TOPIC in event.cargo:
+            thing_name = thing_name_from_topic(event.cargo[MQTT_EVENT_TOPIC])
+
+        # Connection events and the exit signal concern every thing
+        if thing_name is None:
+            for state_machine in self.state_machines.values():
+                state_machine.dispatch(event)
+            return
+
+        state_machine = self.state_machines.get(thing_name)
+
+        if state_machine is None:
+            logger.debug(f"Dropping event {event.name} of unknown thing {thing_name}.")
+            return
+
+        state_machine.dispatch(event)
@@ -0,0 +1,55 @@
+"""
+Health of the broker connection, see MQTT: keepalive and the round
+trip times of PINGREQ / PINGRESP.
+
+The keepalive in CONNECT is keepalive_max, the broker's deadline. While
+a job is processed we ping every keepalive_min, so a dead connection is
+noticed within 2 × keepalive_min instead of 2 × keepalive_max. Otherwise
+pings are rare, to save traffic on metered links.
+"""
+from .metrics import metrics
+from .metrics import MQTT_PING_RTT
+
+# Consecutive slow round trips before reconnecting
+DEGRADED_PINGS = 3
+
+
+class ConnectionHealth:
+    def __init__(
+        self, keepalive_min, keepalive_max, max_ping_rtt, degraded_pings=DEGRADED_PINGS
+    ):
+        self.keepalive_min = keepalive_min
+        self.keepalive_max = keepalive_max
+        self.max_ping_rtt = max_ping_rtt
+        self._degraded_pings = degraded_pings
+        # Things processing a job
+        self._active = set()
+        self._slow_pings = 0
+
+    @property
+    def keepalive(self):
+        """ Current ping interval in seconds. """
+        return self.keepalive_min if self._active else self.keepalive_max
+
+    @property
+    def degraded(self):
+        return self._slow_pings >= self._degraded_pings
+
+    def set_job_active(self, thing_name, active):
+        if active:
+            self._active.add(thing_name)
+        else:
+            self._active.discard(thing_name)
+
+    def ping(self, rtt):
+        """ Round trip time of a PINGREQ in seconds. """
+        metrics.observe(MQTT_PING_RTT, rtt)
+
+        if rtt > self.max_ping_rtt:
+            self._slow_pings += 1
+        else:
+            self._slow_pings = 0
+
+    def reset(self):
+        # A new connection starts healthy
+        self._slow_pings = 0
@@ -1,4 +1,7 @@
+import asyncio
+import functools
 import logging
+import os
 import subprocess
 import threading
 from queue import Queue
@@ -6,6 +9,7 @@ from timeit import default_timer
 
 import pysm
 
+from upparat.aio import Inbox
 from upparat.config import settings
 from upparat.events import HOOK
 from upparat.events import HOOK_COMMAND
@@ -15,11 +19,33 @@ from upparat.events import HOOK_STATUS_COMPLETED
 from upparat.events import HOOK_STATUS_FAILED
 from upparat.events import HOOK_STATUS_OUTPUT
 from upparat.events import HOOK_STATUS_TIMED_OUT
+from upparat.events import THING_NAME
 
 logger = logging.getLogger(__name__)
 
 RETRY_EXIT_CODE = 3
 
+# Environment variable with the thing the hook runs for
+THING_NAME_ENV = "UPPARAT_THING_NAME"
+
+# Seconds a stopped hook gets to exit before it's killed (asyncio runtime)
+STOP_TIMEOUT = 5
+
+# Hooks running on the event loop, which only keeps weak references
+_hook_tasks = set()
+
+
+class _ThingInbox:
+    """ Tags the hook events with the thing, see upparat.gateway. """
+
+    def __init__(self, inbox, thing_name):
+        self.inbox = inbox
+        self.thing_name = thing_name
+
+    def put(self, event):
+        event.cargo[THING_NAME] = self.thing_name
+        self.inbox.put(event)
+
 
 def _publish(inbox, hook, status, message):
     inbox.put(
@@ -29,7 +55,7 @@ def _publish(inbox, hook, status, message):
     )
 
 
-def _hook(hook, stop_event, inbox: Queue, args: list):
+def _hook(hook, stop_event, inbox: Queue, args: list, env=None):
     retry = 0
     max_retries = settings.hooks.max_retries
     retry_interval = settings.hooks.retry_interval
@@ -45,6 +71,7 @@ def _hook(hook, stop_event, inbox: Queue, args: list):
             stdout=subprocess.PIPE,
             universal_newlines=True,
             bufsize=1,
+            env=env,
         ) as process:
             last_line = None
             try:
@@ -61,37 +88,146 @@ def _hook(hook, stop_event, inbox: Queue, args: list):
             process.wait()
             return_code = process.poll()
 
-            if return_code == RETRY_EXIT_CODE:
-                # todo: check if last_line contains a custom timeout and use this
-                #       as the sleep duration.
-                logger.debug(f"Retry '{hook}' in {retry_interval}s")
-
-                # sleep for retry_interval, if stop_event is set break immediately
-                if stop_event.wait(retry_interval):
-                    break
-
-                retry += 1
-                if retry == max_retries:
-                    _publish(
-                        inbox,
-                        hook,
-                        HOOK_STATUS_TIMED_OUT,
-                        f"Timeout after {max_retries * retry_interval}s",
-                    )
-                    logger.warning(
-                        f"Giving up on command '{hook}' after {max_retries * retry_interval}s"
-                    )
-                    break
-            elif return_code:
-                _publish(inbox, hook, HOOK_STATUS_FAILED, f"Exit code: {return_code}")
-                logger.error(f"Command '{hook}' failed with code: {return_code}")
-                break
-            else:
-                _publish(inbox, hook, HOOK_STATUS_COMPLETED, last_line)
-                break
-
-
-def run_hook(hook, inbox, args=None, join=False):
+        if _completed(hook, inbox, return_code, last_line):
+            break
+
+        # todo: check if last_line contains a custom timeout and use this
+        #       as the sleep duration.
+        logger.debug(f"Retry '{hook}' in {retry_interval}s")
+
+        # sleep for retry_interval, if stop_event is set break immediately
+        if stop_event.wait(retry_interval):
+            break
+
+        retry += 1
+        if retry == max_retries:
+            _timed_out(hook, inbox)
+            break
+
+
+async def _hook_async(hook, stop_event, inbox, args: list, env=None):
+    """
+    See _hook, as asyncio subprocess on the event loop (asyncio runtime).
+    Setting stop_event also terminates a running hook.
+    """
+    retry = 0
+    max_retries = settings.hooks.max_retries
+    retry_interval = settings.hooks.retry_interval
+
+    first_call_timer = default_timer()
+
+    while retry < max_retries and not stop_event.is_set():
+        time_elapsed = int(default_timer() - first_call_timer)
+
+        try:
+            process = await asyncio.create_subprocess_exec(
+                hook,
+                str(time_elapsed),
+                str(retry),
+                *args,
+                stdout=subprocess.PIPE,
+                env=env,
+            )
+        except OSError as e:
+            logger.error(f"Command '{hook}' failed: {e}")
+            _publish(inbox, hook, HOOK_STATUS_FAILED, str(e))
+            break
+
+        output = asyncio.ensure_future(_hook_output(hook, inbox, process))
+        stopped = asyncio.ensure_future(stop_event.wait())
+        await asyncio.wait({output, stopped}, return_when=asyncio.FIRST_COMPLETED)
+        stopped.cancel()
+
+        if not output.done():
+            output.cancel()
+            await _stop_process(hook, process)
+            break
+
+        last_line = output.result()
+        return_code = await process.wait()
+
+        if _completed(hook, inbox, return_code, last_line):
+            break
+
+        logger.debug(f"Retry '{hook}' in {retry_interval}s")
+
+        # sleep for retry_interval, if stop_event is set break immediately
+        try:
+            await asyncio.wait_for(stop_event.wait(), retry_interval)
+            break
+        except asyncio.TimeoutError:
+            pass
+
+        retry += 1
+        if retry == max_retries:
+            _timed_out(hook, inbox)
+            break
+
+
+def _completed(hook, inbox, return_code, last_line):
+    """ Publish the result of a hook run, False if the hook asks for a retry. """
+    if return_code == RETRY_EXIT_CODE:
+        return False
+
+    if return_code:
+        _publish(inbox, hook, HOOK_STATUS_FAILED, f"Exit code: {return_code}")
+        logger.error(f"Command '{hook}' failed with code: {return_code}")
+    else:
+        _publish(inbox, hook, HOOK_STATUS_COMPLETED, last_line)
+
+    return True
+
+
+def _timed_out(hook, inbox):
+    max_retries = settings.hooks.max_retries
+    retry_interval = settings.hooks.retry_interval
+
+    _publish(
+        inbox,
+        hook,
+        HOOK_STATUS_TIMED_OUT,
+        f"Timeout after {max_retries * retry_interval}s",
+    )
+    logger.warning(
+        f"Giving up on command '{hook}' after {max_retries * retry_interval}s"
+    )
+
+
+async def _hook_output(hook, inbox, process):
+    """ Publish the output of the hook, returns the last line. """
+    last_line = None
+    async for line in process.stdout:
+        line = line.decode().strip()
+        if line:
+            last_line = line
+            _publish(inbox, hook, HOOK_STATUS_OUTPUT, line)
+    return last_line
+
+
+async def _stop_process(hook, process):
+    logger.info(f"Stopping command '{hook}'")
+    process.terminate()
+
+    try:
+        await asyncio.wait_for(process.wait(), STOP_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"Killing command '{hook}'")
+        process.kill()
+        await process.wait()
+
+
+def _hook_task_done(hook, inbox, task):
+    _hook_tasks.discard(task)
+
+    if task.cancelled() or task.exception() is None:
+        return
+
+    # Otherwise the state would wait for the hook forever
+    logger.error(f"Command '{hook}' failed", exc_info=task.exception())
+    _publish(inbox, hook, HOOK_STATUS_FAILED, str(task.exception()))
+
+
+def run_hook(hook, inbox, args=None, join=False, thing_name=None):
     if not hook:
         return
 
@@ -101,12 +237,40 @@ def run_hook(hook, inbox, args=None, join=False):
         args = [str(arg) if arg else "" for arg in args]
 
     logger.debug(f"Run hook: {hook} {' '.join(args)}")
+
+    # The asyncio runtime runs hooks on its event loop instead of a thread
+    loop = inbox.loop if isinstance(inbox, Inbox) else None
+
+    # Hooks serving several things (gateway mode) get the thing as
+    # environment variable, their events are routed back to it.
+    env = None
+    if thing_name:
+        env = {**os.environ, THING_NAME_ENV: thing_name}
+        inbox = _ThingInbox(inbox, thing_name)
+
+    if loop:
+        stop_event = asyncio.Event()
+        task = loop.create_task(
+            _hook_async(
+                hook=hook, args=args, stop_event=stop_event, inbox=inbox, env=env
+            )
+        )
+        _hook_tasks.add(task)
+        task.add_done_callback(functools.partial(_hook_task_done, hook, inbox))
+        return stop_event
+
     stop_event = threading.Event()
 
     hook_runner = threading.Thread(
         daemon=True,
         target=_hook,
-        kwargs={"hook": hook, "args": args, "stop_event": stop_event, "inbox": inbox},
+        kwargs={
+            "hook": hook,
+            "args": args,
+            "stop_event": stop_event,
+            "inbox": inbox,
+            "env": env,
+        },
     )
     hook_runner.start()
 
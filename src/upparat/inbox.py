@@ -0,0 +1,185 @@
+"""
+Inbox of the state machine: events of MQTT, hooks, downloads and
+signals, dispatched one at a time by cli().
+
+Shutdown and job notifications (which might cancel the job in
+processing) go before the MQTT messages waiting, never before the
+events of the state machine itself (e.g. hook results). Output of a
+chatty hook is coalesced, a line waiting in the inbox is replaced by
+the next one of the same hook.
+Once the inbox reaches its high-water mark, hook threads wait with
+their output until the state machine caught up (backpressure).
+
+Timers scheduled in the inbox put their event once due, see
+upparat.timers.
+"""
+import threading
+from collections import deque
+from queue import Empty
+
+from pysm import Event
+
+from upparat.events import EXIT_SIGNAL_SENT
+from upparat.events import HOOK
+from upparat.events import HOOK_COMMAND
+from upparat.events import HOOK_STATUS
+from upparat.events import HOOK_STATUS_OUTPUT
+from upparat.events import MQTT_EVENT_JOB_TOPIC
+from upparat.events import MQTT_MESSAGE_RECEIVED
+from upparat.events import THING_NAME
+from upparat.jobs import JobTopic
+from upparat.metrics import INBOX_BACKPRESSURE
+from upparat.metrics import INBOX_COALESCED
+from upparat.metrics import INBOX_PENDING
+from upparat.metrics import metrics
+from upparat.timers import Timer
+from upparat.timers import Timers
+
+# Events waiting before hooks wait with their output
+HIGH_WATER = 100
+
+
+def is_urgent(event):
+    """ Events dispatched before all others. """
+    if event.name == EXIT_SIGNAL_SENT:
+        return True
+
+    if event.name != MQTT_MESSAGE_RECEIVED:
+        return False
+
+    # Pending jobs changed, the job in processing might be canceled
+    return event.cargo.get(MQTT_EVENT_JOB_TOPIC) == JobTopic.NOTIFY
+
+
+def can_overtake(event):
+    """ Events urgent ones are dispatched before, see PriorityInbox.put. """
+    if not isinstance(event, Event) or event.name != MQTT_MESSAGE_RECEIVED:
+        return False
+
+    return not is_urgent(event)
+
+
+def coalesce_key(event):
+    """ Consecutive events with the same key are coalesced, None if not. """
+    if event.name == HOOK and event.cargo.get(HOOK_STATUS) == HOOK_STATUS_OUTPUT:
+        return event.cargo.get(THING_NAME), event.cargo.get(HOOK_COMMAND)
+
+    return None
+
+
+class PriorityInbox:
+    """
+    Drop-in for the queue.Queue of the inbox: urgent events before the
+    MQTT messages waiting, otherwise in order. high_water=None disables
+    the backpressure.
+    """
+
+    def __init__(self, high_water=HIGH_WATER, timers=None):
+        self.timers = Timers() if timers is None else timers
+        self._events = deque()
+        self._high_water = high_water
+        # Thread getting the events, never waits in put()
+        self._dispatcher = None
+
+        # Re-entrant, signal handlers put from the dispatching thread
+        self._lock = threading.RLock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+        metrics.gauge(INBOX_PENDING, self.qsize)
+
+    def put(self, event):
+        with self._lock:
+            if is_urgent(event):
+                self._put_urgent(event)
+            else:
+                key = coalesce_key(event)
+                if key is not None and self._coalesce(key, event):
+                    return
+                self._events.append(event)
+
+            self._not_empty.notify()
+
+    def _put_urgent(self, event):
+        """ Before the MQTT messages at the end, after any other event. """
+        index = len(self._events)
+        while index and can_overtake(self._events[index - 1]):
+            index -= 1
+        self._events.insert(index, event)
+
+    def _coalesce(self, key, event):
+        """ Replace the last event if it has the same key or wait for space. """
+        waited = False
+
+        while True:
+            last = self._events[-1] if self._events else None
+            if isinstance(last, Event) and coalesce_key(last) == key:
+                self._events[-1] = event
+                metrics.increment(INBOX_COALESCED)
+                return True
+
+            if not self._full() or threading.get_ident() == self._dispatcher:
+                return False
+
+            if not waited:
+                metrics.increment(INBOX_BACKPRESSURE)
+                waited = True
+
+            self._not_full.wait()
+
+    def _full(self):
+        return self._high_water is not None and self.qsize() >= self._high_water
+
+    def schedule(self, delay, event, interval=None):
+        """
+        Put event in delay seconds, again every interval seconds for a
+        periodic timer. Returns the Timer to cancel it.
+        """
+        with self._lock:
+            timer = self.timers.schedule(delay, event, interval)
+            # The dispatcher might wait for a later timer
+            self._not_empty.notify()
+            return timer
+
+    def get(self, block=True, timeout=None):
+        with self._lock:
+            self._dispatcher = threading.get_ident()
+
+            end = None
+            if not block:
+                end = self.timers.clock()
+            elif timeout is not None:
+                end = self.timers.clock() + timeout
+
+            while True:
+                self._events.extend(self.timers.due())
+
+                while self.qsize():
+                    event = self._events.popleft()
+                    self._not_full.notify()
+
+                    # Cancelled after it was due, e.g. its state was left
+                    if isinstance(event, Timer):
+                        if event.cancelled:
+                            continue
+                        event = event.fire()
+
+                    return event
+
+                wait = self.timers.timeout()
+                if end is not None:
+                    remaining = end - self.timers.clock()
+                    if remaining <= 0:
+                        raise Empty
+                    wait = remaining if wait is None else min(wait, remaining)
+
+                self._not_empty.wait(wait)
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def empty(self):
+        return not self.qsize()
+
+    def qsize(self):
+        return len(self._events)
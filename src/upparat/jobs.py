@@ -1,8 +1,9 @@
-import json
 import os
+import re
 from enum import Enum
 
 from upparat.config import settings
+from upparat.serialization import dumps
 
 # FIXME: Prefix jobs since there could be
 # multiple services consuming AWS IoT Jobs.
@@ -29,9 +30,38 @@ JOB_MESSAGE = "message"
 # AWS jobs status
 JOB_STATUS = "status"
 JOB_STATUS_DETAILS = "statusDetails"
+JOB_CLIENT_TOKEN = "clientToken"
 JOB_ACCEPTED = "accepted"
 JOB_REJECTED = "rejected"
 
+# Job id of the next pending job execution
+NEXT_JOB_ID = "$next"
+
+
+class JobTopic(Enum):
+    NOTIFY = "notify"
+    NOTIFY_NEXT = "notify_next"
+    GET_ACCEPTED = "get_accepted"
+    GET_REJECTED = "get_rejected"
+    DESCRIBE_ACCEPTED = "describe_accepted"
+    DESCRIBE_REJECTED = "describe_rejected"
+    UPDATE_ACCEPTED = "update_accepted"
+    UPDATE_REJECTED = "update_rejected"
+
+
+# Topic levels below $aws/things/<thing_name>/jobs/,
+# "+" matches the job id of the job execution.
+JOB_TOPIC_LEVELS = {
+    ("notify",): JobTopic.NOTIFY,
+    ("notify-next",): JobTopic.NOTIFY_NEXT,
+    ("get", JOB_ACCEPTED): JobTopic.GET_ACCEPTED,
+    ("get", JOB_REJECTED): JobTopic.GET_REJECTED,
+    ("+", "get", JOB_ACCEPTED): JobTopic.DESCRIBE_ACCEPTED,
+    ("+", "get", JOB_REJECTED): JobTopic.DESCRIBE_REJECTED,
+    ("+", "update", JOB_ACCEPTED): JobTopic.UPDATE_ACCEPTED,
+    ("+", "update", JOB_REJECTED): JobTopic.UPDATE_REJECTED,
+}
+
 
 class JobStatus(Enum):
     QUEUED = "QUEUED"
@@ -57,6 +87,7 @@ class JobSuccessStatus(Enum):
     COMPLETE_NO_VERSION_CHECK = "complete_no_version_check"
     COMPLETE_NO_READY_CHECK = "complete_no_ready_check"
     COMPLETE_READY = "complete_ready"
+    SUPERSEDED = "superseded"
 
 
 class JobFailedStatus(Enum):
@@ -91,6 +122,13 @@ def jobs_base(thing_name):
     return f"$aws/things/{thing_name}/jobs/"
 
 
+def thing_name_from_topic(topic):
+    """ Thing name of a $aws/things/<thing_name>/... topic or None. """
+    levels = topic.split("/", 3)
+    if len(levels) > 2 and levels[0] == "$aws" and levels[1] == "things":
+        return levels[2]
+
+
 def get_pending_job_executions(thing_name):
     return os.path.join(jobs_base(thing_name), "get")
 
@@ -107,10 +145,22 @@ def pending_jobs_response(thing_name):
     return os.path.join(jobs_base(thing_name), "notify")
 
 
+def next_job_execution_changed(thing_name):
+    return os.path.join(jobs_base(thing_name), "notify-next")
+
+
 def update_job_execution(thing_name, job_id):
     return os.path.join(jobs_base(thing_name), job_id, "update")
 
 
+def update_job_execution_response(thing_name, job_id, state_filter=None):
+    if state_filter:
+        query = state_filter
+    else:
+        query = "+"
+    return os.path.join(jobs_base(thing_name), job_id, "update", query)
+
+
 def describe_job_execution(thing_name, job_id):
     return os.path.join(jobs_base(thing_name), job_id, "get")
 
@@ -123,10 +173,28 @@ def describe_job_execution_response(thing_name, job_id, state_filter=None):
     return os.path.join(jobs_base(thing_name), job_id, "get", query)
 
 
+def job_subscriptions(thing_name, notify_next=False):
+    """
+    Topic filters Upparat subscribes to once for the lifetime of the
+    connection. States only listen to the messages they're interested in.
+    """
+    subscriptions = [
+        pending_jobs_response(thing_name),
+        get_pending_job_executions_response(thing_name),
+        describe_job_execution_response(thing_name, "+"),
+        update_job_execution_response(thing_name, "+"),
+    ]
+
+    if notify_next:
+        subscriptions.append(next_job_execution_changed(thing_name))
+
+    return subscriptions
+
+
 def job_update(mqtt_client, thing_name, job_id, status, state, message=None):
     mqtt_client.publish(
         update_job_execution(thing_name, job_id),
-        json.dumps(
+        dumps(
             {
                 JOB_STATUS: status,
                 JOB_STATUS_DETAILS: {
@@ -144,6 +212,17 @@ def filter_upparat_job_exectutions(job_executions):
     ]
 
 
+def filter_upparat_notification(payload):
+    """ The jobs/notify payload reduced to the upparat job executions. """
+    return {
+        **payload,
+        JOBS: {
+            status: filter_upparat_job_exectutions(job_executions)
+            for status, job_executions in payload.get(JOBS, {}).items()
+        },
+    }
+
+
 def job_update_multiple_as_failed(
     mqtt_client, thing_name, job_ids, state, message=None
 ):
@@ -153,10 +232,119 @@ def job_update_multiple_as_failed(
         )
 
 
-def get_in_progress_job_ids(payload):
+def job_update_multiple_as_succeeded(
+    mqtt_client, thing_name, job_ids, state, message=None
+):
+    for job_id in job_ids:
+        job_update(
+            mqtt_client, thing_name, job_id, JobStatus.SUCCEEDED.value, state, message
+        )
+
+
+def version_key(version):
+    """
+    Sort key of job document versions in natural order: numbers compare
+    numerically (1.10.0 > 1.9.2), everything else as text.
+    """
+    return [
+        (0, int(part), "") if part.isdigit() else (1, 0, part)
+        for part in re.split(r"(\d+)", str(version))
+        if part
+    ]
+
+
+def get_pending_job_ids(payload):
     jobs = payload.get(JOBS, {})
-    jobs_in_progress = jobs.get(JobStatus.IN_PROGRESS.value, [])
-    return [job[JOB_ID] for job in jobs_in_progress]
+    jobs_pending = jobs.get(JobStatus.IN_PROGRESS.value, []) + jobs.get(
+        JobStatus.QUEUED.value, []
+    )
+    return [job[JOB_ID] for job in jobs_pending]
+
+
+def get_pending_job_execution_ids(payload):
+    """ Job ids of a jobs/get response (see get_pending_job_ids for notify). """
+    jobs_pending = payload.get("inProgressJobs", []) + payload.get("queuedJobs", [])
+    return [job[JOB_ID] for job in jobs_pending]
+
+
+def job_from_execution(job_execution):
+    job_document = job_execution[JOB_DOCUMENT]
+
+    return Job(
+        id_=job_execution[JOB_ID],
+        status=job_execution[JOB_STATUS],
+        file_url=job_document[JOB_DOCUMENT_FILE],
+        version=job_document[JOB_DOCUMENT_VERSION],
+        force=job_document.get(JOB_DOCUMENT_FORCE, False),
+        meta=job_document.get(JOB_DOCUMENT_META),
+        status_details=job_execution.get(JOB_STATUS_DETAILS),
+    )
+
+
+def next_job(job_execution):
+    """
+    Job of the next pending job execution ($next / notify-next) if it can
+    be selected without the list of all pending job executions.
+
+    AWS returns in progress job executions first, so a queued upparat job
+    execution means there's none in progress and it's the one to run.
+    Anything else needs the full selection (prefix filtering, multiple
+    in progress) and returns None.
+    """
+    if not job_execution or not is_upparat_job_id(job_execution[JOB_ID]):
+        return None
+
+    if job_execution[JOB_STATUS] == JobStatus.QUEUED.value:
+        return job_from_execution(job_execution)
+
+
+class JobTopicIndex:
+    """
+    Classify an incoming topic once, so handlers can switch on
+    a JobTopic instead of matching topic strings themselves.
+
+    The known job topics of the things (several in gateway mode) are
+    compiled into a trie of topic levels, a "+" level captures the job id.
+    """
+
+    WILDCARD = "+"
+    LEAF = None
+
+    def __init__(self, *thing_names):
+        self._trie = {}
+
+        for thing_name in thing_names:
+            base = jobs_base(thing_name).rstrip("/").split("/")
+            for levels, job_topic in JOB_TOPIC_LEVELS.items():
+                node = self._trie
+                for level in base + list(levels):
+                    node = node.setdefault(level, {})
+                node[self.LEAF] = job_topic
+
+    def classify(self, topic):
+        """
+        :returns: (JobTopic, job id) of the topic, job id is None for topics
+                  without a job id. (None, None) for unknown topics.
+        """
+        return self._match(self._trie, topic.split("/"), None)
+
+    def _match(self, node, levels, job_id):
+        if not levels:
+            return node.get(self.LEAF), job_id
+
+        level, remaining = levels[0], levels[1:]
+
+        # Exact levels take precedence, e.g. jobs/get/accepted
+        # vs. jobs/<job id>/get/accepted with job id "get".
+        if level in node:
+            job_topic, matched_job_id = self._match(node[level], remaining, job_id)
+            if job_topic:
+                return job_topic, matched_job_id
+
+        if self.WILDCARD in node:
+            return self._match(node[self.WILDCARD], remaining, level)
+
+        return None, None
 
 
 class Job:
@@ -0,0 +1,144 @@
+"""
+Journal of the job executions in processing, one per thing, kept in
+the state location to survive a restart (e.g. the one the restart
+hook triggers).
+
+On startup the state machine resumes the journaled job right away
+instead of asking the Jobs service first: after a reboot the version
+and ready hooks run while MQTT is still connecting. The job is
+reconciled with the cloud once connected, see
+JobProcessingState._reconcile_job.
+"""
+import logging
+import os
+import threading
+
+from upparat.jobs import Job
+from upparat.jobs import JOB_DOCUMENT
+from upparat.jobs import JOB_DOCUMENT_FILE
+from upparat.jobs import JOB_DOCUMENT_FORCE
+from upparat.jobs import JOB_DOCUMENT_META
+from upparat.jobs import JOB_DOCUMENT_VERSION
+from upparat.jobs import job_from_execution
+from upparat.jobs import JOB_ID
+from upparat.jobs import JOB_STATUS
+from upparat.jobs import JOB_STATUS_DETAILS
+from upparat.jobs import JOB_STATUS_DETAILS_STATE
+from upparat.jobs import JobStatus
+from upparat.serialization import dumps
+from upparat.serialization import loads
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_FILE = "journal.json"
+
+# Size of the job's artifact when the entry was written: the artifact
+# only grows, a smaller one is truncated or not ours, see Journal.job
+DOWNLOADED_BYTES = "downloadedBytes"
+
+
+def _downloaded_bytes(job):
+    try:
+        return os.path.getsize(job.filepath)
+    except OSError:
+        return 0
+
+
+class Journal:
+    """
+    thing name → job execution in processing (the job document and
+    internal state as the Jobs service would describe it).
+
+    Written whenever the internal state of a job changes, replaced
+    atomically so a power cut leaves the previous version.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        # Download progress is recorded from the download's thread
+        self.lock = threading.Lock()
+        self._entries = self._read()
+
+    def _read(self):
+        try:
+            with open(self.path, "rb") as journal:
+                return loads(journal.read())
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            logger.warning(f"Ignoring corrupt job journal {self.path}.")
+            return {}
+
+    def _write(self):
+        temporary = f"{self.path}.tmp"
+
+        with open(temporary, "w") as journal:
+            journal.write(dumps(self._entries))
+            journal.flush()
+            os.fsync(journal.fileno())
+
+        os.replace(temporary, self.path)
+
+    def record(self, thing_name, job, state):
+        """ The job is in progress with the given internal state. """
+        with self.lock:
+            entry = self._entries.get(thing_name)
+
+            # e.g. download progress, the artifact itself tells the offset
+            if entry and entry[JOB_ID] == job.id_:
+                if entry[JOB_STATUS_DETAILS][JOB_STATUS_DETAILS_STATE] == state:
+                    return
+
+            self._entries[thing_name] = {
+                JOB_ID: job.id_,
+                JOB_STATUS: JobStatus.IN_PROGRESS.value,
+                JOB_DOCUMENT: {
+                    JOB_DOCUMENT_FILE: job.file_url,
+                    JOB_DOCUMENT_VERSION: job.version,
+                    JOB_DOCUMENT_FORCE: job.force,
+                    JOB_DOCUMENT_META: job.meta,
+                },
+                JOB_STATUS_DETAILS: {JOB_STATUS_DETAILS_STATE: state},
+                DOWNLOADED_BYTES: _downloaded_bytes(job),
+            }
+            self._write()
+
+    def clear(self, thing_name, job_id):
+        """ The job is done (succeeded, failed or canceled). """
+        with self.lock:
+            entry = self._entries.get(thing_name)
+            if entry and entry[JOB_ID] == job_id:
+                del self._entries[thing_name]
+                self._write()
+
+    def job(self, thing_name) -> Job:
+        """ The journaled job of thing_name or None. """
+        with self.lock:
+            entry = self._entries.get(thing_name)
+
+        if not entry:
+            return None
+
+        try:
+            job = job_from_execution(entry)
+        except (KeyError, TypeError):
+            logger.warning(f"Ignoring invalid job journal entry of {thing_name}.")
+            return None
+
+        downloaded_bytes = entry.get(DOWNLOADED_BYTES, 0)
+        size = _downloaded_bytes(job)
+
+        if downloaded_bytes and not size:
+            logger.info(f"Artifact of job {job.id_} is gone, downloading again.")
+        elif size < downloaded_bytes:
+            # Resuming the download would append to the wrong bytes
+            logger.warning(
+                f"Artifact of job {job.id_} has {size} of {downloaded_bytes} "
+                f"journaled bytes, downloading again."
+            )
+            try:
+                os.remove(job.filepath)
+            except OSError as e:
+                logger.warning(f"Unable to remove artifact of job {job.id_}: {e}")
+
+        return job
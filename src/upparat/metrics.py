@@ -0,0 +1,98 @@
+import threading
+
+# job updates
+JOB_UPDATES_PENDING = "job_updates.pending"
+JOB_UPDATES_INFLIGHT = "job_updates.inflight"
+JOB_UPDATES_REJECTED = "job_updates.rejected"
+JOB_UPDATE_PUBACK_LATENCY = "job_updates.puback_latency"
+JOB_UPDATE_ACK_LATENCY = "job_updates.ack_latency"
+
+# mqtt
+MQTT_SUBSCRIBES_PENDING = "mqtt.subscribes_pending"
+MQTT_UNSUBSCRIBES_PENDING = "mqtt.unsubscribes_pending"
+MQTT_SUBSCRIBE_TIMEOUTS = "mqtt.subscribe_timeouts"
+MQTT_UNSUBSCRIBE_TIMEOUTS = "mqtt.unsubscribe_timeouts"
+MQTT_MESSAGES_DROPPED = "mqtt.messages_dropped"
+MQTT_TLS_HANDSHAKE = "mqtt.tls_handshake"
+MQTT_TLS_SESSIONS_RESUMED = "mqtt.tls_sessions_resumed"
+MQTT_FAILOVERS = "mqtt.failovers"
+MQTT_PING_RTT = "mqtt.ping_rtt"
+MQTT_DEGRADED_RECONNECTS = "mqtt.degraded_reconnects"
+
+# states, formatted with the state name
+STATE_DEADLINES_EXPIRED = "states.{}.deadlines_expired"
+
+# inbox
+INBOX_PENDING = "inbox.pending"
+INBOX_COALESCED = "inbox.coalesced"
+INBOX_BACKPRESSURE = "inbox.backpressure"
+
+
+class Timing:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = None
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.last = seconds
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "max": self.max,
+            "last": self.last,
+        }
+
+
+class Metrics:
+    """
+    Process wide registry of counters, gauges and timings. Gauges
+    can be callables which are evaluated when taking a snapshot.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._timings = {}
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            self._timings.setdefault(name, Timing()).observe(seconds)
+
+    def snapshot(self):
+        with self._lock:
+            gauges = dict(self._gauges)
+            snapshot = dict(self._counters)
+            snapshot.update(
+                {name: timing.snapshot() for name, timing in self._timings.items()}
+            )
+
+        # Evaluate callables without holding the lock
+        for name, value in gauges.items():
+            snapshot[name] = value() if callable(value) else value
+
+        return snapshot
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._timings.clear()
+
+
+metrics = Metrics()
@@ -1,28 +1,98 @@
 import logging
+import random
 import struct
+import time
+import uuid
 
 from paho.mqtt.client import Client
 from paho.mqtt.client import CONNACK_ACCEPTED
 from paho.mqtt.client import connack_string
 from paho.mqtt.client import error_string
+from paho.mqtt.client import mqtt_cs_connected
+from paho.mqtt.client import mqtt_cs_disconnecting
+from paho.mqtt.client import MQTT_ERR_CONN_LOST
+from paho.mqtt.client import MQTT_ERR_KEEPALIVE
 from paho.mqtt.client import MQTT_ERR_NO_CONN
 from paho.mqtt.client import MQTT_ERR_SUCCESS
 from paho.mqtt.client import MQTT_LOG_DEBUG
+from paho.mqtt.client import MQTTMessageInfo
 from paho.mqtt.client import SUBSCRIBE
+from paho.mqtt.client import topic_matches_sub
 from paho.mqtt.client import UNSUBSCRIBE
 from pysm import Event
 
+from .events import MQTT_CONNECTED
+from .events import MQTT_DISCONNECTED
+from .events import MQTT_EVENT_JOB_ID
+from .events import MQTT_EVENT_JOB_TOPIC
 from .events import MQTT_EVENT_PAYLOAD
+from .events import MQTT_EVENT_QOS
+from .events import MQTT_EVENT_SESSION_PRESENT
 from .events import MQTT_EVENT_TOPIC
 from .events import MQTT_MESSAGE_RECEIVED
+from .events import MQTT_SUBSCRIBE_TIMEOUT
 from .events import MQTT_SUBSCRIBED
 from .events import MQTT_UNSUBSCRIBED
+from .jobs import EXECUTION
+from .jobs import filter_upparat_notification
+from .jobs import is_upparat_job_id
+from .jobs import JOB_ACCEPTED
+from .jobs import JOB_CLIENT_TOKEN
+from .jobs import JOB_ID
+from .jobs import JOB_MESSAGE
+from .jobs import JOBS
+from .jobs import JobTopic
+from .jobs import NEXT_JOB_ID
+from .jobs import thing_name_from_topic
+from .metrics import JOB_UPDATE_ACK_LATENCY
+from .metrics import JOB_UPDATE_PUBACK_LATENCY
+from .metrics import JOB_UPDATES_INFLIGHT
+from .metrics import JOB_UPDATES_PENDING
+from .metrics import JOB_UPDATES_REJECTED
+from .metrics import metrics
+from .metrics import MQTT_DEGRADED_RECONNECTS
+from .metrics import MQTT_MESSAGES_DROPPED
+from .metrics import MQTT_SUBSCRIBE_TIMEOUTS
+from .metrics import MQTT_SUBSCRIBES_PENDING
+from .metrics import MQTT_UNSUBSCRIBE_TIMEOUTS
+from .metrics import MQTT_UNSUBSCRIBES_PENDING
+from .serialization import dumps
+from .serialization import loads
 
 logger = logging.getLogger(__name__)
 
+# Job updates awaiting a response from the Jobs service
+MAX_INFLIGHT_UPDATES = 10
 
-class MQTT(Client):
+JOB_UPDATE_RESPONSES = (JobTopic.UPDATE_ACCEPTED, JobTopic.UPDATE_REJECTED)
+
+# Limit of AWS IoT for topics in one SUBSCRIBE packet
+MAX_TOPICS_PER_SUBSCRIBE = 8
+
+# Return code in a SUBACK for a refused topic
+SUBACK_FAILURE = 0x80
+
+# Seconds to wait for a SUBACK / UNSUBACK
+ACK_TIMEOUT = 30
+
+
+def queued_message_info():
+    """
+    Paho's publish() result for a message that is sent later (from the
+    job update outbox or by the event loop): accepted (MQTT_ERR_SUCCESS)
+    but without a mid, which is only known once it's sent.
     """
+    info = MQTTMessageInfo(0)
+    info.rc = MQTT_ERR_SUCCESS
+    return info
+
+
+class ClientAdapter:
+    """
+    Upparat's side of a Paho client: subscriptions, job update outbox
+    and the ingress of job messages into the queue. The connection
+    (and its network loop) is owned by MQTT or, embedded into an
+    application, by the application's client, see upparat.embedded.
 
     The underlying problem we address here is that we want a mapping
     between the subscription (message id, mid) and it's topic, mainly
@@ -39,7 +109,9 @@ class MQTT(Client):
 
     ---
 
-    → Therefore, we maintain our own mapping (mid → topic) here.
+    → Therefore, we maintain our own mapping (mid → topics) here,
+      one SUBSCRIBE (mid) can cover several topics. Entries expire
+      after ack_timeout or a disconnect, see _expire_mids().
 
     → The core of this logic is in subscribe() and on_unsubscribe()
       and the rest of the code is pretty much to make this work properly.
@@ -48,103 +120,395 @@ class MQTT(Client):
 
     """
 
-    def __init__(self, client_id, queue):
+    def __init__(
+        self,
+        client,
+        queue,
+        topic_index=None,
+        outbox=None,
+        max_inflight_updates=MAX_INFLIGHT_UPDATES,
+        ack_timeout=ACK_TIMEOUT,
+    ):
+        # Paho client of the connection
+        self._client = client
         self._queue = queue
+        self._topic_index = topic_index
+        self._outbox = outbox
+        self._max_inflight_updates = max_inflight_updates
+        # client token → (topic, time sent)
+        self._inflight = {}
+        # mid → client token
+        self._inflight_mid = {}
         self._subscriptions = {}
+        self._subscribed = set()
+        self._ack_timeout = ack_timeout
+        # mid → (topics, time sent)
         self._subscription_mid = {}
+        # mid → (topic, time sent)
         self._unsubscription_mid = {}
+        # thing name → job topics delivered to the inbox, see set_routes
+        self._routes = {}
+        # thing name → upparat jobs of the last notification delivered
+        self._last_notified_jobs = {}
 
-        super().__init__(client_id)
+        if outbox is not None:
+            metrics.gauge(JOB_UPDATES_PENDING, outbox.__len__)
+            metrics.gauge(JOB_UPDATES_INFLIGHT, self._inflight.__len__)
 
-        self.on_connect = self._on_connect_handler
-        self.on_message = self._on_message_handler
-        self.on_subscribe = self._on_subscribe_handler
-        self.on_unsubscribe = self._on_unsubscribe_handler
-
-    def run(self, host, port):
-        self.enable_logger()
-        logger.debug(f"Connect to {host}:{port}")
-        self.connect_async(host, port)
-        self.loop_start()
+        metrics.gauge(MQTT_SUBSCRIBES_PENDING, self._subscription_mid.__len__)
+        metrics.gauge(MQTT_UNSUBSCRIBES_PENDING, self._unsubscription_mid.__len__)
 
     def subscribe(self, topic, qos=0):
+        """ Subscribe to a topic or a list of (topic, qos) in one packet. """
+        topics = topic if isinstance(topic, list) else [(topic, qos)]
+
         # (A) Generate the message_id (for the mapping)
         # BEFORE we actually subscribe, since Paho
         # is threaded on_unsubscribe callback can be
         # called before _subscribe returns here, but we
-        # want to know the topic in the callback (B)
-        message_id = self._mid_generate()
-        self._subscription_mid[message_id] = topic
+        # want to know the topics in the callback (B)
+        message_id = self._client._mid_generate()
+        self._subscription_mid[message_id] = (
+            [t for t, _ in topics],
+            time.monotonic(),
+        )
 
         # We still want to keep the mapping for topic - qos
         # in case the error gets fixed by a reconnect later!
-        self._subscriptions[topic] = qos
+        for t, q in topics:
+            self._subscriptions[t] = q
 
         result, _ = self._subscribe(topic, qos=qos, mid=message_id)
         if result != MQTT_ERR_SUCCESS:
             # Remove mid on failure
-            del self._subscription_mid[message_id]
+            self._subscription_mid.pop(message_id, None)
             logger.warning(
-                f"Unable to subscribe to topic {topic}: {error_string(result)}"
+                f"Unable to subscribe to topic(s) "
+                f"{', '.join(t for t, _ in topics)}: {error_string(result)}"
             )
 
         return result, message_id
 
+    def is_subscribed(self, topic):
+        """ True if the broker acknowledged the subscription to topic. """
+        return topic in self._subscribed
+
+    def set_routes(self, job_topics, thing_name):
+        """
+        Job topics the current state of the thing handles, messages to
+        other topics are dropped on ingress. See _on_message_handler.
+        """
+        self._routes[thing_name] = frozenset(job_topics)
+        # A new state hasn't seen any notification yet
+        self._last_notified_jobs.pop(thing_name, None)
+
+    def set_job_active(self, thing_name, active):
+        """ Whether the thing processes a job, see MQTT's keepalive. """
+
     def unsubscribe(self, topic):
         self._subscriptions.pop(topic, None)
+        self._subscribed.discard(topic)
 
         # Comment (A) also applies here.
-        message_id = self._mid_generate()
-        self._unsubscription_mid[message_id] = topic
+        message_id = self._client._mid_generate()
+        self._unsubscription_mid[message_id] = (topic, time.monotonic())
 
         result, _ = self._unsubscribe(topic, mid=message_id)
 
         if result != MQTT_ERR_SUCCESS:
-            del self._unsubscription_mid[message_id]
+            self._unsubscription_mid.pop(message_id, None)
 
         return result, message_id
 
-    def _on_connect_handler(self, _, __, ___, rc):
+    def publish(self, topic, payload=None, qos=0, retain=False, **kwargs):
+        if self._outbox is None or not self._outbox.accepts(topic):
+            return self._client_publish(topic, payload, qos, retain, **kwargs)
+
+        # Job updates are tagged with a client token and kept in the
+        # outbox until the Jobs service acknowledged them, see
+        # _on_job_update_response. They're sent at QoS 1 from the
+        # outbox as long as the in-flight window allows.
+        client_token = uuid.uuid4().hex
+        payload = dumps({**loads(payload), JOB_CLIENT_TOKEN: client_token})
+
+        with self._outbox.lock:
+            self._outbox.put(topic, payload, client_token)
+            self._publish_outbox()
+
+        return queued_message_info()
+
+    def _client_publish(self, *args, **kwargs):
+        return self._client.publish(*args, **kwargs)
+
+    def _publish_outbox(self):
+        # Hold the lock so on_publish can't run before the mid is known
+        with self._outbox.lock:
+            inflight_topics = {topic for topic, _ in self._inflight.values()}
+
+            for topic, payload, client_token, _ in self._outbox.pending():
+                if len(self._inflight) >= self._max_inflight_updates:
+                    break
+
+                # One update per job in flight, so they can't overtake
+                if client_token in self._inflight or topic in inflight_topics:
+                    continue
+
+                # Without the responses the update would stay in flight forever
+                if not self._responses_subscribed(topic):
+                    continue
+
+                info = self._client_publish(topic, payload, qos=1)
+                self._inflight[client_token] = (topic, time.monotonic())
+                self._inflight_mid[info.mid] = client_token
+                inflight_topics.add(topic)
+
+    def _responses_subscribed(self, topic):
+        # The Jobs service responds on <update topic>/accepted|rejected
+        response = f"{topic}/{JOB_ACCEPTED}"
+        return any(
+            topic_matches_sub(subscription, response)
+            for subscription in list(self._subscribed)
+        )
+
+    def _replay_outbox(self):
+        with self._outbox.lock:
+            # The responses to the updates in flight might have been
+            # lost with the connection, send them again. Updates are
+            # idempotent, a repeated terminal update gets rejected.
+            self._inflight.clear()
+            self._inflight_mid.clear()
+
+            pending = len(self._outbox)
+            if pending:
+                logger.info(f"Replaying {pending} job update(s) from outbox.")
+
+            self._publish_outbox()
+
+    def _on_job_update_response(self, job_topic, payload):
+        client_token = payload.get(JOB_CLIENT_TOKEN)
+
+        with self._outbox.lock:
+            if client_token not in self._inflight:
+                return
+
+            topic, _ = self._inflight.pop(client_token)
+
+            if job_topic == JobTopic.UPDATE_REJECTED:
+                # Retrying won't help (e.g. the job has been canceled)
+                logger.warning(f"Job update rejected: {payload.get(JOB_MESSAGE)}")
+                metrics.increment(JOB_UPDATES_REJECTED)
+
+            created = self._outbox.delivered(topic, client_token)
+
+            # How far behind the cloud view of this device is
+            if created:
+                metrics.observe(JOB_UPDATE_ACK_LATENCY, time.time() - created)
+
+            self._publish_outbox()
+
+    def _on_connect_handler(self, _, __, flags, rc):
         message = connack_string(rc)
         if rc == CONNACK_ACCEPTED:
             logger.info(message)
         else:
             logger.error(message)
 
-        # (Re)subscribe to topics
-        for topic, qos in self._subscriptions.items():
-            self.subscribe(topic, qos=qos)
+        # The broker kept our subscriptions (and queued messages) if
+        # it resumed the session, otherwise they need to be renewed.
+        session_present = bool(flags and flags.get("session present"))
+        if session_present:
+            logger.info("Resumed persistent session.")
+        else:
+            self._subscribed.clear()
+
+        # (Re)subscribe to topics not acknowledged by the session,
+        # batched so a reconnect takes a single round trip.
+        topics = [
+            (topic, qos)
+            for topic, qos in list(self._subscriptions.items())
+            if topic not in self._subscribed
+        ]
+        for index in range(0, len(topics), MAX_TOPICS_PER_SUBSCRIBE):
+            self.subscribe(topics[index : index + MAX_TOPICS_PER_SUBSCRIBE])
+
+        if self._outbox is not None and rc == CONNACK_ACCEPTED:
+            if session_present:
+                # Responses to updates in flight are queued by the broker
+                self._publish_outbox()
+            else:
+                self._replay_outbox()
+
+        if rc == CONNACK_ACCEPTED:
+            self._queue.put(
+                Event(MQTT_CONNECTED, **{MQTT_EVENT_SESSION_PRESENT: session_present})
+            )
+
+    def _on_disconnect_handler(self, _, __, rc):
+        message = f"Disconnected: {error_string(rc)}"
+        if rc == MQTT_ERR_SUCCESS:
+            logger.info(message)
+        else:
+            logger.warning(message)
+
+        # Subscriptions need to be acknowledged again after reconnect,
+        # unless the broker keeps them in a persistent session.
+        if self._client._clean_session:
+            self._subscribed.clear()
+
+        # Acknowledgements are lost with the connection, pending
+        # subscriptions are renewed on connect (see on_connect).
+        self._subscription_mid.clear()
+        self._unsubscription_mid.clear()
+
+        # Notifications might be missed while offline
+        self._last_notified_jobs.clear()
+
+        self._queue.put(Event(MQTT_DISCONNECTED))
+
+    def _expire_mids(self):
+        """
+        Drop subscriptions / unsubscriptions the broker didn't acknowledge
+        in time and emit MQTT_SUBSCRIBE_TIMEOUT per topic, so a state
+        waiting for MQTT_SUBSCRIBED can retry.
+        """
+        expired = time.monotonic() - self._ack_timeout
+
+        for mid, (topics, sent) in list(self._subscription_mid.items()):
+            if sent > expired or self._subscription_mid.pop(mid, None) is None:
+                continue
+
+            metrics.increment(MQTT_SUBSCRIBE_TIMEOUTS)
+
+            for topic in topics:
+                logger.warning(f"Subscription to topic {topic} timed out.")
+
+                # Only if still wanted (not unsubscribed meanwhile)
+                if topic in self._subscriptions:
+                    self._queue.put(
+                        Event(
+                            MQTT_SUBSCRIBE_TIMEOUT,
+                            **{
+                                MQTT_EVENT_TOPIC: topic,
+                                MQTT_EVENT_QOS: self._subscriptions[topic],
+                            },
+                        )
+                    )
+
+        for mid, (topic, sent) in list(self._unsubscription_mid.items()):
+            if sent > expired or self._unsubscription_mid.pop(mid, None) is None:
+                continue
+
+            metrics.increment(MQTT_UNSUBSCRIBE_TIMEOUTS)
+            logger.warning(f"Unsubscription from topic {topic} timed out.")
 
     def _on_message_handler(self, _, __, message):
+        job_topic, job_id = None, None
+
+        # Classify the topic once here instead of every handler matching it
+        if self._topic_index:
+            job_topic, job_id = self._topic_index.classify(message.topic)
+
+        # Responses to our job updates are handled here
+        if self._outbox is not None and job_topic in JOB_UPDATE_RESPONSES:
+            payload = self._decode(message)
+            if payload is not None:
+                self._on_job_update_response(job_topic, payload)
+            return
+
+        thing_name = thing_name_from_topic(message.topic)
+
+        # Ingress filter: drop what the current state doesn't handle
+        # and jobs of other services before decoding the payload.
+        if self._routes and job_topic not in self._routes.get(thing_name, ()):
+            return self._drop(message, "not routed")
+
+        if job_id and job_id != NEXT_JOB_ID and not is_upparat_job_id(job_id):
+            return self._drop(message, "not an upparat job")
+
+        payload = self._decode(message)
+        if payload is None:
+            return
+
+        if job_topic == JobTopic.NOTIFY_NEXT:
+            execution = payload.get(EXECUTION)
+            if not execution or not is_upparat_job_id(execution[JOB_ID]):
+                return self._drop(message, "not an upparat job")
+
+        # Fold notifications to the upparat jobs, repeated ones
+        # only changed jobs of other services.
+        elif job_topic == JobTopic.NOTIFY:
+            payload = filter_upparat_notification(payload)
+            if payload[JOBS] == self._last_notified_jobs.get(thing_name):
+                return self._drop(message, "no upparat job changed")
+            self._last_notified_jobs[thing_name] = payload[JOBS]
+
         self._queue.put(
             Event(
                 MQTT_MESSAGE_RECEIVED,
                 **{
                     MQTT_EVENT_TOPIC: message.topic,
-                    MQTT_EVENT_PAYLOAD: message.payload,
+                    MQTT_EVENT_PAYLOAD: payload,
+                    MQTT_EVENT_JOB_TOPIC: job_topic,
+                    MQTT_EVENT_JOB_ID: job_id,
                 },
             )
         )
 
-    def _on_subscribe_handler(self, _, __, mid, ___):
+    @staticmethod
+    def _decode(message):
+        # Decode once here on Paho's thread, all job topics carry JSON
+        try:
+            return loads(message.payload)
+        except ValueError:
+            logger.warning(f"Dropping message on {message.topic}: Invalid JSON.")
+
+    @staticmethod
+    def _drop(message, reason):
+        logger.debug(f"Dropping message on {message.topic}: {reason}.")
+        metrics.increment(MQTT_MESSAGES_DROPPED)
+
+    def _on_subscribe_handler(self, _, __, mid, granted_qos):
         # (B) see comment (A) in subscribe():
-        # we want to know the mid → topic mapping here
-        # since we want to publish an event with the topic
+        # we want to know the mid → topics mapping here
+        # since we want to publish an event per topic
         # that has been subscribed to.
-        if mid in self._subscription_mid:
-            self._queue.put(
-                Event(
-                    MQTT_SUBSCRIBED,
-                    **{MQTT_EVENT_TOPIC: self._subscription_mid.pop(mid)},
-                )
-            )
-        else:
+        if mid not in self._subscription_mid:
             logger.error(f"No topic mapping found for subscription {mid}")
+            return
+
+        topics, _ = self._subscription_mid.pop(mid)
+
+        # The SUBACK has a return code per topic, in order
+        for index, topic in enumerate(topics):
+            if granted_qos and granted_qos[index] == SUBACK_FAILURE:
+                logger.warning(f"Subscription to topic {topic} refused.")
+                continue
+
+            self._subscribed.add(topic)
+            self._queue.put(Event(MQTT_SUBSCRIBED, **{MQTT_EVENT_TOPIC: topic}))
+
+            if self._outbox is not None and topic_matches_sub(
+                self._outbox.response_filter, topic
+            ):
+                self._publish_outbox()
+
+    def _on_publish_handler(self, _, __, mid):
+        if self._outbox is None:
+            return
+
+        # The broker has the update (PUBACK),
+        # wait for the Jobs response to remove it.
+        with self._outbox.lock:
+            client_token = self._inflight_mid.pop(mid, None)
+
+            if client_token in self._inflight:
+                _, sent = self._inflight[client_token]
+                metrics.observe(JOB_UPDATE_PUBACK_LATENCY, time.monotonic() - sent)
 
     def _on_unsubscribe_handler(self, _, __, mid):
         # See comment (B), same applies here.
         if mid in self._unsubscription_mid:
-            topic = self._unsubscription_mid.pop(mid)
+            topic, _ = self._unsubscription_mid.pop(mid)
             self._queue.put(Event(MQTT_UNSUBSCRIBED, **{MQTT_EVENT_TOPIC: topic}))
         else:
             logger.error(f"No topic mapping found for unsubscription {mid}")
@@ -158,18 +522,18 @@ class MQTT(Client):
         command = SUBSCRIBE | (dup << 3) | 0x2
         packet = bytearray()
         packet.append(command)
-        self._pack_remaining_length(packet, remaining_length)
+        self._client._pack_remaining_length(packet, remaining_length)
         if not mid:
-            mid = self._mid_generate()
+            mid = self._client._mid_generate()
         packet.extend(struct.pack("!H", mid))
         for t, q in topics:
-            self._pack_str16(packet, t)
+            self._client._pack_str16(packet, t)
             packet.append(q)
 
-        self._easy_log(
+        self._client._easy_log(
             MQTT_LOG_DEBUG, "Sending SUBSCRIBE (d%d, m%d) %s", dup, mid, topics
         )
-        return self._packet_queue(command, packet, mid, 1), mid
+        return self._client._packet_queue(command, packet, mid, 1), mid
 
     def _subscribe(self, topic, qos=0, mid=None):
         """ See Paho's _subscribe, allow for passing a mid. """
@@ -197,12 +561,12 @@ class MQTT(Client):
             raise ValueError("No topic specified, or incorrect topic type.")
 
         if any(
-            self._filter_wildcard_len_check(topic) != MQTT_ERR_SUCCESS
+            self._client._filter_wildcard_len_check(topic) != MQTT_ERR_SUCCESS
             for topic, _ in topic_qos_list
         ):
             raise ValueError("Invalid subscription filter.")
 
-        if self._sock is None:
+        if self._client._sock is None:
             return MQTT_ERR_NO_CONN, None
 
         return self._send_subscribe(False, topic_qos_list, mid)
@@ -216,17 +580,17 @@ class MQTT(Client):
         command = UNSUBSCRIBE | (dup << 3) | 0x2
         packet = bytearray()
         packet.append(command)
-        self._pack_remaining_length(packet, remaining_length)
+        self._client._pack_remaining_length(packet, remaining_length)
         if not mid:
-            mid = self._mid_generate()
+            mid = self._client._mid_generate()
         packet.extend(struct.pack("!H", mid))
         for t in topics:
-            self._pack_str16(packet, t)
+            self._client._pack_str16(packet, t)
 
-        self._easy_log(
+        self._client._easy_log(
             MQTT_LOG_DEBUG, "Sending UNSUBSCRIBE (d%d, m%d) %s", dup, mid, topics
         )
-        return self._packet_queue(command, packet, mid, 1), mid
+        return self._client._packet_queue(command, packet, mid, 1), mid
 
     def _unsubscribe(self, topic, mid=None):
         """ See Paho's _unsubscribe, allow for passing a mid. """
@@ -247,7 +611,148 @@ class MQTT(Client):
         if topic_list is None:
             raise ValueError("No topic specified, or incorrect topic type.")
 
-        if self._sock is None:
+        if self._client._sock is None:
             return MQTT_ERR_NO_CONN, None
 
         return self._send_unsubscribe(False, topic_list, mid)
+
+
+class MQTT(ClientAdapter, Client):
+    """ Upparat's own connection, kept up by Paho's network thread. """
+
+    def __init__(
+        self,
+        client_id,
+        queue,
+        clean_session=True,
+        topic_index=None,
+        outbox=None,
+        max_inflight_updates=MAX_INFLIGHT_UPDATES,
+        ack_timeout=ACK_TIMEOUT,
+        endpoints=None,
+        health=None,
+    ):
+        ClientAdapter.__init__(
+            self, self, queue, topic_index, outbox, max_inflight_updates, ack_timeout
+        )
+        Client.__init__(self, client_id, clean_session=clean_session)
+
+        # Brokers to fail over between, see upparat.endpoints
+        self._endpoints = endpoints
+        # Adaptive keepalive, see upparat.health
+        self._health = health
+
+        self.on_connect = self._on_connect_handler
+        self.on_disconnect = self._on_disconnect_handler
+        self.on_message = self._on_message_handler
+        self.on_subscribe = self._on_subscribe_handler
+        self.on_unsubscribe = self._on_unsubscribe_handler
+        self.on_publish = self._on_publish_handler
+
+    def run(self, host, port):
+        self.enable_logger()
+        logger.debug(f"Connect to {host}:{port}")
+        self.connect_async(host, port)
+        self.loop_start()
+
+    def set_job_active(self, thing_name, active):
+        if self._health is not None:
+            self._health.set_job_active(thing_name, active)
+
+    def reconnect(self):
+        if self._health is not None:
+            # The broker's deadline, pings get more frequent after CONNACK
+            self._keepalive = self._health.keepalive_max
+            self._health.reset()
+
+        if self._endpoints is not None:
+            endpoint = self._endpoints.select()
+            self._host, self._port = endpoint.host, endpoint.port
+            self._ssl_context = self._endpoints.ssl_contexts.get(endpoint.name)
+            self._ssl = self._ssl_context is not None
+
+        try:
+            return super().reconnect()
+        except OSError:
+            if self._endpoints is not None:
+                self._endpoints.failed()
+            raise
+
+    def _on_connect_handler(self, client, userdata, flags, rc):
+        if self._endpoints is not None:
+            if rc == CONNACK_ACCEPTED:
+                self._endpoints.connected()
+            else:
+                self._endpoints.failed()
+
+        super()._on_connect_handler(client, userdata, flags, rc)
+
+    def _client_publish(self, *args, **kwargs):
+        # Paho's publish, the one after ClientAdapter's in the MRO
+        return super(ClientAdapter, self).publish(*args, **kwargs)
+
+    def _next_reconnect_delay(self):
+        """
+        Exponential backoff with full jitter: a random time up to the
+        backoff, so a fleet disconnected at the same time doesn't
+        reconnect in lockstep. Paho resets the backoff on CONNACK.
+        """
+        with self._reconnect_delay_mutex:
+            if self._reconnect_delay is None:
+                self._reconnect_delay = self._reconnect_min_delay
+            else:
+                self._reconnect_delay = min(
+                    self._reconnect_delay * 2, self._reconnect_max_delay
+                )
+
+            delay = random.uniform(0, self._reconnect_delay)
+
+        logger.info(f"Reconnect in {delay:.1f}s.")
+        return delay
+
+    def _reconnect_wait(self):
+        """ See Paho's _reconnect_wait, using _next_reconnect_delay. """
+        delay = self._next_reconnect_delay()
+
+        # Sleep in steps to notice a disconnect() meanwhile
+        target_time = time.monotonic() + delay
+        remaining = delay
+        while remaining > 0:
+            if self._state == mqtt_cs_disconnecting or self._thread_terminate:
+                break
+            time.sleep(min(remaining, 1))
+            remaining = target_time - time.monotonic()
+
+    def loop_misc(self):
+        # Called by Paho's network loop about once a second
+        self._expire_mids()
+
+        if self._health is not None and self._sock is not None:
+            if self._health.degraded:
+                return self._reconnect_degraded()
+
+            if self._state == mqtt_cs_connected:
+                self._keepalive = self._health.keepalive
+
+        return super().loop_misc()
+
+    def _handle_pingresp(self):
+        sent = self._ping_t
+        rc = super()._handle_pingresp()
+
+        if self._health is not None and rc == MQTT_ERR_SUCCESS and sent:
+            self._health.ping(time.monotonic() - sent)
+
+        return rc
+
+    def _reconnect_degraded(self):
+        """ See Paho's loop_misc on a missing PINGRESP. """
+        logger.warning("Round trips to the broker degraded, reconnecting.")
+        metrics.increment(MQTT_DEGRADED_RECONNECTS)
+
+        if self._endpoints is not None:
+            self._endpoints.failed()
+
+        self._sock_close()
+        self._do_on_disconnect(MQTT_ERR_KEEPALIVE)
+        return MQTT_ERR_CONN_LOST
@@ -0,0 +1,85 @@
+import sqlite3
+import threading
+import time
+
+from paho.mqtt.client import topic_matches_sub
+
+OUTBOX_FILE = "outbox.sqlite"
+
+
+class Outbox:
+    """
+    Persistent outbox for messages published to topics matching
+    topic_filter (the job execution updates), which are acknowledged
+    by a message to response_filter.
+
+    A message is kept until it has been acknowledged and replayed after
+    a reconnect or restart otherwise. Only the last message per topic
+    is kept, so after a long outage every job needs one message.
+    """
+
+    def __init__(self, path, topic_filter, response_filter):
+        self.topic_filter = topic_filter
+        self.response_filter = response_filter
+
+        # Guards the outbox and the in-flight bookkeeping of
+        # the client, re-entrant since Paho might call back.
+        self.lock = threading.RLock()
+
+        # Accessed from our and Paho's thread (guarded by lock)
+        self._db = sqlite3.connect(
+            str(path), check_same_thread=False, isolation_level=None
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "topic TEXT PRIMARY KEY, payload, client_token TEXT, "
+            "created REAL, seq INTEGER)"
+        )
+
+        (self._seq,) = self._db.execute(
+            "SELECT COALESCE(MAX(seq), 0) FROM messages"
+        ).fetchone()
+
+    def accepts(self, topic):
+        return topic_matches_sub(self.topic_filter, topic)
+
+    def put(self, topic, payload, client_token):
+        """
+        Store the message, replacing any pending message to topic. A replaced
+        message keeps its creation time: the receiver is behind since then.
+        """
+        with self.lock:
+            self._seq += 1
+            self._db.execute(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, "
+                "COALESCE((SELECT created FROM messages WHERE topic = ?), ?), ?)",
+                (topic, payload, client_token, topic, time.time(), self._seq),
+            )
+
+    def delivered(self, topic, client_token):
+        """
+        Remove the message unless it got replaced meanwhile.
+        :returns: creation time of the removed message or None
+        """
+        with self.lock:
+            row = self._db.execute(
+                "SELECT created FROM messages WHERE topic = ? AND client_token = ?",
+                (topic, client_token),
+            ).fetchone()
+
+            if row:
+                self._db.execute("DELETE FROM messages WHERE topic = ?", (topic,))
+                return row[0]
+
+    def pending(self):
+        """ Pending messages (topic, payload, client_token, created), oldest first. """
+        with self.lock:
+            return self._db.execute(
+                "SELECT topic, payload, client_token, created "
+                "FROM messages ORDER BY seq"
+            ).fetchall()
+
+    def __len__(self):
+        with self.lock:
+            (count,) = self._db.execute("SELECT COUNT(*) FROM messages").fetchone()
+            return count
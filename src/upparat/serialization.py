@@ -0,0 +1,20 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def loads(data):
+    """ Decode JSON from str or bytes, using orjson if installed. """
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj):
+    """ Encode obj as JSON str, using orjson if installed. """
+    if orjson:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj)
@@ -1,45 +1,245 @@
-import json
 import logging
 import sys
+import weakref
 
-from paho.mqtt.client import topic_matches_sub
+from pysm import Event
 from pysm import State
 from pysm import StateMachine
+from pysm.pysm import any_event
+from pysm.pysm import StateMachineException
 
 from upparat.config import NAME
 from upparat.config import settings
+from upparat.events import DEADLINE_EXPIRED
+from upparat.events import DEADLINE_RETRIES
+from upparat.events import DEADLINE_SECONDS
 from upparat.events import ENTER
 from upparat.events import EXIT
 from upparat.events import EXIT_SIGNAL_SENT
 from upparat.events import JOB
+from upparat.events import MQTT_CONNECTED
+from upparat.events import MQTT_DISCONNECTED
+from upparat.events import MQTT_EVENT_JOB_TOPIC
 from upparat.events import MQTT_EVENT_PAYLOAD
+from upparat.events import MQTT_EVENT_QOS
+from upparat.events import MQTT_EVENT_SESSION_PRESENT
 from upparat.events import MQTT_EVENT_TOPIC
 from upparat.events import MQTT_MESSAGE_RECEIVED
-from upparat.jobs import get_in_progress_job_ids
+from upparat.events import MQTT_SUBSCRIBE_TIMEOUT
+from upparat.events import THING_NAME
+from upparat.jobs import get_pending_job_execution_ids
+from upparat.jobs import get_pending_job_executions
+from upparat.jobs import get_pending_job_ids
 from upparat.jobs import job_update
 from upparat.jobs import JobStatus
-from upparat.jobs import pending_jobs_response
+from upparat.jobs import JobTopic
+from upparat.metrics import metrics
+from upparat.metrics import STATE_DEADLINES_EXPIRED
 from upparat.mqtt import MQTT
 
 logger = logging.getLogger(__name__)
 
+# Deadlines double with every retry up to this factor
+DEADLINE_MAX_BACKOFF = 8
+
 
 class UpparatStateMachine(StateMachine):
-    def __init__(self, inbox, mqtt_client):
+    # State machines of the process, one per thing in gateway mode
+    instances = weakref.WeakSet()
+
+    def __init__(self, inbox, mqtt_client, thing_name=None, journal=None):
         self.inbox = inbox
         self.mqtt_client = mqtt_client
+        self.thing_name = thing_name or settings.broker.thing_name
+        # Job in processing across restarts, see upparat.journal
+        self.journal = journal
+        # Offline once disconnected until reconnected
+        self.online = True
+        # Supersedes the queued jobs of its version or older (supersede_jobs),
+        # see SelectJobState.select_newest
+        self.succeeded_job = None
+        # Transition and handler tables, see compile()
+        self._table = None
+        self._handlers = None
+
+        # e.g. a plain Queue of an embedding application
+        if not hasattr(inbox, "schedule"):
+            logger.warning("Inbox without timers, states won't time out.")
+
         super().__init__(NAME)
+        UpparatStateMachine.instances.add(self)
+
+    @classmethod
+    def jobs_in_processing(cls):
+        """ Jobs currently processed by the state machines of the process. """
+        jobs = []
+        for machine in list(cls.instances):
+            state = machine.leaf_state
+            if isinstance(state, JobProcessingState) and state.job:
+                jobs.append(state.job)
+        return jobs
+
+    def add_state(self, state, initial=False):
+        super().add_state(state, initial)
+        self._table = None
+
+    def add_transition(self, *args, **kwargs):
+        super().add_transition(*args, **kwargs)
+        self._table = None
+
+    def compile(self):
+        """
+        Transition table of the state machine: (state, event, input) →
+        transitions in the order pysm tries them, the ones for any event
+        last. Handler table: (state, event) → the state's handler or the
+        machine's one it would propagate to. Only flat state machines (no
+        nested ones), as ours.
+        """
+        transitions = self._transitions._transitions
+        table = {}
+        handlers = {}
 
-    def dispatch(self, event):
-        state_before = self.state
-        super().dispatch(event)
-        state_after = self.state
+        for state in self.states:
+            if isinstance(state, StateMachine):
+                raise StateMachineException(
+                    f"Nested state machine {state.name} is not supported."
+                )
+            # See BaseState.root_machine
+            state._root_machine = self
+
+            # Enter / exit events are never propagated, see pysm's State._on
+            for name, handler in self.handlers.items():
+                if name not in (ENTER, EXIT):
+                    handlers[(state, name)] = (self, handler)
+            for name, handler in state.handlers.items():
+                handlers[(state, name)] = (state, handler)
+
+        for (state, event, input_), candidates in list(transitions.items()):
+            if event is not any_event:
+                table[(state, event, input_)] = list(candidates) + list(
+                    transitions.get((state, any_event, input_), ())
+                )
+
+        for (state, event, input_), candidates in list(transitions.items()):
+            if event is any_event:
+                table[(state, event, input_)] = list(candidates)
+
+        self._initial = self.initial_state
+        self._handlers = handlers
+        self._table = table
+
+    def register_handlers(self):
+        # Reached if the current state doesn't handle the event itself
+        self.handlers = {MQTT_SUBSCRIBE_TIMEOUT: self._on_subscribe_timeout}
+
+    def _on_subscribe_timeout(self, state, event):
+        # States waiting for MQTT_SUBSCRIBED get it once acknowledged
+        self.mqtt_client.subscribe(
+            event.cargo[MQTT_EVENT_TOPIC], qos=event.cargo[MQTT_EVENT_QOS]
+        )
+
+    def initialize(self, *args, **kwargs):
+        super().initialize(*args, **kwargs)
+        self._route(self.leaf_state)
+
+    def _enter_states(self, event, top_state, to_state):
+        # Route before entering: on_enter might publish a request
+        # and the response must not be dropped on ingress.
+        if to_state is not None:
+            self._route(self._get_leaf_state(to_state))
+
+        super()._enter_states(event, top_state, to_state)
 
-        if state_after != state_before:
-            logger.info(
-                f"State changed from {state_before.name} to {state_after.name}."
+    def _route(self, state):
+        self.mqtt_client.set_routes(state.job_topics, self.thing_name)
+        # Notice a dead connection sooner while processing a job
+        self.mqtt_client.set_job_active(
+            self.thing_name, isinstance(state, JobProcessingState)
+        )
+
+    def dispatch(self, event):
+        """
+        pysm's StateMachine.dispatch on the transition table (compile()):
+        same handlers, transitions and enter / exit events, without
+        walking the hierarchy for every event.
+        """
+        if event.name == MQTT_DISCONNECTED:
+            self.online = False
+        elif event.name == MQTT_CONNECTED:
+            self.online = True
+
+        if self._table is None:
+            self.compile()
+
+        state = self._leaf_state
+        if state is None:
+            raise StateMachineException(
+                f'StateMachine "{self.name}" must be initialized before dispatch'
             )
 
+        # Handled by the state, otherwise propagated to the machine
+        event.state_machine = self
+        self._handle(state, event)
+
+        transition = self._find_transition(state, event)
+        if transition is None:
+            return
+
+        to_state = transition["to_state"]
+
+        transition["before"](state, event)
+        if to_state is not None:
+            self._exit_state(state, event)
+        transition["action"](state, event)
+        if to_state is not None:
+            self._enter_state(to_state, event)
+        transition["after"](self._leaf_state, event)
+
+        if to_state is not None and to_state is not state:
+            logger.info(f"State changed from {state.name} to {to_state.name}.")
+
+    def _handle(self, state, event):
+        """ pysm's State._on, looked up in the handler table. """
+        handler = self._handlers.get((state, event.name))
+        if handler is not None:
+            event.propagate = False
+            owner, handler = handler
+            handler(owner, event)
+
+    def _find_transition(self, state, event):
+        transitions = self._table.get((state, event.name, event.input))
+        if transitions is None:
+            transitions = self._table.get((state, any_event, event.input), ())
+
+        for transition in transitions:
+            if transition["condition"](state, event) is True:
+                return transition
+
+        return None
+
+    def _exit_state(self, state, event):
+        """ See pysm's _exit_states, the leaf state is our only level. """
+        self.leaf_state_stack.push(state)
+
+        exit_event = Event(EXIT, propagate=False, source_event=event)
+        exit_event.state_machine = self
+        self._handle(state, exit_event)
+        state.cancel_timers()
+
+        self.state_stack.push(state)
+        self.state = self._initial
+
+    def _enter_state(self, state, event):
+        """ See _enter_states, flat as _exit_state. """
+        self._route(state)
+
+        enter_event = Event(ENTER, propagate=False, source_event=event)
+        enter_event.state_machine = self
+        self._leaf_state = state
+        self._handle(state, enter_event)
+
+        self.state = state
+
     def print_uml(self):
         """
         todo: Extract to a dev/test only function. No need to be included in production.
@@ -72,6 +272,14 @@ class UpparatStateMachine(StateMachine):
 
 
 class BaseState(State):
+    # Job topics handled, messages to others are dropped on ingress
+    job_topics = frozenset()
+    # Set once compiled into a state machine, see UpparatStateMachine.compile
+    _root_machine = None
+    # Timers scheduled while active, cancelled on exit
+    _timers = ()
+    _deadline = None
+
     def __init__(self):
         super().__init__(self.name)
 
@@ -86,11 +294,15 @@ class BaseState(State):
         self.mqtt_client.disconnect()
         sys.exit()
 
+    def on_deadline(self, state, event):
+        """ Ask the broker again, see set_deadline. """
+
     def register_handlers(self):
         self.handlers = {
             ENTER: self.on_enter,
             EXIT: self.on_exit,
             EXIT_SIGNAL_SENT: self.on_exit_signal,
+            DEADLINE_EXPIRED: self._on_deadline_expired,
         }
 
         self.handlers.update(self.event_handlers())
@@ -106,6 +318,9 @@ class BaseState(State):
         :rtype: |StateMachine|
 
         """
+        if self._root_machine is not None:
+            return self._root_machine
+
         machine = self
         while machine.parent:
             machine = machine.parent
@@ -115,38 +330,127 @@ class BaseState(State):
     def mqtt_client(self) -> MQTT:
         return self.root_machine.mqtt_client
 
+    @property
+    def thing_name(self):
+        return self.root_machine.thing_name
+
     def publish(self, event):
+        # Routes the event back to this state machine in gateway mode
+        event.cargo[THING_NAME] = self.thing_name
         self.root_machine.inbox.put(event)
 
+    def schedule(self, delay, event, interval=None):
+        """
+        Publish event in delay seconds (and every interval seconds after)
+        unless the state is left before, see upparat.timers. None if the
+        inbox has no timers.
+        """
+        inbox = self.root_machine.inbox
+        if not hasattr(inbox, "schedule"):
+            return None
+
+        event.cargo[THING_NAME] = self.thing_name
+        timer = inbox.schedule(delay, event, interval)
+        self._timers = [t for t in self._timers if t.active] + [timer]
+        return timer
+
+    def cancel_timers(self):
+        for timer in self._timers:
+            timer.cancel()
+        self._timers = ()
+
+    def set_deadline(self, seconds, retries=0):
+        """
+        Call on_deadline() unless the state is left within seconds (doubled
+        for every retry), e.g. to recover from a lost broker response.
+        """
+        self.clear_deadline()
+
+        if not seconds:
+            return
+
+        delay = seconds * min(2 ** retries, DEADLINE_MAX_BACKOFF)
+        self._deadline = self.schedule(
+            delay,
+            Event(
+                DEADLINE_EXPIRED,
+                **{DEADLINE_SECONDS: seconds, DEADLINE_RETRIES: retries},
+            ),
+        )
+
+    def clear_deadline(self):
+        if self._deadline is not None:
+            self._deadline.cancel()
+            self._deadline = None
+
+    def _on_deadline_expired(self, state, event):
+        seconds = event.cargo[DEADLINE_SECONDS]
+        retries = event.cargo[DEADLINE_RETRIES]
+
+        # Offline, not a slow broker: wait for the reconnect
+        if not self.root_machine.online:
+            return self.set_deadline(seconds, retries)
+
+        metrics.increment(STATE_DEADLINES_EXPIRED.format(self.name))
+        logger.warning(f"No response in {self.name} within the deadline, retrying.")
+
+        self.set_deadline(seconds, retries + 1)
+        self.on_deadline(state, event)
+
 
 class JobProcessingState(BaseState):
     job = None
-    pending_jobs_response = None
+
+    # Cancel detection and reconciliation, see _handle_job_cancel
+    job_topics = frozenset({JobTopic.NOTIFY, JobTopic.GET_ACCEPTED})
 
     def job_succeeded(self, state, message=None):
         job_update(
             self.mqtt_client,
-            settings.broker.thing_name,
+            self.thing_name,
             self.job.id_,
             JobStatus.SUCCEEDED.value,
             state,
             message,
         )
 
+        # Also after a restart: the queued jobs are compared on the next selection
+        if settings.service.supersede_jobs:
+            self.root_machine.succeeded_job = self.job
+
+        self._job_done()
+
     def job_failed(self, state, message=None):
         job_update(
             self.mqtt_client,
-            settings.broker.thing_name,
+            self.thing_name,
             self.job.id_,
             JobStatus.FAILED.value,
             state,
             message,
         )
+        self._job_done()
+
+    def _job_done(self):
+        # The update itself is kept in the outbox until acknowledged
+        journal = self.root_machine.journal
+        if journal is not None:
+            journal.clear(self.thing_name, self.job.id_)
 
     def job_progress(self, state, message=None):
+        # Resumed from here after a restart, even if offline now
+        journal = self.root_machine.journal
+        if journal is not None:
+            journal.record(self.thing_name, self.job, state)
+
+        # Progress is outdated by the time we're back online
+        if not self.root_machine.online:
+            logger.debug(f"Offline, skipping progress update {state}.")
+            return
+
         job_update(
             self.mqtt_client,
-            settings.broker.thing_name,
+            self.thing_name,
             self.job.id_,
             JobStatus.IN_PROGRESS.value,
             state,
@@ -155,31 +459,39 @@ class JobProcessingState(BaseState):
 
     def _setup_job_processing(self, state, event):
         self.job = event.cargo["source_event"].cargo[JOB]
-
-        # Watch for job updates → canceled
-        self.pending_jobs_response = pending_jobs_response(settings.broker.thing_name)
-        self.mqtt_client.subscribe(self.pending_jobs_response, qos=1)
-
         self.on_enter(state, event)
 
     def _cleanup_job_processing(self, state, event):
-        self.mqtt_client.unsubscribe(self.pending_jobs_response)
         self.on_exit(state, event)
 
-    def _handle_job_cancel(self, state, event, mqtt_message_handler=None):
-        topic = event.cargo[MQTT_EVENT_TOPIC]
+    def _reconcile_job(self, state, event):
+        # A resumed session delivers the notifications sent while offline
+        if event.cargo.get(MQTT_EVENT_SESSION_PRESENT):
+            return
+
+        # Notifications might have been missed while offline,
+        # check once if the job is still pending, see below.
+        self.mqtt_client.publish(get_pending_job_executions(self.thing_name), qos=1)
 
-        # if our job is not in progress anymore it has been
-        # canceled / deleted and we should stop now.
-        if topic_matches_sub(self.pending_jobs_response, topic):
-            payload = json.loads(event.cargo[MQTT_EVENT_PAYLOAD])
+    def _handle_job_cancel(self, state, event):
+        job_topic = event.cargo.get(MQTT_EVENT_JOB_TOPIC)
+        payload = event.cargo.get(MQTT_EVENT_PAYLOAD)
 
-            if self.job.id_ not in get_in_progress_job_ids(payload):
-                logger.info(f"Job {self.job.id_} got canceled.")
-                return self.on_job_cancelled(state, event)
+        pending_job_ids = None
+        if job_topic == JobTopic.NOTIFY:
+            pending_job_ids = get_pending_job_ids(payload)
+        elif job_topic == JobTopic.GET_ACCEPTED:
+            pending_job_ids = get_pending_job_execution_ids(payload)
 
-        if mqtt_message_handler:
-            mqtt_message_handler(state, event)
+        # if our job is neither in progress nor queued anymore it
+        # has been canceled / deleted and we should stop now.
+        if pending_job_ids is not None and self.job.id_ not in pending_job_ids:
+            logger.info(f"Job {self.job.id_} got canceled.")
+            self._job_done()
+            return self.on_job_cancelled(state, event)
+
+        if self._mqtt_message_handler:
+            self._mqtt_message_handler(state, event)
 
     def on_job_cancelled(self, state, event):
         pass
@@ -189,19 +501,14 @@ class JobProcessingState(BaseState):
             ENTER: self._setup_job_processing,
             EXIT: self._cleanup_job_processing,
             EXIT_SIGNAL_SENT: self.on_exit_signal,
+            DEADLINE_EXPIRED: self._on_deadline_expired,
             MQTT_MESSAGE_RECEIVED: self._handle_job_cancel,
+            MQTT_CONNECTED: self._reconcile_job,
         }
 
         event_handlers = self.event_handlers()
 
-        # Wrap the original MQTT_MESSAGE_RECEIVED handler
-        if MQTT_MESSAGE_RECEIVED in event_handlers:
-
-            def _wrapper(state, event):
-                return self._handle_job_cancel(
-                    state, event, event_handlers[MQTT_MESSAGE_RECEIVED]
-                )
-
-            event_handlers[MQTT_MESSAGE_RECEIVED] = _wrapper
+        # Called by _handle_job_cancel unless the job got canceled
+        self._mqtt_message_handler = event_handlers.pop(MQTT_MESSAGE_RECEIVED, None)
 
         self.handlers.update(event_handlers)
@@ -1,6 +1,6 @@
 import functools
-import json
 import logging
+import multiprocessing
 import os
 import socket
 import threading
@@ -12,6 +12,8 @@ from urllib.error import URLError
 import backoff
 import pysm
 
+from upparat.config import DOWNLOAD_WORKER_PROCESS
+from upparat.config import LOG_FORMAT
 from upparat.config import settings
 from upparat.events import DOWNLOAD_COMPLETED
 from upparat.events import DOWNLOAD_INTERRUPTED
@@ -26,7 +28,9 @@ from upparat.events import JOB
 from upparat.hooks import run_hook
 from upparat.jobs import JobFailedStatus
 from upparat.jobs import JobProgressStatus
+from upparat.serialization import dumps
 from upparat.statemachine import JobProcessingState
+from upparat.statemachine import UpparatStateMachine
 
 logger = logging.getLogger(__name__)
 
@@ -34,6 +38,10 @@ READ_CHUNK_SIZE_BYTES = 1024 * 100  # 100 kib
 REQUEST_TIMEOUT_SEC = 30
 BACKOFF_EXPO_MAX_SEC = 2 ** 6  # 64
 
+# Messages sent from the download process to the parent
+WORKER_EVENT = "event"
+WORKER_PROGRESS = "progress"
+
 RETRYABLE_EXCEPTIONS = (
     URLError,
     HTTPError,
@@ -48,15 +56,19 @@ RETRYABLE_EXCEPTIONS = (
     RETRYABLE_EXCEPTIONS,
     jitter=backoff.full_jitter,
 )
-def download(job, stop_download, publish, update_job_progress):
+def download(job, stop_download, publish, update_job_progress, filepath=None):
     """
     See https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
     for more information regarding the backoff behaviour (i.e. jitter).
+
+    filepath defaults to the job's, a download process passes it since
+    it doesn't load the settings.
     """
+    filepath = filepath or job.filepath
     start_position_bytes = 0
 
-    if os.path.exists(job.filepath):
-        start_position_bytes = os.path.getsize(job.filepath)
+    if os.path.exists(filepath):
+        start_position_bytes = os.path.getsize(filepath)
         logger.info(f"Partial download of {start_position_bytes} bytes found.")
 
     if stop_download.is_set():
@@ -65,12 +77,12 @@ def download(job, stop_download, publish, update_job_progress):
     request = urllib.request.Request(job.file_url)
     request.add_header("Range", f"bytes={start_position_bytes}-")
 
-    logger.info(f"Downloading job to {job.filepath}.")
+    logger.info(f"Downloading job to {filepath}.")
 
     try:
         with urllib.request.urlopen(
             request, timeout=REQUEST_TIMEOUT_SEC
-        ) as source, open(job.filepath, "ab") as destination:
+        ) as source, open(filepath, "ab") as destination:
 
             done = False
 
@@ -89,14 +101,14 @@ def download(job, stop_download, publish, update_job_progress):
 
                     update_job_progress(
                         JobProgressStatus.DOWNLOAD_PROGRESS.value,
-                        message=json.dumps({"downloaded_bytes": downloaded_bytes}),
+                        message=dumps({"downloaded_bytes": downloaded_bytes}),
                     )
                 else:
                     done = True
 
         if stop_download.is_set():
-            logger.info(f"Download stopped. Removing {job.filepath}.")
-            os.remove(job.filepath)
+            logger.info(f"Download stopped. Removing {filepath}.")
+            os.remove(filepath)
 
         if done:
             logger.info(f"Download completed.")
@@ -126,6 +138,283 @@ def download(job, stop_download, publish, update_job_progress):
             raise exception
 
 
+def download_worker(job, filepath, stop_download, connection, log_level):
+    """
+    Entry point of the download process. Events and progress
+    updates are sent back to the parent over the given pipe.
+    """
+    # A fresh interpreter, see start_worker_process
+    logging.basicConfig(format=LOG_FORMAT, level=log_level)
+
+    def publish(event):
+        connection.send((WORKER_EVENT, event))
+
+    def update_job_progress(state, message=None):
+        connection.send((WORKER_PROGRESS, state, message))
+
+    try:
+        download(job, stop_download, publish, update_job_progress, filepath=filepath)
+    finally:
+        connection.close()
+
+
+def forward_worker_messages(connection, publish, update_job_progress, process=None):
+    """
+    Forward messages from the download process until it closes the pipe,
+    then reap the process.
+    """
+    try:
+        while True:
+            try:
+                message = connection.recv()
+            except EOFError:
+                break
+
+            kind, *args = message
+
+            if kind == WORKER_EVENT:
+                publish(*args)
+            elif kind == WORKER_PROGRESS:
+                update_job_progress(*args)
+    finally:
+        connection.close()
+
+        if process is not None:
+            process.join()
+
+
+def start_worker_thread(job, shared_download):
+    shared_download.stop_download = threading.Event()
+
+    threading.Thread(
+        daemon=True,
+        target=download,
+        kwargs={
+            "job": job,
+            "stop_download": shared_download.stop_download,
+            "publish": shared_download.publish,
+            "update_job_progress": shared_download.update_job_progress,
+        },
+    ).start()
+
+
+def start_worker_process(job, shared_download):
+    # Spawn a fresh interpreter: forking copies the locks (logging,
+    # SSL) held by Paho's and the hooks' threads. The child doesn't
+    # load the settings, it gets what it needs.
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+
+    shared_download.stop_download = context.Event()
+
+    process = context.Process(
+        daemon=True,
+        target=download_worker,
+        kwargs={
+            "job": job,
+            "filepath": job.filepath,
+            "stop_download": shared_download.stop_download,
+            "connection": sender,
+            "log_level": logging.getLogger().level,
+        },
+    )
+    process.start()
+
+    # Only the child writes to the pipe, closing our end
+    # makes sure the reader sees EOF once the child is gone.
+    sender.close()
+
+    threading.Thread(
+        daemon=True,
+        target=forward_worker_messages,
+        kwargs={
+            "connection": receiver,
+            "publish": shared_download.publish,
+            "update_job_progress": shared_download.update_job_progress,
+            "process": process,
+        },
+    ).start()
+
+
+def worker_starter(job):
+    """ Starts the configured download worker of job, see SharedDownload.join. """
+    if settings.service.download_worker == DOWNLOAD_WORKER_PROCESS:
+        return functools.partial(start_worker_process, job)
+
+    return functools.partial(start_worker_thread, job)
+
+
+class SharedDownload:
+    """
+    Download of a job artifact, shared by the download states of the
+    things processing the same job (gateway mode). The worker's events
+    and progress updates are forwarded to every state which joined,
+    the download stops once the last one left.
+    """
+
+    # file path → download in progress
+    downloads = {}
+    lock = threading.Lock()
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.stop_download = None
+        self.states = []
+
+    @classmethod
+    def join(cls, state, start_worker):
+        """ Join the download of the state's job, start_worker(download) if none. """
+        with cls.lock:
+            shared_download = cls.downloads.get(state.job.filepath)
+
+            if shared_download is None:
+                shared_download = cls(state.job.filepath)
+                cls.downloads[shared_download.filepath] = shared_download
+                start_worker(shared_download)
+            else:
+                logger.info(f"Joining download of {shared_download.filepath}.")
+
+            shared_download.states.append(state)
+
+        return shared_download
+
+    def leave(self, state):
+        with self.lock:
+            if state in self.states:
+                self.states.remove(state)
+
+            if not self.states and self.downloads.get(self.filepath) is self:
+                del self.downloads[self.filepath]
+                self.stop_download.set()
+
+    def publish(self, event):
+        with self.lock:
+            states = list(self.states)
+
+            # The worker is done, a later job starts a new download
+            if event.name in (DOWNLOAD_COMPLETED, DOWNLOAD_INTERRUPTED):
+                if self.downloads.get(self.filepath) is self:
+                    del self.downloads[self.filepath]
+
+        for state in states:
+            # Every thing continues with its own job execution
+            cargo = dict(event.cargo)
+            if JOB in cargo:
+                cargo[JOB] = state.job
+            state.publish(pysm.Event(event.name, **cargo))
+
+    def update_job_progress(self, status, message=None):
+        with self.lock:
+            states = list(self.states)
+
+        for state in states:
+            state.job_progress(status, message)
+
+
+class Prefetch:
+    """
+    Download of a queued job's artifact while the current job installs,
+    see InstallState. Joins the SharedDownload of the artifact like a
+    download state, the download state of the job takes it over once the
+    job is processed (or finds the artifact complete).
+
+    Events and progress of the download are dropped: the job is still
+    queued, a progress update would put it in progress.
+
+    Prefetched artifacts are kept while their jobs are queued, also
+    across restarts, see filepaths().
+    """
+
+    # file path → prefetch, until its job is processed or not queued anymore
+    prefetches = {}
+    # thing name → ids of its queued jobs as of the last jobs/get
+    queued_job_ids = {}
+    lock = threading.Lock()
+
+    def __init__(self, job, thing_name):
+        self.job = job
+        self.thing_name = thing_name
+        self.shared_download = None
+
+    @classmethod
+    def start(cls, job, thing_name):
+        """ Prefetch the artifact of job, False if the limit is reached. """
+        with cls.lock:
+            if job.filepath in cls.prefetches:
+                return True
+
+            if len(cls.prefetches) >= settings.service.prefetch_downloads:
+                return False
+
+            logger.info(f"Prefetching the artifact of job {job.id_}.")
+            prefetch = cls(job, thing_name)
+            prefetch.shared_download = SharedDownload.join(
+                prefetch, worker_starter(job)
+            )
+            cls.prefetches[job.filepath] = prefetch
+            return True
+
+    @classmethod
+    def hand_over(cls, filepath):
+        """ The download state of the job joined, the prefetch is done. """
+        with cls.lock:
+            prefetch = cls.prefetches.pop(filepath, None)
+
+        if prefetch is not None:
+            prefetch.shared_download.leave(prefetch)
+
+    @classmethod
+    def queued(cls, thing_name, job_ids):
+        """
+        The queued jobs of thing_name as of a jobs/get. Prefetches of its
+        other jobs are dropped, e.g. the job was canceled meanwhile.
+        """
+        with cls.lock:
+            cls.queued_job_ids[thing_name] = set(job_ids)
+            dropped = [
+                prefetch
+                for prefetch in cls.prefetches.values()
+                if prefetch.thing_name == thing_name and prefetch.job.id_ not in job_ids
+            ]
+            for prefetch in dropped:
+                del cls.prefetches[prefetch.job.filepath]
+
+        for prefetch in dropped:
+            logger.info(f"Dropping prefetch of job {prefetch.job.id_}, not queued.")
+            prefetch.shared_download.leave(prefetch)
+
+    @classmethod
+    def filepaths(cls):
+        """ Artifacts to keep: the prefetches and the ones of queued jobs. """
+        with cls.lock:
+            filepaths = set(cls.prefetches)
+
+            # The prefetches before a restart
+            if settings.service.prefetch_downloads:
+                for job_ids in cls.queued_job_ids.values():
+                    filepaths.update(
+                        settings.service.download_location / job_id
+                        for job_id in job_ids
+                    )
+
+            return filepaths
+
+    def publish(self, event):
+        if event.name not in (DOWNLOAD_COMPLETED, DOWNLOAD_INTERRUPTED):
+            return
+
+        logger.info(f"Prefetch of job {self.job.id_}: {event.name}.")
+
+        # e.g. the URL expired, the job downloads it again once processed
+        if event.name == DOWNLOAD_INTERRUPTED:
+            with self.lock:
+                if self.prefetches.get(self.job.filepath) is self:
+                    del self.prefetches[self.job.filepath]
+
+    def job_progress(self, status, message=None):
+        pass
+
+
 class DownloadState(JobProcessingState):
     """ State that handles the actual download. """
 
@@ -135,34 +424,40 @@ class DownloadState(JobProcessingState):
     def __init__(self):
         self.stop_download_hook = threading.Event()
         self.stop_download = threading.Event()
+        self.shared_download = None
         super().__init__()
 
     def clean_previous_downloads(self):
+        # Artifacts of the jobs other things of a gateway are processing
+        in_use = {job.filepath for job in UpparatStateMachine.jobs_in_processing()}
+        in_use.add(self.job.filepath)
+        in_use.update(Prefetch.filepaths())
+
         for download_file in os.listdir(settings.service.download_location):
             download_file_path = settings.service.download_location / download_file
-            if not self.job.filepath == download_file_path:
+            if download_file_path not in in_use:
                 logger.info(f"Deleting previous download artifact {download_file_path}")
                 os.remove(download_file_path)
 
     def start_download_thread(self):
-        # event could still be set from the previous job
-        # that has been cancelled or deleted, so clear it.
-        self.stop_download.clear()
         self.clean_previous_downloads()
 
         logger.debug(f"Start download for job {self.job.id_}.")
         self.job_progress(JobProgressStatus.DOWNLOAD_START.value)
 
-        threading.Thread(
-            daemon=True,
-            target=download,
-            kwargs={
-                "job": self.job,
-                "stop_download": self.stop_download,
-                "publish": self.publish,
-                "update_job_progress": self.job_progress,
-            },
-        ).start()
+        # The stop event is the download's, a new one for every download
+        self.shared_download = SharedDownload.join(self, worker_starter(self.job))
+        self.stop_download = self.shared_download.stop_download
+
+        # Continues a prefetch of the job, if any
+        Prefetch.hand_over(self.job.filepath)
+
+    def stop_download_thread(self):
+        if self.shared_download:
+            self.shared_download.leave(self)
+            self.shared_download = None
+        else:
+            self.stop_download.set()
 
     def on_enter(self, state, event):
         hook = settings.hooks.download
@@ -170,7 +465,10 @@ class DownloadState(JobProcessingState):
 
         if hook and not force:
             self.stop_download_hook = run_hook(
-                hook, self.root_machine.inbox, args=[self.job.meta]
+                hook,
+                self.root_machine.inbox,
+                args=[self.job.meta],
+                thing_name=self.thing_name,
             )
         else:
             logger.info(
@@ -183,7 +481,7 @@ class DownloadState(JobProcessingState):
 
     def on_exit(self, state, event):
         self.stop_hooks()
-        self.stop_download.set()
+        self.stop_download_thread()
 
     def event_handlers(self):
         return {HOOK: self.on_handle_hooks}
@@ -209,5 +507,5 @@ class DownloadState(JobProcessingState):
 
     def on_job_cancelled(self, state, event):
         self.stop_hooks()
-        self.stop_download.set()
+        self.stop_download_thread()
         self.publish(pysm.Event(DOWNLOAD_INTERRUPTED))
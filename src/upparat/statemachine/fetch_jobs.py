@@ -1,23 +1,35 @@
-import json
 import logging
 
 from paho.mqtt.client import topic_matches_sub
 from pysm import Event
 
 from upparat.config import settings
+from upparat.events import JOB
 from upparat.events import JOB_EXECUTION_SUMMARIES
 from upparat.events import JOB_EXECUTION_SUMMARIES_PROGRESS
 from upparat.events import JOB_EXECUTION_SUMMARIES_QUEUED
+from upparat.events import JOB_SELECTED
 from upparat.events import JOBS_AVAILABLE
+from upparat.events import MQTT_EVENT_JOB_ID
+from upparat.events import MQTT_EVENT_JOB_TOPIC
 from upparat.events import MQTT_EVENT_PAYLOAD
 from upparat.events import MQTT_EVENT_TOPIC
 from upparat.events import MQTT_MESSAGE_RECEIVED
 from upparat.events import MQTT_SUBSCRIBED
 from upparat.events import NO_JOBS_PENDING
+from upparat.jobs import describe_job_execution
+from upparat.jobs import describe_job_execution_response
+from upparat.jobs import EXECUTION
 from upparat.jobs import filter_upparat_job_exectutions
 from upparat.jobs import get_pending_job_executions
 from upparat.jobs import get_pending_job_executions_response
+from upparat.jobs import JOB_ID
+from upparat.jobs import JOB_MESSAGE
+from upparat.jobs import JobTopic
+from upparat.jobs import next_job
+from upparat.jobs import NEXT_JOB_ID
 from upparat.statemachine import BaseState
+from upparat.statemachine.download import Prefetch
 
 
 logger = logging.getLogger(__name__)
@@ -26,35 +38,98 @@ IN_PROGRESS_JOBS = "inProgressJobs"
 QUEUED_JOBS = "queuedJobs"
 
 
+def fast_job_selection():
+    """ Whether the next job execution is selected right away, see below. """
+    service = settings.service
+    return service.fast_job_selection and not service.supersede_jobs
+
+
 class FetchJobsState(BaseState):
     """
     Get pending job executions by publishing to $aws/things/<device_id>/jobs/get.
+
+    With fast_job_selection the next job execution is described first
+    ($aws/things/<device_id>/jobs/$next/get) and selected right away
+    if possible, skipping the select_job state. Not with supersede_jobs,
+    the next job execution might be superseded by a later one.
     """
 
     name = "fetch_jobs"
+    job_topics = frozenset(
+        {
+            JobTopic.GET_ACCEPTED,
+            JobTopic.GET_REJECTED,
+            JobTopic.DESCRIBE_ACCEPTED,
+            JobTopic.DESCRIBE_REJECTED,
+        }
+    )
     current_job_id = None
     get_pending_job_executions_response = None
+    # Rejected requests since entered, see on_rejected
+    rejections = 0
 
     def on_enter(self, state, event):
-        self.get_pending_job_executions_response = get_pending_job_executions_response(
-            settings.broker.thing_name
-        )
-        self.mqtt_client.subscribe(self.get_pending_job_executions_response, qos=1)
+        thing_name = self.thing_name
+        self.rejections = 0
+
+        # The subscription or the response might get lost
+        self.set_deadline(settings.broker.fetch_jobs_deadline)
+
+        if self.fast_job_selection:
+            response = describe_job_execution_response(thing_name, "+")
+        else:
+            response = get_pending_job_executions_response(thing_name)
+
+        self.get_pending_job_executions_response = response
+
+        # Subscriptions are persistent, only wait for
+        # the broker if it hasn't acknowledged them yet.
+        if self.mqtt_client.is_subscribed(self.get_pending_job_executions_response):
+            self.fetch_jobs()
 
     def on_subscription(self, state, event):
         topic = event.cargo[MQTT_EVENT_TOPIC]
         # Get pending job executions once subscribed to accepted_job_executions_topic
         if topic_matches_sub(self.get_pending_job_executions_response, topic):
-            self.mqtt_client.publish(
-                get_pending_job_executions(settings.broker.thing_name), qos=1
-            )
+            self.fetch_jobs()
+
+    def on_deadline(self, state, event):
+        self.fetch_jobs()
+
+    @property
+    def fast_job_selection(self):
+        return fast_job_selection()
+
+    def fetch_jobs(self):
+        if self.fast_job_selection:
+            self.describe_next_job_execution()
+        else:
+            self.get_pending_job_executions()
+
+    def get_pending_job_executions(self):
+        self.mqtt_client.publish(get_pending_job_executions(self.thing_name), qos=1)
+
+    def describe_next_job_execution(self):
+        self.mqtt_client.publish(
+            describe_job_execution(self.thing_name, NEXT_JOB_ID), qos=1
+        )
 
     def on_message(self, state, event):
-        topic = event.cargo[MQTT_EVENT_TOPIC]
-        payload = json.loads(event.cargo[MQTT_EVENT_PAYLOAD])
+        job_topic = event.cargo[MQTT_EVENT_JOB_TOPIC]
+
+        if event.cargo[MQTT_EVENT_JOB_ID] == NEXT_JOB_ID:
+            if job_topic == JobTopic.DESCRIBE_ACCEPTED:
+                return self.on_next_job_execution(event.cargo[MQTT_EVENT_PAYLOAD])
+            if job_topic == JobTopic.DESCRIBE_REJECTED:
+                return self.get_pending_job_executions()
+
+        if job_topic == JobTopic.GET_REJECTED:
+            return self.on_rejected(event.cargo[MQTT_EVENT_PAYLOAD])
 
         # Handle accepted pending jobs executions
-        if topic_matches_sub(self.get_pending_job_executions_response, topic):
+        if job_topic == JobTopic.GET_ACCEPTED:
+            payload = event.cargo[MQTT_EVENT_PAYLOAD]
+
             in_progress_job_executions = filter_upparat_job_exectutions(
                 payload.get(IN_PROGRESS_JOBS, [])
             )
@@ -63,6 +138,11 @@ class FetchJobsState(BaseState):
                 payload.get(QUEUED_JOBS, [])
             )
 
+            # Keeps their prefetched artifacts, see Prefetch
+            Prefetch.queued(
+                self.thing_name, [job[JOB_ID] for job in queued_job_executions]
+            )
+
             # If there are jobs available go to prepare state
             if in_progress_job_executions or queued_job_executions:
                 logger.debug("Job executions available.")
@@ -81,6 +161,34 @@ class FetchJobsState(BaseState):
                 logger.debug("No pending job executions available.")
                 return self.publish(Event(NO_JOBS_PENDING))
 
+    def on_rejected(self, payload):
+        logger.warning(f"Fetching jobs rejected: {payload.get(JOB_MESSAGE)}")
+
+        # Without a deadline there's no retry, check again once notified
+        if not settings.broker.fetch_jobs_deadline:
+            return self.publish(Event(NO_JOBS_PENDING))
+
+        # e.g. throttled, ask again later (backing off, see set_deadline)
+        self.rejections += 1
+        self.set_deadline(settings.broker.fetch_jobs_deadline, self.rejections)
+
+    def on_next_job_execution(self, payload):
+        job_execution = payload.get(EXECUTION)
+
+        if not job_execution:
+            logger.debug("No pending job executions available.")
+            return self.publish(Event(NO_JOBS_PENDING))
+
+        job = next_job(job_execution)
+
+        if job:
+            logger.info(f"Start queued job execution: {job.id_}")
+            return self.publish(Event(JOB_SELECTED, **{JOB: job}))
+
+        # In progress or not an upparat job → select from all pending job executions
+        logger.debug(f"Next job execution {job_execution['jobId']} needs selection.")
+        self.get_pending_job_executions()
+
     def event_handlers(self):
         return {
             MQTT_SUBSCRIBED: self.on_subscription,
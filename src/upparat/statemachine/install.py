@@ -15,20 +15,41 @@ from upparat.events import HOOK_STATUS_TIMED_OUT
 from upparat.events import INSTALLATION_DONE
 from upparat.events import INSTALLATION_INTERRUPTED
 from upparat.events import JOB
+from upparat.events import MQTT_EVENT_JOB_ID
+from upparat.events import MQTT_EVENT_JOB_TOPIC
+from upparat.events import MQTT_EVENT_PAYLOAD
+from upparat.events import MQTT_MESSAGE_RECEIVED
 from upparat.hooks import run_hook
+from upparat.jobs import describe_job_execution
+from upparat.jobs import EXECUTION
+from upparat.jobs import filter_upparat_job_exectutions
+from upparat.jobs import get_pending_job_executions
+from upparat.jobs import JOB_ID
 from upparat.jobs import JobFailedStatus
 from upparat.jobs import JobProgressStatus
 from upparat.jobs import JobSuccessStatus
+from upparat.jobs import JobTopic
+from upparat.jobs import next_job
 from upparat.statemachine import JobProcessingState
+from upparat.statemachine.download import Prefetch
+from upparat.statemachine.fetch_jobs import QUEUED_JOBS
 
 logger = logging.getLogger(__name__)
 
 
 class InstallState(JobProcessingState):
+    """
+    Run the install hook. With prefetch_downloads the artifacts of the
+    next queued jobs are downloaded meanwhile, see Prefetch.
+    """
+
     name = "install"
+    job_topics = JobProcessingState.job_topics | {JobTopic.DESCRIBE_ACCEPTED}
 
     def __init__(self):
         self.stop_install_hook = threading.Event()
+        # Queued jobs described to prefetch their artifacts
+        self.prefetch_job_ids = []
         super().__init__()
 
     def on_enter(self, state, event):
@@ -40,7 +61,14 @@ class InstallState(JobProcessingState):
                 settings.hooks.install,
                 self.root_machine.inbox,
                 args=[self.job.meta, self.job.filepath],
+                thing_name=self.thing_name,
             )
+
+            # Ask for the queued jobs, see on_message
+            if settings.service.prefetch_downloads:
+                self.mqtt_client.publish(
+                    get_pending_job_executions(self.thing_name), qos=1
+                )
         else:
             logger.info("No installation hook provided")
             # mark as succeeded because maybe there is no "install" step
@@ -56,7 +84,57 @@ class InstallState(JobProcessingState):
         self._stop_hooks()
 
     def event_handlers(self):
-        return {HOOK: self.on_install_hook_event}
+        return {
+            HOOK: self.on_install_hook_event,
+            MQTT_MESSAGE_RECEIVED: self.on_message,
+        }
+
+    def on_message(self, state, event):
+        if not settings.service.prefetch_downloads:
+            return
+
+        job_topic = event.cargo[MQTT_EVENT_JOB_TOPIC]
+        payload = event.cargo[MQTT_EVENT_PAYLOAD]
+
+        if job_topic == JobTopic.GET_ACCEPTED:
+            self.describe_next_jobs(payload)
+        elif job_topic == JobTopic.DESCRIBE_ACCEPTED:
+            if event.cargo[MQTT_EVENT_JOB_ID] in self.prefetch_job_ids:
+                self.prefetch(next_job(payload.get(EXECUTION)))
+
+    def describe_next_jobs(self, payload):
+        """ Describe the queued jobs next in line to get their artifacts. """
+        # The latest queued job likely supersedes the others
+        queued_jobs_ids = [
+            job[JOB_ID]
+            for job in sorted(
+                filter_upparat_job_exectutions(payload.get(QUEUED_JOBS, [])),
+                key=lambda summary: summary["queuedAt"],
+                reverse=settings.service.supersede_jobs,
+            )
+            if job[JOB_ID] != self.job.id_
+        ]
+
+        Prefetch.queued(self.thing_name, queued_jobs_ids)
+        self.prefetch_job_ids = queued_jobs_ids[: settings.service.prefetch_downloads]
+
+        for job_id in self.prefetch_job_ids:
+            self.mqtt_client.publish(
+                describe_job_execution(self.thing_name, job_id), qos=1
+            )
+
+    def prefetch(self, job):
+        # Not queued anymore or not an upparat job
+        if job is None:
+            return
+
+        # The download hook decides when to download
+        if settings.hooks.download and not job.force:
+            logger.debug(f"Not prefetching job {job.id_}, download hook provided.")
+            return
+
+        if not Prefetch.start(job, self.thing_name):
+            logger.debug(f"Not prefetching job {job.id_}, limit reached.")
 
     def _stop_hooks(self):
         self.stop_install_hook.set()
@@ -1,3 +1,5 @@
+import logging
+
 from pysm import Event
 
 from upparat.events import DOWNLOAD_COMPLETED
@@ -5,17 +7,22 @@ from upparat.events import DOWNLOAD_INTERRUPTED
 from upparat.events import ENTER
 from upparat.events import INSTALLATION_DONE
 from upparat.events import INSTALLATION_INTERRUPTED
+from upparat.events import JOB
 from upparat.events import JOB_INSTALLATION_COMPLETE
 from upparat.events import JOB_INSTALLATION_DONE
 from upparat.events import JOB_REVOKED
 from upparat.events import JOB_SELECTED
 from upparat.events import JOB_VERIFIED
 from upparat.events import JOBS_AVAILABLE
+from upparat.events import MQTT_CONNECTED
+from upparat.events import MQTT_EVENT_SESSION_PRESENT
 from upparat.events import NO_JOBS_PENDING
 from upparat.events import RESTART_INTERRUPTED
 from upparat.events import SELECT_JOB_INTERRUPTED
+from upparat.jobs import job_subscriptions
 from upparat.statemachine import UpparatStateMachine
 from upparat.statemachine.download import DownloadState
+from upparat.statemachine.fetch_jobs import fast_job_selection
 from upparat.statemachine.fetch_jobs import FetchJobsState
 from upparat.statemachine.install import InstallState
 from upparat.statemachine.monitor import MonitorState
@@ -24,9 +31,17 @@ from upparat.statemachine.select_job import SelectJobState
 from upparat.statemachine.verify_installation import VerifyInstallationState
 from upparat.statemachine.verify_job import VerifyJobState
 
+logger = logging.getLogger(__name__)
+
 
-def create_statemachine(event_queue, mqtt_client):
-    statemachine = UpparatStateMachine(event_queue, mqtt_client)
+def _session_lost(state, event):
+    return not event.cargo.get(MQTT_EVENT_SESSION_PRESENT)
+
+
+def create_statemachine(event_queue, mqtt_client, thing_name=None, journal=None):
+    statemachine = UpparatStateMachine(
+        event_queue, mqtt_client, thing_name, journal=journal
+    )
 
     fetch_jobs_state = FetchJobsState()
     monitor_state = MonitorState()
@@ -56,11 +71,28 @@ def create_statemachine(event_queue, mqtt_client):
         fetch_jobs_state, select_job_state, events=[JOBS_AVAILABLE]
     )
 
+    # Next pending job execution can be selected right away (fast_job_selection)
+    # or the job in processing before a restart is resumed (journal)
+    statemachine.add_transition(
+        fetch_jobs_state, verify_job_state, events=[JOB_SELECTED]
+    )
+
     # Notified about pending jobs
     statemachine.add_transition(
         monitor_state, select_job_state, events=[JOBS_AVAILABLE]
     )
 
+    # Notified about the next job execution (fast_job_selection)
+    statemachine.add_transition(monitor_state, verify_job_state, events=[JOB_SELECTED])
+
+    # Notifications might have been missed while offline → fetch once
+    statemachine.add_transition(
+        monitor_state,
+        fetch_jobs_state,
+        events=[MQTT_CONNECTED],
+        condition=_session_lost,
+    )
+
     # Found a job to process (can be queued or in_progress if not yet installed)
     statemachine.add_transition(
         select_job_state, verify_job_state, events=[JOB_SELECTED]
@@ -117,7 +149,25 @@ def create_statemachine(event_queue, mqtt_client):
 
     statemachine.initialize()
 
-    # send initial enter event to the initial state
-    statemachine.dispatch(Event(ENTER))
+    # Subscribe once, the client restores the subscriptions on reconnect
+    mqtt_client.subscribe(
+        [
+            (topic, 1)
+            for topic in job_subscriptions(
+                statemachine.thing_name,
+                notify_next=fast_job_selection(),
+            )
+        ]
+    )
+
+    # Resume the job in processing before the restart without asking the
+    # Jobs service first, e.g. verify the installation while connecting.
+    job = journal.job(statemachine.thing_name) if journal is not None else None
+    if job:
+        logger.info(f"Resuming job {job.id_} [{job.internal_state}].")
+        statemachine.dispatch(Event(JOB_SELECTED, **{JOB: job}))
+    else:
+        # send initial enter event to the initial state
+        statemachine.dispatch(Event(ENTER))
 
     return statemachine
@@ -1,20 +1,22 @@
-import json
 import logging
 
-from paho.mqtt.client import topic_matches_sub
 from pysm import Event
 
-from upparat.config import settings
+from upparat.events import JOB
 from upparat.events import JOB_EXECUTION_SUMMARIES
 from upparat.events import JOB_EXECUTION_SUMMARIES_PROGRESS
 from upparat.events import JOB_EXECUTION_SUMMARIES_QUEUED
+from upparat.events import JOB_SELECTED
 from upparat.events import JOBS_AVAILABLE
+from upparat.events import MQTT_EVENT_JOB_TOPIC
 from upparat.events import MQTT_EVENT_PAYLOAD
-from upparat.events import MQTT_EVENT_TOPIC
 from upparat.events import MQTT_MESSAGE_RECEIVED
+from upparat.jobs import EXECUTION
 from upparat.jobs import filter_upparat_job_exectutions
-from upparat.jobs import pending_jobs_response
+from upparat.jobs import JobTopic
+from upparat.jobs import next_job
 from upparat.statemachine import BaseState
+from upparat.statemachine.fetch_jobs import fast_job_selection
 
 logger = logging.getLogger(__name__)
 
@@ -25,23 +27,35 @@ JOBS_QUEUED = "QUEUED"
 class MonitorState(BaseState):
     """
     Wait for new jobs to be published to $aws/things/<device_id>/jobs/notify
+    (or $aws/things/<device_id>/jobs/notify-next with fast_job_selection).
+
+    A new job is notified on both topics, only one of them is handled so
+    the job is selected once.
     """
 
     name = "monitor"
-    job_pending_response = None
-
-    def on_enter(self, state, event):
-        self.job_pending_response = pending_jobs_response(settings.broker.thing_name)
-        self.mqtt_client.subscribe(self.job_pending_response, qos=1)
 
-    def on_exit(self, state, event):
-        self.mqtt_client.unsubscribe(self.job_pending_response)
+    @property
+    def job_topics(self):
+        if fast_job_selection():
+            return frozenset({JobTopic.NOTIFY_NEXT})
+        return frozenset({JobTopic.NOTIFY})
 
     def on_message(self, state, event):
-        topic = event.cargo[MQTT_EVENT_TOPIC]
+        job_topic = event.cargo[MQTT_EVENT_JOB_TOPIC]
+
+        if job_topic not in self.job_topics:
+            return
+
+        # The next job execution can be selected right away
+        if job_topic == JobTopic.NOTIFY_NEXT:
+            job = next_job(event.cargo[MQTT_EVENT_PAYLOAD].get(EXECUTION))
+            if job:
+                logger.info(f"Start queued job execution: {job.id_}")
+                self.publish(Event(JOB_SELECTED, **{JOB: job}))
 
-        if topic_matches_sub(self.job_pending_response, topic):
-            payload = json.loads(event.cargo[MQTT_EVENT_PAYLOAD])
+        elif job_topic == JobTopic.NOTIFY:
+            payload = event.cargo[MQTT_EVENT_PAYLOAD]
 
             in_progress_job_executions = filter_upparat_job_exectutions(
                 payload["jobs"].get(JOBS_IN_PROGRESS, [])
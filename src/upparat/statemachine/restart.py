@@ -36,6 +36,7 @@ class RestartState(JobProcessingState):
                 settings.hooks.restart,
                 self.root_machine.inbox,
                 args=[self.job.meta, self.job.force],
+                thing_name=self.thing_name,
             )
         else:
             logger.info("No restart hook provided")
@@ -1,4 +1,3 @@
-import json
 import logging
 
 from paho.mqtt.client import topic_matches_sub
@@ -10,6 +9,8 @@ from upparat.events import JOB_EXECUTION_SUMMARIES
 from upparat.events import JOB_EXECUTION_SUMMARIES_PROGRESS
 from upparat.events import JOB_EXECUTION_SUMMARIES_QUEUED
 from upparat.events import JOB_SELECTED
+from upparat.events import MQTT_EVENT_JOB_ID
+from upparat.events import MQTT_EVENT_JOB_TOPIC
 from upparat.events import MQTT_EVENT_PAYLOAD
 from upparat.events import MQTT_EVENT_TOPIC
 from upparat.events import MQTT_MESSAGE_RECEIVED
@@ -18,20 +19,16 @@ from upparat.events import SELECT_JOB_INTERRUPTED
 from upparat.jobs import describe_job_execution
 from upparat.jobs import describe_job_execution_response
 from upparat.jobs import EXECUTION
-from upparat.jobs import Job
-from upparat.jobs import JOB_ACCEPTED
-from upparat.jobs import JOB_DOCUMENT
-from upparat.jobs import JOB_DOCUMENT_FILE
-from upparat.jobs import JOB_DOCUMENT_FORCE
-from upparat.jobs import JOB_DOCUMENT_META
-from upparat.jobs import JOB_DOCUMENT_VERSION
+from upparat.jobs import job_from_execution
 from upparat.jobs import JOB_ID
 from upparat.jobs import JOB_MESSAGE
-from upparat.jobs import JOB_REJECTED
-from upparat.jobs import JOB_STATUS
-from upparat.jobs import JOB_STATUS_DETAILS
 from upparat.jobs import job_update_multiple_as_failed
+from upparat.jobs import job_update_multiple_as_succeeded
 from upparat.jobs import JobProgressStatus
+from upparat.jobs import JobStatus
+from upparat.jobs import JobSuccessStatus
+from upparat.jobs import JobTopic
+from upparat.jobs import version_key
 from upparat.statemachine import BaseState
 
 logger = logging.getLogger(__name__)
@@ -40,13 +37,29 @@ logger = logging.getLogger(__name__)
 class SelectJobState(BaseState):
     """
     Select the job to run. This can be one that was already started or a queued one
+
+    With supersede_jobs all queued jobs are described and the one with the
+    newest version is selected. Queued jobs not newer than the last job
+    that succeeded are superseded by it instead.
     """
 
     name = "select_job"
+    job_topics = frozenset({JobTopic.DESCRIBE_ACCEPTED, JobTopic.DESCRIBE_REJECTED})
     current_job_id = None
     describe_job_execution_response = None
 
+    # Compares job document versions, replace e.g. for semantic versions
+    version_key = staticmethod(version_key)
+
+    def __init__(self):
+        # Queued job id → job once described (supersede_jobs), oldest first
+        self.candidates = {}
+        super().__init__()
+
     def on_enter(self, state, event):
+        self.current_job_id = None
+        self.candidates = {}
+
         job_execution_summaries = event.cargo["source_event"].cargo[
             JOB_EXECUTION_SUMMARIES
         ]
@@ -79,7 +92,7 @@ class SelectJobState(BaseState):
 
                 job_update_multiple_as_failed(
                     self.mqtt_client,
-                    settings.broker.thing_name,
+                    self.thing_name,
                     in_progress_jobs_ids,
                     JobProgressStatus.ERROR_MULTIPLE_IN_PROGRESS.value,
                     failure_reason,
@@ -87,6 +100,10 @@ class SelectJobState(BaseState):
 
                 self.publish(Event(SELECT_JOB_INTERRUPTED))
 
+        elif settings.service.supersede_jobs and queued_jobs_ids:
+            logger.info(f"Select the newest of {len(queued_jobs_ids)} queued jobs.")
+            self.candidates = {job_id: None for job_id in queued_jobs_ids}
+
         elif queued_jobs_ids:
             self.current_job_id = queued_jobs_ids[0]
             logger.info(f"Start queued job execution: {self.current_job_id}")
@@ -95,12 +112,19 @@ class SelectJobState(BaseState):
             logger.warning("No job executions pending.")
             self.publish(Event(SELECT_JOB_INTERRUPTED))
 
-        # Subscribe to current job description, if any job was selected
-        if self.current_job_id:
+        # Describe the current job (or the candidates), if any job was
+        # selected. The subscription to the job descriptions is persistent,
+        # only wait for the broker if it hasn't acknowledged it yet.
+        if self.current_job_id or self.candidates:
             self.describe_job_execution_response = describe_job_execution_response(
-                settings.broker.thing_name, self.current_job_id
+                self.thing_name, "+"
             )
-            self.mqtt_client.subscribe(self.describe_job_execution_response, qos=1)
+
+            # The subscription or the description might get lost
+            self.set_deadline(settings.broker.select_job_deadline)
+
+            if self.mqtt_client.is_subscribed(self.describe_job_execution_response):
+                self.describe_job_execution()
 
     def on_subscription(self, state, event):
         topic = event.cargo[MQTT_EVENT_TOPIC]
@@ -108,43 +132,109 @@ class SelectJobState(BaseState):
         # Get the current job info once we are
         # subscribed to job_execution_update_topic
         if topic_matches_sub(self.describe_job_execution_response, topic):
+            self.describe_job_execution()
+
+    def on_deadline(self, state, event):
+        self.describe_job_execution()
+
+    def describe_job_execution(self):
+        if self.current_job_id:
+            job_ids = [self.current_job_id]
+        else:
+            # Not yet described candidates
+            job_ids = [job_id for job_id, job in self.candidates.items() if not job]
+
+        for job_id in job_ids:
             self.mqtt_client.publish(
-                describe_job_execution(settings.broker.thing_name, self.current_job_id),
-                qos=1,
+                describe_job_execution(self.thing_name, job_id), qos=1
             )
 
     def on_message(self, state, event):
-        topic = event.cargo[MQTT_EVENT_TOPIC]
-        payload = json.loads(event.cargo[MQTT_EVENT_PAYLOAD])
+        job_topic = event.cargo[MQTT_EVENT_JOB_TOPIC]
 
-        accepted_topic = describe_job_execution_response(
-            settings.broker.thing_name, self.current_job_id, state_filter=JOB_ACCEPTED
-        )
-
-        rejected_topic = describe_job_execution_response(
-            settings.broker.thing_name, self.current_job_id, state_filter=JOB_REJECTED
-        )
+        if event.cargo[MQTT_EVENT_JOB_ID] in self.candidates:
+            return self.on_candidate(event)
 
-        if topic_matches_sub(accepted_topic, topic):
-            job_execution = payload[EXECUTION]
-            job_document = job_execution[JOB_DOCUMENT]
-
-            job = Job(
-                id_=job_execution[JOB_ID],
-                status=job_execution[JOB_STATUS],
-                file_url=job_document[JOB_DOCUMENT_FILE],
-                version=job_document[JOB_DOCUMENT_VERSION],
-                force=job_document.get(JOB_DOCUMENT_FORCE, False),
-                meta=job_document.get(JOB_DOCUMENT_META),
-                status_details=job_execution.get(JOB_STATUS_DETAILS),
-            )
+        # Only the description of the current job is of interest
+        if event.cargo[MQTT_EVENT_JOB_ID] != self.current_job_id:
+            return
 
+        if job_topic == JobTopic.DESCRIBE_ACCEPTED:
+            payload = event.cargo[MQTT_EVENT_PAYLOAD]
+            job = job_from_execution(payload[EXECUTION])
             self.publish(Event(JOB_SELECTED, **{JOB: job}))
 
-        elif topic_matches_sub(rejected_topic, topic):
+        elif job_topic == JobTopic.DESCRIBE_REJECTED:
+            payload = event.cargo[MQTT_EVENT_PAYLOAD]
             logger.warning(payload[JOB_MESSAGE])
             self.publish(Event(SELECT_JOB_INTERRUPTED))
 
+    def on_candidate(self, event):
+        job_id = event.cargo[MQTT_EVENT_JOB_ID]
+        payload = event.cargo[MQTT_EVENT_PAYLOAD]
+
+        if event.cargo[MQTT_EVENT_JOB_TOPIC] == JobTopic.DESCRIBE_ACCEPTED:
+            job = job_from_execution(payload[EXECUTION])
+            if job.status == JobStatus.QUEUED.value:
+                self.candidates[job_id] = job
+            else:
+                del self.candidates[job_id]
+        elif event.cargo[MQTT_EVENT_JOB_TOPIC] == JobTopic.DESCRIBE_REJECTED:
+            # e.g. canceled meanwhile
+            logger.warning(payload[JOB_MESSAGE])
+            del self.candidates[job_id]
+
+        if all(self.candidates.values()):
+            self.select_newest()
+
+    def select_newest(self):
+        jobs = list(self.candidates.values())
+        self.candidates = {}
+
+        if not jobs:
+            logger.warning("No job executions pending.")
+            return self.publish(Event(SELECT_JOB_INTERRUPTED))
+
+        # Installing these would be a downgrade. Compared with the queued jobs
+        # of the broker, not with what was selected before (e.g. a restart).
+        succeeded = self.root_machine.succeeded_job
+        if succeeded is not None:
+            succeeded_version = self.version_key(succeeded.version)
+            superseded = [
+                job
+                for job in jobs
+                if self.version_key(job.version) <= succeeded_version
+            ]
+            jobs = [job for job in jobs if job not in superseded]
+            self.supersede(superseded, succeeded)
+
+        if not jobs:
+            logger.info("No newer job executions pending.")
+            return self.publish(Event(SELECT_JOB_INTERRUPTED))
+
+        # The oldest of the newest version. The others stay queued, they are
+        # superseded by it once it succeeded (see the next selection), if it
+        # fails the next selection picks among them.
+        newest = max(jobs, key=lambda job: self.version_key(job.version))
+
+        logger.info(f"Start queued job execution: {newest.id_}")
+        self.publish(Event(JOB_SELECTED, **{JOB: newest}))
+
+    def supersede(self, jobs, succeeded):
+        if not jobs:
+            return
+
+        job_ids = [job.id_ for job in jobs]
+        logger.info(f"Jobs {', '.join(job_ids)} superseded by {succeeded.id_}.")
+
+        job_update_multiple_as_succeeded(
+            self.mqtt_client,
+            self.thing_name,
+            job_ids,
+            JobSuccessStatus.SUPERSEDED.value,
+            f"Superseded by {succeeded.id_} (version {succeeded.version})",
+        )
+
     def event_handlers(self):
         return {
             MQTT_SUBSCRIBED: self.on_subscription,
@@ -37,7 +37,10 @@ class VerifyInstallationState(JobProcessingState):
             # Start version check
             logger.debug("Start version check")
             self.stop_version_hook = run_hook(
-                settings.hooks.version, self.root_machine.inbox, args=[self.job.meta]
+                settings.hooks.version,
+                self.root_machine.inbox,
+                args=[self.job.meta],
+                thing_name=self.thing_name,
             )
 
     def on_exit(self, state, event):
@@ -74,6 +77,7 @@ class VerifyInstallationState(JobProcessingState):
                         settings.hooks.ready,
                         self.root_machine.inbox,
                         args=[self.job.meta],
+                        thing_name=self.thing_name,
                     )
                 else:
                     logger.info("Skip ready hook")
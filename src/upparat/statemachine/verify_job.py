@@ -49,7 +49,10 @@ class VerifyJobState(JobProcessingState):
 
             logger.debug("Start version check")
             self.stop_version_hook = run_hook(
-                version_hook, self.root_machine.inbox, args=[self.job.meta]
+                version_hook,
+                self.root_machine.inbox,
+                args=[self.job.meta],
+                thing_name=self.thing_name,
             )
 
         elif self.job.status == JobStatus.IN_PROGRESS.value:
@@ -0,0 +1,97 @@
+"""
+Timers of the state machines, see PriorityInbox.schedule(): the event
+of a timer is put into the inbox once due and dispatched like all other
+events, no thread per timeout is needed.
+
+States schedule timers with BaseState.schedule(), they are cancelled
+once the state is left.
+"""
+import heapq
+import itertools
+import time
+
+from pysm import Event
+
+
+class Timer:
+    def __init__(self, deadline, event, interval=None):
+        self.deadline = deadline
+        self.event = event
+        # Seconds between events of a periodic timer
+        self.interval = interval
+        self.cancelled = False
+        self.done = False
+
+    @property
+    def active(self):
+        return not (self.cancelled or self.done)
+
+    def cancel(self):
+        self.cancelled = True
+
+    def fire(self):
+        """ The event to dispatch, a copy for periodic timers. """
+        if self.interval is None:
+            self.done = True
+            return self.event
+
+        event = self.event
+        return Event(event.name, event.input, **event.cargo)
+
+
+class Timers:
+    """ Timers ordered by deadline (a heap), guarded by the inbox. """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._heap = []
+        # Keeps the order of timers with the same deadline
+        self._seq = itertools.count()
+
+    def schedule(self, delay, event, interval=None):
+        if interval is not None and interval <= 0:
+            raise ValueError(f"Timer interval must be positive: {interval}")
+
+        timer = Timer(self.clock() + delay, event, interval)
+        self._push(timer)
+        return timer
+
+    def _push(self, timer):
+        heapq.heappush(self._heap, (timer.deadline, next(self._seq), timer))
+
+    def timeout(self):
+        """ Seconds until the next timer is due, None without timers. """
+        self._drop_cancelled()
+
+        if not self._heap:
+            return None
+
+        return max(0, self._heap[0][0] - self.clock())
+
+    def due(self):
+        """ Timers due by now, periodic ones are scheduled again. """
+        now = self.clock()
+        timers = []
+
+        while self._heap and self._heap[0][0] <= now:
+            _, _, timer = heapq.heappop(self._heap)
+            if timer.cancelled:
+                continue
+
+            timers.append(timer)
+
+            if timer.interval is not None:
+                timer.deadline += timer.interval
+                # Fell behind (e.g. a long dispatch), skip the missed events
+                if timer.deadline <= now:
+                    timer.deadline = now + timer.interval
+                self._push(timer)
+
+        return timers
+
+    def _drop_cancelled(self):
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+
+    def __len__(self):
+        return sum(1 for _, _, timer in self._heap if not timer.cancelled)
@@ -0,0 +1,79 @@
+"""
+TLS for the broker connection. The context is created once, so the CA
+and the certificate chain are parsed at startup only, and reconnects
+resume the TLS session of the previous connection where the broker
+supports it instead of a full handshake with the client certificate.
+"""
+import ssl
+import time
+
+from .metrics import metrics
+from .metrics import MQTT_TLS_HANDSHAKE
+from .metrics import MQTT_TLS_SESSIONS_RESUMED
+
+# AWS IoT client certificate authentication on 443 / 8883
+ALPN_PROTOCOL = "x-amzn-mqtt-ca"
+
+
+class ResumingSocket(ssl.SSLSocket):
+    """ Measures the handshake and hands its session to the context. """
+
+    def do_handshake(self, block=False):
+        start = time.monotonic()
+
+        try:
+            super().do_handshake(block)
+        except (OSError, ValueError):
+            # Don't offer the session again, e.g. if the broker refused it
+            self.context.forget_session(self.server_hostname)
+            raise
+
+        metrics.observe(MQTT_TLS_HANDSHAKE, time.monotonic() - start)
+        if self.session_reused:
+            metrics.increment(MQTT_TLS_SESSIONS_RESUMED)
+
+        self.context.keep_session(self.server_hostname, self.session)
+
+    def close(self):
+        # TLS 1.3 session tickets arrive after the handshake
+        session = self.session
+        if session is not None and session.has_ticket:
+            self.context.keep_session(self.server_hostname, session)
+
+        super().close()
+
+
+class ResumingContext(ssl.SSLContext):
+    """ SSLContext offering the last session of a host on wrap_socket(). """
+
+    sslsocket_class = ResumingSocket
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        # server hostname → session of the last connection
+        self._sessions = {}
+
+    def wrap_socket(self, sock, server_hostname=None, session=None, **kwargs):
+        if session is None and server_hostname:
+            session = self._sessions.get(server_hostname)
+
+        return super().wrap_socket(
+            sock, server_hostname=server_hostname, session=session, **kwargs
+        )
+
+    def keep_session(self, server_hostname, session):
+        if server_hostname and session is not None:
+            self._sessions[server_hostname] = session
+
+    def forget_session(self, server_hostname):
+        self._sessions.pop(server_hostname, None)
+
+
+def create_context(cafile, certfile, keyfile):
+    """ Context for client certificate authentication with TLS ALPN. """
+    context = ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.load_default_certs()
+    context.set_alpn_protocols([ALPN_PROTOCOL])
+    context.load_verify_locations(cafile=cafile)
+    context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+    return context
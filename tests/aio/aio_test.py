@@ -0,0 +1,349 @@
+import asyncio
+import os
+import socket
+import struct
+import threading
+from pathlib import Path
+
+import pytest
+from paho.mqtt.client import MQTT_ERR_SUCCESS
+from pysm import Event
+
+from upparat import hooks
+from upparat.aio import AsyncioMQTT
+from upparat.aio import dispatch
+from upparat.aio import Inbox
+from upparat.config import Endpoint
+from upparat.config import settings
+from upparat.endpoints import Endpoints
+from upparat.events import HOOK_MESSAGE
+from upparat.events import HOOK_STATUS
+from upparat.events import HOOK_STATUS_COMPLETED
+from upparat.events import HOOK_STATUS_FAILED
+from upparat.events import HOOK_STATUS_OUTPUT
+from upparat.events import MQTT_CONNECTED
+from upparat.events import MQTT_DISCONNECTED
+from upparat.events import MQTT_EVENT_TOPIC
+from upparat.events import MQTT_SUBSCRIBED
+from upparat.hooks import run_hook
+
+COMMAND_FILE = (Path(__file__).parent.parent / "hooks" / "test.sh").as_posix()
+TIMEOUT = 5
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+class Broker:
+    """ Just enough of an MQTT broker: CONNACK and SUBACK. """
+
+    def __init__(self):
+        self.connections = 0
+        self.published = []
+        self.writer = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        self.writer = writer
+
+        try:
+            while True:
+                command = (await reader.readexactly(1))[0] & 0xF0
+
+                length, multiplier = 0, 1
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length += (byte & 0x7F) * multiplier
+                    multiplier *= 128
+                    if not byte & 0x80:
+                        break
+
+                body = await reader.readexactly(length)
+
+                if command == 0x10:  # CONNECT
+                    writer.write(bytes([0x20, 2, 0, 0]))
+                elif command == 0x80:  # SUBSCRIBE
+                    topics = 0
+                    index = 2
+                    while index < len(body):
+                        (topic_length,) = struct.unpack("!H", body[index : index + 2])
+                        index += 2 + topic_length + 1
+                        topics += 1
+                    writer.write(bytes([0x90, 2 + topics]) + body[:2] + bytes(topics))
+                elif command == 0x30:  # PUBLISH
+                    (topic_length,) = struct.unpack("!H", body[:2])
+                    self.published.append(body[2 : 2 + topic_length].decode())
+                elif command == 0xE0:  # DISCONNECT
+                    break
+        except asyncio.IncompleteReadError:
+            pass
+
+        writer.close()
+
+    def close(self):
+        self.server.close()
+
+
+async def wait_for_event(inbox, name):
+    while True:
+        event = await asyncio.wait_for(inbox.get(), TIMEOUT)
+        if event.name == name:
+            return event
+
+
+def test_inbox_put_from_thread(loop):
+    inbox = Inbox(loop)
+
+    inbox.put(Event("loop"))
+    thread = threading.Thread(target=inbox.put, args=(Event("thread"),))
+    thread.start()
+    thread.join()
+
+    async def _get():
+        return [(await inbox.get()).name for _ in range(2)]
+
+    assert loop.run_until_complete(asyncio.wait_for(_get(), TIMEOUT)) == [
+        "loop",
+        "thread",
+    ]
+
+
+def test_inbox_schedule(loop):
+    inbox = Inbox(loop)
+    inbox.schedule(0.05, Event("timer"))
+    cancelled = inbox.schedule(0.01, Event("cancelled"))
+    cancelled.cancel()
+
+    async def _get():
+        return (await inbox.get()).name
+
+    assert loop.run_until_complete(asyncio.wait_for(_get(), TIMEOUT)) == "timer"
+
+
+def test_dispatch(mocker, loop):
+    inbox = Inbox(loop)
+    state_machine = mocker.Mock()
+    state_machine.dispatch.side_effect = [None, SystemExit]
+
+    inbox.put(Event("first"))
+    inbox.put(Event("exit"))
+
+    with pytest.raises(SystemExit):
+        loop.run_until_complete(dispatch(inbox, state_machine))
+
+    assert state_machine.dispatch.call_count == 2
+
+
+def test_mqtt_connect_subscribe_reconnect(mocker, loop):
+    broker = Broker()
+    port = loop.run_until_complete(broker.start())
+
+    inbox = Inbox(loop)
+    client = AsyncioMQTT("_", inbox, loop=loop)
+    mocker.patch.object(client, "_next_reconnect_delay", return_value=0)
+
+    # connects in the executor, the loop keeps dispatching
+    reconnect_threads = []
+    reconnect = client.reconnect
+
+    def _reconnect():
+        reconnect_threads.append(threading.get_ident())
+        return reconnect()
+
+    mocker.patch.object(client, "reconnect", side_effect=_reconnect)
+
+    async def _scenario():
+        client.run("127.0.0.1", port)
+        await wait_for_event(inbox, MQTT_CONNECTED)
+
+        client.subscribe([("a", 1), ("b", 1)])
+        subscribed = [
+            (await wait_for_event(inbox, MQTT_SUBSCRIBED)).cargo[MQTT_EVENT_TOPIC]
+            for _ in range(2)
+        ]
+        assert subscribed == ["a", "b"]
+
+        # publish from a download thread is handed over to the loop
+        infos = []
+        thread = threading.Thread(
+            target=lambda: infos.append(client.publish("topic", "{}"))
+        )
+        thread.start()
+        thread.join()
+        assert infos[0].rc == MQTT_ERR_SUCCESS
+        for _ in range(100):
+            if broker.published:
+                break
+            await asyncio.sleep(0.01)
+        assert broker.published == ["topic"]
+
+        # connection lost → reconnect and resubscribe
+        broker.writer.close()
+        await wait_for_event(inbox, MQTT_DISCONNECTED)
+        await wait_for_event(inbox, MQTT_CONNECTED)
+        await wait_for_event(inbox, MQTT_SUBSCRIBED)
+        assert broker.connections == 2
+
+        client.disconnect()
+        await asyncio.sleep(0.1)
+
+    loop.run_until_complete(_scenario())
+    assert len(reconnect_threads) == 2
+    assert threading.get_ident() not in reconnect_threads
+    broker.close()
+    loop.run_until_complete(broker.server.wait_closed())
+
+
+def test_mqtt_endpoints_probed_off_loop(mocker, loop):
+    broker = Broker()
+    port = loop.run_until_complete(broker.start())
+
+    closed = socket.socket()
+    closed.bind(("127.0.0.1", 0))
+    closed_port = closed.getsockname()[1]
+    closed.close()
+
+    endpoints = Endpoints(
+        [Endpoint("down", "127.0.0.1", closed_port), Endpoint("up", "127.0.0.1", port)]
+    )
+    probe_threads = []
+    probe = endpoints.probe
+
+    def _probe(endpoint):
+        probe_threads.append(threading.get_ident())
+        return probe(endpoint)
+
+    mocker.patch.object(endpoints, "probe", side_effect=_probe)
+
+    inbox = Inbox(loop)
+    client = AsyncioMQTT("_", inbox, loop=loop, endpoints=endpoints)
+
+    async def _scenario():
+        client.run("127.0.0.1", closed_port)
+        await wait_for_event(inbox, MQTT_CONNECTED)
+        assert endpoints.current.name == "up"
+
+        client.disconnect()
+        await asyncio.sleep(0.1)
+
+    loop.run_until_complete(_scenario())
+    broker.close()
+    loop.run_until_complete(broker.server.wait_closed())
+
+    assert len(probe_threads) == 2
+    assert threading.get_ident() not in probe_threads
+
+
+def test_hook_on_loop(mocker, loop):
+    inbox = Inbox(loop)
+    run_hook(COMMAND_FILE, inbox, args=["args"])
+
+    async def _events():
+        events = []
+        while not events or events[-1].cargo[HOOK_STATUS] == HOOK_STATUS_OUTPUT:
+            events.append(await asyncio.wait_for(inbox.get(), TIMEOUT))
+        return events
+
+    events = loop.run_until_complete(_events())
+
+    # Output lines waiting in the inbox are coalesced, the newest one is kept
+    output = [event.cargo[HOOK_MESSAGE] for event in events[:-1]]
+    assert output == sorted(set(output), key=["1", "2", "3", "args"].index)
+    assert output[-1] == "args"
+
+    assert events[-1].cargo[HOOK_MESSAGE] == "args"
+    assert events[-1].cargo[HOOK_STATUS] == HOOK_STATUS_COMPLETED
+
+
+def test_hook_on_loop_stopped(mocker, loop):
+    inbox = Inbox(loop)
+    settings.hooks.retry_interval = 60
+    settings.hooks.max_retries = 3
+
+    create_subprocess_exec = mocker.patch(
+        "upparat.hooks.asyncio.create_subprocess_exec"
+    )
+    process = create_subprocess_exec.return_value = mocker.Mock()
+    process.stdout = mocker.MagicMock()
+    process.stdout.__aiter__.return_value = []
+
+    async def _retry():
+        return 3
+
+    process.wait.side_effect = _retry
+
+    async def _create(*args, **kwargs):
+        return process
+
+    create_subprocess_exec.side_effect = _create
+
+    stop_event = run_hook("retry", inbox)
+
+    async def _stop():
+        await asyncio.sleep(0.1)
+        stop_event.set()
+        await asyncio.sleep(0.1)
+
+    loop.run_until_complete(_stop())
+
+    # stopped while waiting for the retry
+    assert create_subprocess_exec.call_count == 1
+    assert inbox.empty()
+
+
+def test_hook_on_loop_terminated(tmpdir, loop):
+    inbox = Inbox(loop)
+    hook = tmpdir / "hook.sh"
+    hook.write("#!/usr/bin/env sh\necho $$\nexec sleep 60\n")
+    hook.chmod(0o755)
+
+    stop_event = run_hook(str(hook), inbox)
+    assert len(hooks._hook_tasks) == 1
+
+    async def _stop():
+        pid = int((await asyncio.wait_for(inbox.get(), TIMEOUT)).cargo[HOOK_MESSAGE])
+        stop_event.set()
+
+        while hooks._hook_tasks:
+            await asyncio.sleep(0.01)
+        return pid
+
+    pid = loop.run_until_complete(asyncio.wait_for(_stop(), TIMEOUT))
+
+    # terminated and reaped, no result
+    with pytest.raises(ProcessLookupError):
+        os.kill(pid, 0)
+    assert inbox.empty()
+
+
+def test_hook_on_loop_error(mocker, loop):
+    inbox = Inbox(loop)
+    mocker.patch(
+        "upparat.hooks.asyncio.create_subprocess_exec", side_effect=RuntimeError("bug")
+    )
+
+    run_hook("hook", inbox)
+    event = loop.run_until_complete(asyncio.wait_for(inbox.get(), TIMEOUT))
+
+    # the state isn't left waiting for the hook
+    assert event.cargo[HOOK_STATUS] == HOOK_STATUS_FAILED
+    assert event.cargo[HOOK_MESSAGE] == "bug"
+    assert not hooks._hook_tasks
+
+
+def test_hook_on_loop_not_found(loop):
+    inbox = Inbox(loop)
+    run_hook("/does/not/exist", inbox)
+
+    event = loop.run_until_complete(asyncio.wait_for(inbox.get(), TIMEOUT))
+    assert event.cargo[HOOK_STATUS] == HOOK_STATUS_FAILED
@@ -1,9 +1,13 @@
+import os
+import signal
 from queue import Queue
 
 import pytest
 from pysm import Event
 
 from upparat.cli import cli
+from upparat.config import RUNTIME_ASYNCIO
+from upparat.config import RUNTIME_THREAD
 from upparat.config import settings
 from upparat.events import EXIT_SIGNAL_SENT
 
@@ -26,7 +30,7 @@ def test_sigint_handler(mocker, queue_with_exit_signal):
     with pytest.raises(SystemExit):
         cli(queue_with_exit_signal)
 
-    assert signal.signal.call_count == 2
+    assert signal.signal.call_count == 3
     assert signal.signal.call_args_list[0][0][0] == signal.SIGINT
 
     # test that SIGINT would put EXIT_SIGNAL_SENT event in queue
@@ -45,7 +49,7 @@ def test_sigterm_handler(mocker, queue_with_exit_signal):
     with pytest.raises(SystemExit):
         cli(queue_with_exit_signal)
 
-    assert signal.signal.call_count == 2
+    assert signal.signal.call_count == 3
     assert signal.signal.call_args_list[1][0][0] == signal.SIGTERM
 
     # test that SIGTERM would put EXIT_SIGNAL_SENT event in queue
@@ -70,9 +74,18 @@ def test_mqtt_client_setup(mocker, queue_with_exit_signal):
         cli(queue_with_exit_signal)
 
     assert mqtt.call_args == mocker.call(
-        client_id=settings.broker.client_id, queue=queue_with_exit_signal
+        client_id=settings.broker.client_id,
+        queue=queue_with_exit_signal,
+        clean_session=settings.broker.clean_session,
+        topic_index=mocker.ANY,
+        outbox=mocker.ANY,
+        endpoints=mocker.ANY,
+        health=mocker.ANY,
     )
 
+    mqtt_instance.reconnect_delay_set.assert_called_once_with(
+        settings.broker.reconnect_min_delay, settings.broker.reconnect_max_delay
+    )
     mqtt_instance.run.assert_called_once_with(
         settings.broker.host, settings.broker.port
     )
@@ -85,8 +98,108 @@ def test_state_machine_setup(mocker, queue_with_exit_signal):
 
     mqtt = mocker.patch("upparat.cli.MQTT")
     mqtt_instance = mqtt.return_value
+    journal = mocker.patch("upparat.cli.Journal")
+
+    with pytest.raises(SystemExit):
+        cli(queue_with_exit_signal)
+
+    journal.assert_called_once_with(settings.service.state_location / "journal.json")
+    create_statemachine.assert_called_once_with(
+        queue_with_exit_signal, mqtt_instance, journal=journal.return_value
+    )
+
+
+def test_outbox_setup(mocker, queue_with_exit_signal):
+    mocker.patch("upparat.cli.MQTT")
+    outbox = mocker.patch("upparat.cli.Outbox")
+
+    settings.broker.thing_name = "bobby"
+
+    with pytest.raises(SystemExit):
+        cli(queue_with_exit_signal)
+
+    outbox.assert_called_once_with(
+        settings.service.state_location / "outbox.sqlite",
+        "$aws/things/bobby/jobs/+/update",
+        "$aws/things/bobby/jobs/+/update/+",
+    )
+
+
+def test_gateway_setup(mocker, queue_with_exit_signal):
+    create_statemachine = mocker.patch("upparat.cli.create_statemachine")
+    create_statemachine.return_value.dispatch.side_effect = SystemExit
+    mqtt = mocker.patch("upparat.cli.MQTT")
+    mqtt_instance = mqtt.return_value
+    outbox = mocker.patch("upparat.cli.Outbox")
+    journal = mocker.patch("upparat.cli.Journal").return_value
+
+    settings.broker.thing_names = ["a", "b"]
+
+    try:
+        with pytest.raises(SystemExit):
+            cli(queue_with_exit_signal)
+    finally:
+        settings.broker.thing_names = []
+
+    assert create_statemachine.call_args_list == [
+        mocker.call(queue_with_exit_signal, mqtt_instance, "a", journal=journal),
+        mocker.call(queue_with_exit_signal, mqtt_instance, "b", journal=journal),
+    ]
+
+    # one outbox for the job updates of all things
+    outbox.assert_called_once_with(
+        settings.service.state_location / "outbox.sqlite",
+        "$aws/things/+/jobs/+/update",
+        "$aws/things/+/jobs/+/update/+",
+    )
+
+
+def test_sigusr1_handler(mocker, queue_with_exit_signal):
+    signal = mocker.patch("upparat.cli.signal")
+    logger = mocker.patch("upparat.cli.logger")
 
     with pytest.raises(SystemExit):
         cli(queue_with_exit_signal)
 
-    create_statemachine.assert_called_once_with(queue_with_exit_signal, mqtt_instance)
+    assert signal.signal.call_args_list[2][0][0] == signal.SIGUSR1
+
+    # test that SIGUSR1 logs the metrics
+    signal_handler = signal.signal.call_args_list[2][0][1]
+    signal_handler(None, None)
+
+    assert "job_updates.pending" in logger.warning.call_args[0][0]
+
+
+def test_asyncio_runtime(mocker):
+    mqtt = mocker.patch("upparat.cli.MQTT")
+    asyncio_mqtt = mocker.patch("upparat.cli.AsyncioMQTT")
+    create_statemachine = mocker.patch("upparat.cli.create_statemachine")
+
+    loops = []
+
+    def _create_statemachine(inbox, client, journal):
+        # the signal handlers are registered with the loop
+        inbox.loop.call_soon(os.kill, os.getpid(), signal.SIGTERM)
+        loops.append(inbox.loop)
+        return mocker.DEFAULT
+
+    create_statemachine.side_effect = _create_statemachine
+    create_statemachine.return_value.dispatch.side_effect = SystemExit
+
+    settings.service.runtime = RUNTIME_ASYNCIO
+
+    try:
+        with pytest.raises(SystemExit):
+            cli()
+    finally:
+        settings.service.runtime = RUNTIME_THREAD
+
+    # the loop is upparat's own and closed on exit
+    assert loops[0].is_closed()
+    assert mqtt.call_count == 0
+    asyncio_mqtt.return_value.run.assert_called_once_with(
+        settings.broker.host, settings.broker.port
+    )
+
+    event = create_statemachine.return_value.dispatch.call_args[0][0]
+    assert event.name == EXIT_SIGNAL_SENT
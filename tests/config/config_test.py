@@ -166,6 +166,71 @@ def test_sentry_config_file(tmpdir, create_settings):
     assert settings.service.sentry == sentry
 
 
+def test_download_worker_default(create_settings):
+    settings = create_settings()
+    assert settings.service.download_worker == "thread"
+
+
+def test_download_worker_config_file(create_settings):
+    settings = create_settings(service={"download_worker": "process"})
+    assert settings.service.download_worker == "process"
+
+    with pytest.raises(ValueError, match="download_worker"):
+        create_settings(service={"download_worker": "fiber"})
+
+
+def test_state_location_default(create_settings):
+    settings = create_settings()
+    assert settings.service.state_location == Path("/tmp/upparat-state")
+
+
+def test_state_location_config_file(tmpdir, create_settings):
+    state_location = Path(tmpdir / "state_here")
+    assert not state_location.is_dir()
+
+    settings = create_settings(service={"state_location": str(state_location)})
+    assert settings.service.state_location == state_location
+    assert state_location.is_dir()
+
+
+def test_fast_job_selection_default(create_settings):
+    settings = create_settings()
+    assert not settings.service.fast_job_selection
+
+
+def test_fast_job_selection_config_file(create_settings):
+    settings = create_settings(service={"fast_job_selection": "true"})
+    assert settings.service.fast_job_selection
+
+
+def test_prefetch_downloads(create_settings):
+    assert create_settings().service.prefetch_downloads == 0
+
+    settings = create_settings(service={"prefetch_downloads": "2"})
+    assert settings.service.prefetch_downloads == 2
+
+    with pytest.raises(ValueError, match="prefetch_downloads"):
+        create_settings(service={"prefetch_downloads": "-1"})
+
+
+def test_supersede_jobs(create_settings):
+    assert not create_settings().service.supersede_jobs
+    assert create_settings(service={"supersede_jobs": "true"}).service.supersede_jobs
+
+
+def test_runtime_default(create_settings):
+    settings = create_settings()
+    assert settings.service.runtime == "thread"
+
+
+def test_runtime_config_file(create_settings):
+    settings = create_settings(service={"runtime": "asyncio"})
+    assert settings.service.runtime == "asyncio"
+
+    with pytest.raises(ValueError, match="runtime"):
+        create_settings(service={"runtime": "trio"})
+
+
 def test_host_default(create_settings):
     settings = create_settings()
     assert settings.broker.host == "127.0.0.1"
@@ -210,6 +275,125 @@ def test_certs_config_file(create_settings):
     assert settings.broker.keyfile == keyfile
 
 
+def test_thing_names_default(create_settings):
+    settings = create_settings()
+    assert settings.broker.thing_names == []
+
+
+def test_thing_names_config_file(create_settings):
+    settings = create_settings(broker={"thing_names": "sensor_1, sensor_2,"})
+    assert settings.broker.thing_names == ["sensor_1", "sensor_2"]
+
+
+def test_keepalive_default(create_settings):
+    settings = create_settings()
+    assert settings.broker.keepalive_min == 30
+    assert settings.broker.keepalive_max == 60
+    assert settings.broker.max_ping_rtt == 10
+
+
+def test_keepalive_config_file(create_settings):
+    settings = create_settings(
+        broker={"keepalive_min": 20, "keepalive_max": 1200, "max_ping_rtt": 2.5}
+    )
+    assert settings.broker.keepalive_min == 20
+    assert settings.broker.keepalive_max == 1200
+    assert settings.broker.max_ping_rtt == 2.5
+
+
+def test_keepalive_invalid(create_settings):
+    with pytest.raises(ValueError, match="keepalive"):
+        create_settings(broker={"keepalive_min": 600, "keepalive_max": 300})
+
+
+def test_deadlines_default(create_settings):
+    settings = create_settings()
+    assert settings.broker.fetch_jobs_deadline == 30
+    assert settings.broker.select_job_deadline == 30
+
+
+def test_deadlines_config_file(create_settings):
+    settings = create_settings(
+        broker={"fetch_jobs_deadline": 10, "select_job_deadline": 0}
+    )
+    assert settings.broker.fetch_jobs_deadline == 10
+    assert settings.broker.select_job_deadline == 0
+
+
+def test_deadlines_invalid(create_settings):
+    with pytest.raises(ValueError, match="fetch_jobs_deadline"):
+        create_settings(broker={"fetch_jobs_deadline": -1})
+
+
+def test_endpoints_default(create_settings):
+    settings = create_settings()
+    assert settings.broker.endpoints == []
+
+
+def test_endpoints_config_file(tmpdir):
+    path = Path(tmpdir / "upparat.conf")
+    path.write_text(
+        """
+[broker]
+endpoints = bridge, aws
+
+[endpoint:bridge]
+host = bridge.local
+
+[endpoint:aws]
+host = iot.amazonaws.com
+port = 8883
+cafile = ca.pem
+certfile = cert.pem
+keyfile = key.pem
+"""
+    )
+
+    bridge, aws = Settings(["-c", str(path)]).broker.endpoints
+
+    assert (bridge.name, bridge.host, bridge.port) == ("bridge", "bridge.local", 1883)
+    assert bridge.cafile is None
+    assert (aws.name, aws.host, aws.port) == ("aws", "iot.amazonaws.com", 8883)
+    assert (aws.cafile, aws.certfile, aws.keyfile) == ("ca.pem", "cert.pem", "key.pem")
+
+
+def test_endpoints_missing_section(create_settings):
+    with pytest.raises(ValueError, match="endpoint:aws"):
+        create_settings(broker={"endpoints": "aws"})
+
+
+def test_clean_session_default(create_settings):
+    settings = create_settings()
+    assert settings.broker.clean_session
+
+
+def test_clean_session_config_file(create_settings):
+    settings = create_settings(broker={"clean_session": "false"})
+    assert not settings.broker.clean_session
+
+
+def test_reconnect_delay_default(create_settings):
+    settings = create_settings()
+    assert settings.broker.reconnect_min_delay == 1
+    assert settings.broker.reconnect_max_delay == 120
+
+
+def test_reconnect_delay_config_file(create_settings):
+    settings = create_settings(
+        broker={"reconnect_min_delay": 5, "reconnect_max_delay": 300}
+    )
+    assert settings.broker.reconnect_min_delay == 5
+    assert settings.broker.reconnect_max_delay == 300
+
+
+def test_reconnect_delay_invalid(create_settings):
+    with pytest.raises(ValueError, match="reconnect"):
+        create_settings(broker={"reconnect_min_delay": 10, "reconnect_max_delay": 5})
+
+    with pytest.raises(ValueError, match="reconnect"):
+        create_settings(broker={"reconnect_min_delay": 0})
+
+
 def test_hooks_default(create_settings):
     settings = create_settings()
     assert not settings.hooks.version
@@ -0,0 +1,131 @@
+from queue import Queue
+
+import pytest
+from paho.mqtt.client import Client
+from paho.mqtt.client import CONNACK_ACCEPTED
+from paho.mqtt.client import MQTT_ERR_NO_CONN
+from paho.mqtt.client import MQTT_ERR_SUCCESS
+from paho.mqtt.client import MQTTMessage
+
+from upparat.embedded import create_embedded_statemachine
+from upparat.embedded import EmbeddedMQTT
+from upparat.events import MQTT_CONNECTED
+from upparat.events import MQTT_EVENT_JOB_TOPIC
+from upparat.events import MQTT_MESSAGE_RECEIVED
+from upparat.events import MQTT_SUBSCRIBED
+from upparat.jobs import JobTopic
+from upparat.jobs import JobTopicIndex
+from upparat.serialization import dumps
+
+MID = 42
+
+
+@pytest.fixture
+def embedded(mocker):
+    client = Client("application")
+    callbacks = mocker.Mock()
+    client.on_connect = callbacks.on_connect
+    client.on_message = callbacks.on_message
+    client.on_subscribe = callbacks.on_subscribe
+    client.on_publish = callbacks.on_publish
+
+    queue = Queue()
+    adapter = EmbeddedMQTT(client, queue, topic_index=JobTopicIndex("bobby"))
+
+    return client, callbacks, adapter, queue
+
+
+def message(topic, payload):
+    message = MQTTMessage(topic=topic.encode())
+    message.payload = dumps(payload)
+    return message
+
+
+def test_on_connect_chained(embedded):
+    client, callbacks, _, queue = embedded
+
+    client.on_connect(client, None, {"session present": 0}, CONNACK_ACCEPTED)
+
+    assert queue.get_nowait().name == MQTT_CONNECTED
+    callbacks.on_connect.assert_called_once_with(
+        client, None, {"session present": 0}, CONNACK_ACCEPTED
+    )
+
+
+def test_job_messages_taken(embedded):
+    client, callbacks, _, queue = embedded
+
+    client._handle_on_message(message("$aws/things/bobby/jobs/notify", {"jobs": {}}))
+    client._handle_on_message(message("telemetry", {}))
+
+    event = queue.get_nowait()
+    assert event.name == MQTT_MESSAGE_RECEIVED
+    assert event.cargo[MQTT_EVENT_JOB_TOPIC] == JobTopic.NOTIFY
+    assert queue.empty()
+
+    # Everything else is the application's
+    callbacks.on_message.assert_called_once()
+    assert callbacks.on_message.call_args[0][2].topic == "telemetry"
+
+
+def test_subscribe_own_mid(mocker, embedded):
+    client, callbacks, adapter, queue = embedded
+    client._mid_generate = mocker.Mock(return_value=MID)
+    adapter._subscribe = mocker.Mock(return_value=(MQTT_ERR_SUCCESS, None))
+
+    adapter.subscribe("topic", qos=1)
+    client.on_subscribe(client, None, MID, (1,))
+
+    assert queue.get_nowait().name == MQTT_SUBSCRIBED
+    assert callbacks.on_subscribe.call_count == 0
+
+    # Subscriptions of the application
+    client.on_subscribe(client, None, 7, (0,))
+    callbacks.on_subscribe.assert_called_once_with(client, None, 7, (0,))
+
+
+def test_subscribe_not_connected(embedded):
+    _, _, adapter, _ = embedded
+
+    # Renewed once the application's client connects
+    assert adapter.subscribe("topic", qos=1)[0] == MQTT_ERR_NO_CONN
+    assert adapter._subscriptions == {"topic": 1}
+
+
+def test_publish_own_mid(embedded):
+    client, callbacks, adapter, _ = embedded
+
+    # Queued by Paho until connected
+    info = adapter.publish("$aws/things/bobby/jobs/get", "{}", qos=1)
+    client.on_publish(client, None, info.mid)
+
+    assert callbacks.on_publish.call_count == 0
+
+    client.on_publish(client, None, info.mid + 1)
+    callbacks.on_publish.assert_called_once_with(client, None, info.mid + 1)
+
+
+def test_disconnect_detaches(embedded):
+    client, callbacks, adapter, queue = embedded
+
+    adapter.disconnect()
+
+    assert client.on_connect is callbacks.on_connect
+    assert client.on_subscribe is callbacks.on_subscribe
+    assert client.on_publish is callbacks.on_publish
+
+    client._handle_on_message(message("$aws/things/bobby/jobs/notify", {"jobs": {}}))
+    assert queue.empty()
+    callbacks.on_message.assert_called_once()
+
+
+def test_create_embedded_statemachine(embedded):
+    client = Client("application")
+    inbox = Queue()
+
+    state_machine = create_embedded_statemachine(client, inbox, "bobby")
+
+    assert state_machine.thing_name == "bobby"
+    assert isinstance(state_machine.mqtt_client, EmbeddedMQTT)
+    # Subscribed on the application's client once connected
+    assert "$aws/things/bobby/jobs/notify" in state_machine.mqtt_client._subscriptions
@@ -0,0 +1,114 @@
+import socket
+
+import pytest
+
+from upparat.config import Endpoint
+from upparat.endpoints import Endpoints
+from upparat.metrics import metrics
+from upparat.metrics import MQTT_FAILOVERS
+
+BRIDGE = Endpoint("bridge", "bridge.local", 1883)
+AWS = Endpoint("aws", "iot.amazonaws.com", 8883, "ca.pem", "cert.pem", "key.pem")
+
+
+@pytest.fixture
+def endpoints(mocker):
+    endpoints = Endpoints([BRIDGE, AWS])
+    latencies = {"bridge": 0.01, "aws": 0.1}
+    mocker.patch.object(
+        endpoints, "probe", side_effect=lambda endpoint: latencies[endpoint.name]
+    )
+    return endpoints, latencies
+
+
+def test_single_endpoint_not_probed(mocker):
+    endpoints = Endpoints([AWS])
+    probe = mocker.patch.object(endpoints, "probe")
+
+    assert endpoints.select() is AWS
+    assert not endpoints.probing
+    assert probe.call_count == 0
+
+
+def test_fastest_endpoint(endpoints):
+    endpoints, latencies = endpoints
+    assert endpoints.select() is BRIDGE
+
+    latencies["bridge"] = 0.5
+    endpoints.failed()
+    assert endpoints.select() is AWS
+
+
+def test_current_endpoint_not_probed(endpoints):
+    endpoints, latencies = endpoints
+    assert endpoints.select() is BRIDGE
+    assert endpoints.probe.call_count == 2
+
+    # e.g. the broker closed the connection, reconnect right away
+    latencies["bridge"] = 0.5
+    assert not endpoints.probing
+    assert endpoints.select() is BRIDGE
+    assert endpoints.probe.call_count == 2
+
+
+def test_probe_all_ahead(endpoints):
+    endpoints, latencies = endpoints
+    assert endpoints.probing
+
+    endpoints.probe_all()
+    latencies["bridge"] = 0.5
+
+    # the latencies of probe_all() are used once
+    assert endpoints.select() is BRIDGE
+    assert endpoints.probe.call_count == 2
+
+    endpoints.failed()
+    assert endpoints.select() is AWS
+    assert endpoints.probe.call_count == 4
+
+
+def test_failover_unreachable(endpoints):
+    metrics.reset()
+    endpoints, latencies = endpoints
+    assert endpoints.select() is BRIDGE
+
+    latencies["bridge"] = None
+    endpoints.failed()
+    assert endpoints.select() is AWS
+    assert metrics.snapshot()[MQTT_FAILOVERS] == 1
+
+
+def test_failed_endpoint_avoided(endpoints):
+    endpoints, _ = endpoints
+    assert endpoints.select() is BRIDGE
+
+    # e.g. the bridge accepts TCP but its broker is down
+    endpoints.failed()
+    assert endpoints.select() is AWS
+
+    endpoints.connected()
+    assert endpoints.select() is AWS
+
+
+def test_all_unreachable_in_turn(endpoints):
+    endpoints, latencies = endpoints
+    latencies["bridge"] = latencies["aws"] = None
+
+    assert endpoints.select() is BRIDGE
+    endpoints.failed()
+    assert endpoints.select() is AWS
+    endpoints.failed()
+    assert endpoints.select() is BRIDGE
+
+
+def test_probe():
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen()
+    port = listener.getsockname()[1]
+
+    endpoints = Endpoints([])
+    assert endpoints.probe(Endpoint("local", "127.0.0.1", port)) >= 0
+
+    listener.close()
+    assert endpoints.probe(Endpoint("local", "127.0.0.1", port)) is None
@@ -0,0 +1,56 @@
+import pytest
+from pysm import Event
+
+from upparat.events import HOOK
+from upparat.events import MQTT_CONNECTED
+from upparat.events import MQTT_EVENT_TOPIC
+from upparat.events import MQTT_MESSAGE_RECEIVED
+from upparat.events import THING_NAME
+from upparat.gateway import Gateway
+
+
+@pytest.fixture
+def gateway(mocker):
+    state_machines = [mocker.Mock(thing_name=name) for name in ("a", "b")]
+    return Gateway(state_machines), state_machines
+
+
+def test_dispatch_by_topic(gateway):
+    gateway, (a, b) = gateway
+
+    event = Event(
+        MQTT_MESSAGE_RECEIVED, **{MQTT_EVENT_TOPIC: "$aws/things/b/jobs/notify"}
+    )
+    gateway.dispatch(event)
+
+    assert a.dispatch.call_count == 0
+    b.dispatch.assert_called_once_with(event)
+
+
+def test_dispatch_by_thing_name(gateway):
+    gateway, (a, b) = gateway
+
+    event = Event(HOOK, **{THING_NAME: "a"})
+    gateway.dispatch(event)
+
+    a.dispatch.assert_called_once_with(event)
+    assert b.dispatch.call_count == 0
+
+
+def test_dispatch_to_all(gateway):
+    gateway, state_machines = gateway
+
+    event = Event(MQTT_CONNECTED)
+    gateway.dispatch(event)
+
+    for state_machine in state_machines:
+        state_machine.dispatch.assert_called_once_with(event)
+
+
+def test_dispatch_unknown_thing(gateway):
+    gateway, state_machines = gateway
+
+    gateway.dispatch(Event(HOOK, **{THING_NAME: "c"}))
+
+    for state_machine in state_machines:
+        assert state_machine.dispatch.call_count == 0
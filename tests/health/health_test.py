@@ -0,0 +1,39 @@
+from upparat.health import ConnectionHealth
+from upparat.metrics import metrics
+from upparat.metrics import MQTT_PING_RTT
+
+
+def test_keepalive():
+    health = ConnectionHealth(30, 300, 10)
+    assert health.keepalive == 300
+
+    health.set_job_active("a", True)
+    health.set_job_active("b", True)
+    assert health.keepalive == 30
+
+    # Short as long as any thing processes a job (gateway mode)
+    health.set_job_active("a", False)
+    assert health.keepalive == 30
+
+    health.set_job_active("b", False)
+    assert health.keepalive == 300
+
+
+def test_degraded():
+    metrics.reset()
+    health = ConnectionHealth(30, 300, 10, degraded_pings=2)
+
+    health.ping(11)
+    assert not health.degraded
+
+    # a fast round trip in between
+    health.ping(0.1)
+    health.ping(11)
+    assert not health.degraded
+
+    health.ping(12)
+    assert health.degraded
+    assert metrics.snapshot()[MQTT_PING_RTT]["count"] == 4
+
+    health.reset()
+    assert not health.degraded
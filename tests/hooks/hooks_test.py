@@ -9,6 +9,7 @@ from upparat.events import HOOK_STATUS_COMPLETED
 from upparat.events import HOOK_STATUS_FAILED
 from upparat.events import HOOK_STATUS_OUTPUT
 from upparat.events import HOOK_STATUS_TIMED_OUT
+from upparat.events import THING_NAME
 from upparat.hooks import RETRY_EXIT_CODE
 from upparat.hooks import run_hook
 
@@ -61,6 +62,7 @@ def test_subprocess_args(mocker):
         bufsize=1,
         stdout=subprocess.PIPE,
         universal_newlines=True,
+        env=None,
     )
 
 
@@ -172,3 +174,17 @@ def test_command(mocker):
     assert event.name == HOOK
     assert event.cargo[HOOK_STATUS] == HOOK_STATUS_COMPLETED
     assert event.cargo[HOOK_MESSAGE] == "args"
+
+
+def test_thing_name(mocker):
+    mock = _subprocess_mock(mocker, [0], ["1"])
+    queue = mocker.MagicMock()
+
+    run_hook("noop", queue, join=True, thing_name="sensor_1")
+
+    _, kwargs = mock.call_args
+    assert kwargs["env"]["UPPARAT_THING_NAME"] == "sensor_1"
+
+    # routed back to the thing in gateway mode
+    for args, _ in queue.put.call_args_list:
+        assert args[0].cargo[THING_NAME] == "sensor_1"
@@ -0,0 +1,176 @@
+import threading
+from queue import Empty
+
+import pytest
+from pysm import Event
+
+from upparat.events import DOWNLOAD_COMPLETED
+from upparat.events import EXIT_SIGNAL_SENT
+from upparat.events import HOOK
+from upparat.events import HOOK_COMMAND
+from upparat.events import HOOK_MESSAGE
+from upparat.events import HOOK_STATUS
+from upparat.events import HOOK_STATUS_COMPLETED
+from upparat.events import HOOK_STATUS_OUTPUT
+from upparat.events import MQTT_EVENT_JOB_TOPIC
+from upparat.events import MQTT_MESSAGE_RECEIVED
+from upparat.events import MQTT_SUBSCRIBED
+from upparat.events import THING_NAME
+from upparat.inbox import PriorityInbox
+from upparat.jobs import JobTopic
+from upparat.metrics import INBOX_BACKPRESSURE
+from upparat.metrics import INBOX_COALESCED
+from upparat.metrics import metrics
+
+TIMEOUT = 5
+
+
+def hook_event(message, status=HOOK_STATUS_OUTPUT, hook="install", **cargo):
+    cargo.update({HOOK_COMMAND: hook, HOOK_STATUS: status, HOOK_MESSAGE: message})
+    return Event(HOOK, **cargo)
+
+
+def messages(inbox):
+    events = []
+    while not inbox.empty():
+        event = inbox.get_nowait()
+        events.append(event.cargo.get(HOOK_MESSAGE, event.name))
+    return events
+
+
+def message_event(job_topic):
+    return Event(MQTT_MESSAGE_RECEIVED, **{MQTT_EVENT_JOB_TOPIC: job_topic})
+
+
+def test_urgent_first():
+    inbox = PriorityInbox()
+    get_accepted = message_event(JobTopic.GET_ACCEPTED)
+    notify = message_event(JobTopic.NOTIFY)
+    exit_signal = Event(EXIT_SIGNAL_SENT)
+
+    inbox.put(get_accepted)
+    inbox.put(notify)
+    inbox.put(exit_signal)
+
+    events = [inbox.get_nowait() for _ in range(inbox.qsize())]
+    assert events == [notify, exit_signal, get_accepted]
+
+
+def test_urgent_after_statemachine_events():
+    inbox = PriorityInbox()
+    get_accepted = message_event(JobTopic.GET_ACCEPTED)
+    notify = message_event(JobTopic.NOTIFY)
+
+    # Published by the state machine, never overtaken
+    inbox.put(Event(MQTT_SUBSCRIBED))
+    inbox.put(hook_event("done", status=HOOK_STATUS_COMPLETED))
+    inbox.put(get_accepted)
+    inbox.put(notify)
+    inbox.put(Event(DOWNLOAD_COMPLETED))
+    inbox.put(Event(EXIT_SIGNAL_SENT))
+
+    events = [inbox.get_nowait() for _ in range(inbox.qsize())]
+    assert [event.cargo.get(HOOK_MESSAGE, event.name) for event in events] == [
+        MQTT_SUBSCRIBED,
+        "done",
+        MQTT_MESSAGE_RECEIVED,
+        MQTT_MESSAGE_RECEIVED,
+        DOWNLOAD_COMPLETED,
+        EXIT_SIGNAL_SENT,
+    ]
+    assert events[2:4] == [notify, get_accepted]
+
+
+def test_coalesce_output():
+    metrics.reset()
+    inbox = PriorityInbox()
+
+    for line in ["1", "2", "3"]:
+        inbox.put(hook_event(line))
+    inbox.put(hook_event("a", hook="restart"))
+    inbox.put(hook_event("b", hook="restart", **{THING_NAME: "other"}))
+    inbox.put(hook_event("4"))
+    inbox.put(hook_event("5"))
+    inbox.put(hook_event("done", status=HOOK_STATUS_COMPLETED))
+    inbox.put(hook_event("6"))
+
+    assert messages(inbox) == ["3", "a", "b", "5", "done", "6"]
+    assert metrics.snapshot()[INBOX_COALESCED] == 3
+
+
+def test_get_timeout():
+    inbox = PriorityInbox()
+
+    with pytest.raises(Empty):
+        inbox.get(timeout=0.01)
+
+    with pytest.raises(Empty):
+        inbox.get_nowait()
+
+
+def test_backpressure():
+    metrics.reset()
+    inbox = PriorityInbox(high_water=2)
+
+    inbox.put(Event(DOWNLOAD_COMPLETED))
+    inbox.put(hook_event("1"))
+
+    # Coalesced, no need to wait
+    inbox.put(hook_event("2"))
+
+    # The hook waits until the state machine caught up
+    hook = threading.Thread(target=inbox.put, args=(hook_event("x", hook="other"),))
+    hook.start()
+    hook.join(0.1)
+    assert hook.is_alive()
+    assert metrics.snapshot()[INBOX_BACKPRESSURE] == 1
+
+    assert inbox.get(timeout=TIMEOUT).name == DOWNLOAD_COMPLETED
+    hook.join(TIMEOUT)
+    assert not hook.is_alive()
+
+    # Never waits in the dispatching thread (e.g. a state publishing)
+    inbox.put(hook_event("y", hook="another"))
+    assert messages(inbox) == ["2", "x", "y"]
+
+
+def test_schedule():
+    inbox = PriorityInbox()
+
+    inbox.schedule(0.05, Event("timer"))
+    inbox.put(Event(DOWNLOAD_COMPLETED))
+
+    assert inbox.get(timeout=TIMEOUT).name == DOWNLOAD_COMPLETED
+    assert inbox.get(timeout=TIMEOUT).name == "timer"
+
+    with pytest.raises(Empty):
+        inbox.get(timeout=0.01)
+
+
+def test_schedule_wakes_dispatcher():
+    inbox = PriorityInbox()
+    inbox.schedule(60, Event("later"))
+
+    events = []
+    dispatcher = threading.Thread(target=lambda: events.append(inbox.get()))
+    dispatcher.start()
+
+    # Waits for the later timer at first
+    dispatcher.join(0.05)
+    inbox.schedule(0, Event("now"))
+    dispatcher.join(TIMEOUT)
+
+    assert [event.name for event in events] == ["now"]
+
+
+def test_cancelled_after_due():
+    inbox = PriorityInbox()
+    timer = inbox.schedule(0, Event("timer"))
+    inbox.put(Event(DOWNLOAD_COMPLETED))
+
+    # Due, but e.g. the download completed transition left its state
+    assert inbox.get().name == DOWNLOAD_COMPLETED
+    timer.cancel()
+
+    with pytest.raises(Empty):
+        inbox.get_nowait()
@@ -0,0 +1,101 @@
+import pytest
+
+from upparat.jobs import get_pending_job_ids
+from upparat.jobs import JobTopic
+from upparat.jobs import JobTopicIndex
+from upparat.jobs import next_job
+from upparat.jobs import version_key
+
+THING_NAME = "thing"
+JOB_ID = "upparat_1"
+
+
+@pytest.fixture
+def topic_index():
+    return JobTopicIndex(THING_NAME)
+
+
+@pytest.mark.parametrize(
+    "topic,expected",
+    [
+        ("notify", (JobTopic.NOTIFY, None)),
+        ("notify-next", (JobTopic.NOTIFY_NEXT, None)),
+        ("get/accepted", (JobTopic.GET_ACCEPTED, None)),
+        ("get/rejected", (JobTopic.GET_REJECTED, None)),
+        (f"{JOB_ID}/get/accepted", (JobTopic.DESCRIBE_ACCEPTED, JOB_ID)),
+        (f"{JOB_ID}/get/rejected", (JobTopic.DESCRIBE_REJECTED, JOB_ID)),
+        (f"{JOB_ID}/update/accepted", (JobTopic.UPDATE_ACCEPTED, JOB_ID)),
+        (f"{JOB_ID}/update/rejected", (JobTopic.UPDATE_REJECTED, JOB_ID)),
+        # job ids which collide with topic levels
+        ("get/get/accepted", (JobTopic.DESCRIBE_ACCEPTED, "get")),
+        ("notify/update/accepted", (JobTopic.UPDATE_ACCEPTED, "notify")),
+    ],
+)
+def test_classify(topic_index, topic, expected):
+    assert topic_index.classify(f"$aws/things/{THING_NAME}/jobs/{topic}") == expected
+
+
+@pytest.mark.parametrize(
+    "topic",
+    [
+        f"$aws/things/{THING_NAME}/jobs/get",
+        f"$aws/things/{THING_NAME}/jobs/start-next",
+        f"$aws/things/{THING_NAME}/jobs/{JOB_ID}/get",
+        "$aws/things/other/jobs/notify",
+        "$aws/things",
+        "topic",
+    ],
+)
+def test_classify_unknown(topic_index, topic):
+    assert topic_index.classify(topic) == (None, None)
+
+
+def create_job_execution(job_id, status):
+    return {
+        "jobId": job_id,
+        "status": status,
+        "jobDocument": {"file": "http://foo.bar/baz.bin", "version": "1.0.1"},
+    }
+
+
+def test_next_job_queued():
+    job = next_job(create_job_execution(JOB_ID, "QUEUED"))
+    assert job.id_ == JOB_ID
+    assert job.status == "QUEUED"
+    assert job.version == "1.0.1"
+    assert not job.force
+
+
+@pytest.mark.parametrize(
+    "job_execution",
+    [
+        None,
+        create_job_execution(JOB_ID, "IN_PROGRESS"),
+        create_job_execution("other_1", "QUEUED"),
+    ],
+)
+def test_next_job_needs_selection(job_execution):
+    assert next_job(job_execution) is None
+
+
+def test_get_pending_job_ids():
+    payload = {
+        "jobs": {
+            "IN_PROGRESS": [{"jobId": "upparat_1"}],
+            "QUEUED": [{"jobId": "upparat_2"}],
+        }
+    }
+    assert get_pending_job_ids(payload) == ["upparat_1", "upparat_2"]
+    assert get_pending_job_ids({}) == []
+
+
+def test_version_key():
+    versions = ["1.10.0", "1.9.2", "1.9", "2.0.0-rc1", "2.0.0", "1.9.10"]
+    assert sorted(versions, key=version_key) == [
+        "1.9",
+        "1.9.2",
+        "1.9.10",
+        "1.10.0",
+        "2.0.0",
+        "2.0.0-rc1",
+    ]
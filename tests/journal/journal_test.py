@@ -0,0 +1,97 @@
+from pathlib import Path
+
+import pytest
+
+from upparat.config import settings
+from upparat.jobs import Job
+from upparat.jobs import JobProgressStatus
+from upparat.jobs import JobStatus
+from upparat.journal import Journal
+
+JOB_ = Job(
+    "upparat_1",
+    JobStatus.QUEUED.value,
+    "http://foo.bar/baz.bin",
+    "1.0.0",
+    True,
+    {"foo": "bar"},
+    None,
+)
+
+
+@pytest.fixture
+def path(tmpdir):
+    return tmpdir / "journal.json"
+
+
+def test_record(path):
+    journal = Journal(path)
+    assert journal.job("bobby") is None
+
+    journal.record("bobby", JOB_, JobProgressStatus.REBOOT_START.value)
+
+    # After the restart
+    job = Journal(path).job("bobby")
+    assert job.id_ == JOB_.id_
+    assert job.status == JobStatus.IN_PROGRESS.value
+    assert job.internal_state == JobProgressStatus.REBOOT_START.value
+    assert (job.file_url, job.version, job.force, job.meta) == (
+        JOB_.file_url,
+        JOB_.version,
+        JOB_.force,
+        JOB_.meta,
+    )
+    assert Journal(path).job("other") is None
+
+
+def test_written_on_change(mocker, path):
+    journal = Journal(path)
+    write = mocker.spy(journal, "_write")
+
+    journal.record("bobby", JOB_, JobProgressStatus.DOWNLOAD_START.value)
+    journal.record("bobby", JOB_, JobProgressStatus.DOWNLOAD_PROGRESS.value)
+    journal.record("bobby", JOB_, JobProgressStatus.DOWNLOAD_PROGRESS.value)
+    journal.record("bobby", JOB_, JobProgressStatus.INSTALLATION_START.value)
+
+    assert write.call_count == 3
+
+
+def test_clear(path):
+    journal = Journal(path)
+    journal.record("bobby", JOB_, JobProgressStatus.REBOOT_START.value)
+    journal.record("alice", JOB_, JobProgressStatus.REBOOT_START.value)
+
+    # Not the journaled job
+    journal.clear("bobby", "upparat_2")
+    assert Journal(path).job("bobby")
+
+    journal.clear("bobby", JOB_.id_)
+    assert Journal(path).job("bobby") is None
+    assert Journal(path).job("alice")
+
+
+def test_corrupt(path):
+    path.write("{")
+    assert Journal(path).job("bobby") is None
+
+    path.write('{"bobby": {"jobId": "upparat_1"}}')
+    assert Journal(path).job("bobby") is None
+
+
+def test_artifact_shorter_than_journaled(mocker, tmpdir, path):
+    mocker.patch.object(settings.service, "download_location", Path(tmpdir))
+    artifact = Path(tmpdir) / JOB_.id_
+    artifact.write_bytes(b"0123456789")
+
+    journal = Journal(path)
+    journal.record("bobby", JOB_, JobProgressStatus.DOWNLOAD_PROGRESS.value)
+
+    # Resumed, it only grew since
+    artifact.write_bytes(b"0123456789abcdef")
+    assert Journal(path).job("bobby")
+    assert artifact.exists()
+
+    # e.g. truncated by a power cut or replaced, download it again
+    artifact.write_bytes(b"01234")
+    assert Journal(path).job("bobby")
+    assert not artifact.exists()
@@ -0,0 +1,22 @@
+from upparat.metrics import Metrics
+
+
+def test_snapshot():
+    metrics = Metrics()
+
+    metrics.increment("counter")
+    metrics.increment("counter", 2)
+    metrics.gauge("gauge", 7)
+    metrics.gauge("callable", lambda: 42)
+    metrics.observe("timing", 1.0)
+    metrics.observe("timing", 3.0)
+
+    assert metrics.snapshot() == {
+        "counter": 3,
+        "gauge": 7,
+        "callable": 42,
+        "timing": {"count": 2, "mean": 2.0, "max": 3.0, "last": 3.0},
+    }
+
+    metrics.reset()
+    assert metrics.snapshot() == {}
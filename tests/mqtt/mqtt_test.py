@@ -1,15 +1,38 @@
+import time
 from queue import Queue
 
 import pytest
+from paho.mqtt.client import CONNACK_ACCEPTED
+from paho.mqtt.client import CONNACK_REFUSED_SERVER_UNAVAILABLE
+from paho.mqtt.client import mqtt_cs_connected
+from paho.mqtt.client import MQTT_ERR_CONN_LOST
 from paho.mqtt.client import MQTT_ERR_NO_CONN
 from paho.mqtt.client import MQTT_ERR_SUCCESS
 
+from upparat.config import Endpoint
+from upparat.events import MQTT_CONNECTED
+from upparat.events import MQTT_DISCONNECTED
+from upparat.events import MQTT_EVENT_JOB_ID
+from upparat.events import MQTT_EVENT_JOB_TOPIC
 from upparat.events import MQTT_EVENT_PAYLOAD
+from upparat.events import MQTT_EVENT_QOS
+from upparat.events import MQTT_EVENT_SESSION_PRESENT
 from upparat.events import MQTT_EVENT_TOPIC
 from upparat.events import MQTT_MESSAGE_RECEIVED
+from upparat.events import MQTT_SUBSCRIBE_TIMEOUT
 from upparat.events import MQTT_SUBSCRIBED
 from upparat.events import MQTT_UNSUBSCRIBED
+from upparat.health import ConnectionHealth
+from upparat.jobs import JobTopic
+from upparat.jobs import JobTopicIndex
+from upparat.metrics import metrics
+from upparat.metrics import MQTT_MESSAGES_DROPPED
+from upparat.metrics import MQTT_SUBSCRIBE_TIMEOUTS
+from upparat.metrics import MQTT_SUBSCRIBES_PENDING
+from upparat.metrics import MQTT_UNSUBSCRIBE_TIMEOUTS
 from upparat.mqtt import MQTT
+from upparat.outbox import Outbox
+from upparat.serialization import dumps
 
 MID = 42
 
@@ -103,7 +126,7 @@ def test_subscribe_success(mocker, mqtt):
 
     # check subscription state
     assert client._subscriptions[topic] == qos
-    assert client._subscription_mid[MID] == topic
+    assert client._subscription_mid[MID] == ([topic], mocker.ANY)
 
     assert len(client._unsubscription_mid) == 0
 
@@ -139,7 +162,7 @@ def test_unsubscribe_success(mocker, mqtt):
     client._mid_generate.assert_called_once_with()
 
     # check subscription state
-    assert client._unsubscription_mid[MID] == topic
+    assert client._unsubscription_mid[MID] == (topic, mocker.ANY)
 
     assert len(client._subscriptions) == 0
     assert len(client._subscription_mid) == 0
@@ -176,16 +199,192 @@ def test_on_connect_handler_resubscribe(mocker, mqtt):
 
     client.on_connect(None, None, None, MQTT_ERR_SUCCESS)
 
-    client._subscribe.assert_called_once_with(topic, qos=0, mid=MID)
+    client._subscribe.assert_called_once_with([(topic, 0)], qos=0, mid=MID)
     assert client._unsubscribe.call_count == 0
 
 
+def test_on_connect_handler_resubscribe_batched(mocker, mqtt):
+    client, queue = mqtt
+    client._subscribe = mocker.Mock(return_value=(MQTT_ERR_SUCCESS, None))
+
+    topics = [(f"topic/{index}", 1) for index in range(10)]
+    client.subscribe(topics)
+    client._subscribe.reset_mock()
+
+    client.on_connect(None, None, None, CONNACK_ACCEPTED)
+
+    # at most 8 topics per SUBSCRIBE (AWS IoT)
+    assert client._subscribe.call_args_list == [
+        mocker.call(topics[:8], qos=0, mid=MID),
+        mocker.call(topics[8:], qos=0, mid=MID),
+    ]
+
+
+def test_on_subscribe_multiple_topics(mocker, mqtt):
+    client, queue = mqtt
+    client._subscribe = mocker.Mock(return_value=(MQTT_ERR_SUCCESS, None))
+
+    client.subscribe([("a", 1), ("b", 1), ("c", 1)])
+    assert client._subscription_mid[MID] == (["a", "b", "c"], mocker.ANY)
+
+    # b got refused by the broker
+    client.on_subscribe(None, None, MID, (1, 0x80, 1))
+
+    assert [queue.get_nowait().cargo[MQTT_EVENT_TOPIC] for _ in range(2)] == [
+        "a",
+        "c",
+    ]
+    assert queue.empty()
+    assert client.is_subscribed("a")
+    assert not client.is_subscribed("b")
+    assert client.is_subscribed("c")
+
+
+def test_on_connect_event(mqtt):
+    client, queue = mqtt
+
+    client.on_connect(None, None, None, CONNACK_REFUSED_SERVER_UNAVAILABLE)
+    assert queue.empty()
+
+    client.on_connect(None, None, None, CONNACK_ACCEPTED)
+    assert queue.get_nowait().name == MQTT_CONNECTED
+
+
+def test_on_disconnect_event(mqtt):
+    client, queue = mqtt
+
+    client.on_disconnect(None, None, MQTT_ERR_NO_CONN)
+    assert queue.get_nowait().name == MQTT_DISCONNECTED
+
+
+def test_reconnect_wait_full_jitter(mocker, mqtt):
+    client, _ = mqtt
+    uniform = mocker.patch("upparat.mqtt.random.uniform", return_value=0)
+    client.reconnect_delay_set(1, 4)
+
+    for _ in range(4):
+        client._reconnect_wait()
+
+    assert uniform.call_args_list == [
+        mocker.call(0, 1),
+        mocker.call(0, 2),
+        mocker.call(0, 4),
+        mocker.call(0, 4),
+    ]
+
+
+def test_reconnect_wait_interrupted_by_disconnect(mocker, mqtt):
+    client, _ = mqtt
+    mocker.patch("upparat.mqtt.random.uniform", return_value=60)
+    sleep = mocker.patch("upparat.mqtt.time.sleep")
+
+    client.disconnect()
+    client._reconnect_wait()
+    assert sleep.call_count == 0
+
+
+def test_reconnect_endpoints(mocker):
+    endpoints = mocker.Mock(ssl_contexts={"aws": "context"})
+    endpoints.select.return_value = Endpoint("aws", "iot.amazonaws.com", 8883)
+    reconnect = mocker.patch("paho.mqtt.client.Client.reconnect")
+    client = MQTT("_", Queue(), endpoints=endpoints)
+
+    client.reconnect()
+
+    assert (client._host, client._port) == ("iot.amazonaws.com", 8883)
+    assert client._ssl_context == "context"
+    assert client._ssl
+    assert reconnect.call_count == 1
+
+    client.on_connect(None, None, None, CONNACK_ACCEPTED)
+    endpoints.connected.assert_called_once_with()
+
+    # Connect failed, the next reconnect might fail over
+    reconnect.side_effect = ConnectionRefusedError
+    with pytest.raises(ConnectionRefusedError):
+        client.reconnect()
+    endpoints.failed.assert_called_once_with()
+
+
+def test_adaptive_keepalive(mocker):
+    health = ConnectionHealth(30, 300, 10)
+    mocker.patch("paho.mqtt.client.Client.reconnect")
+    mocker.patch("paho.mqtt.client.Client.loop_misc")
+    client = MQTT("_", Queue(), health=health)
+    client._sock = mocker.Mock()
+
+    # CONNECT with the broker's deadline
+    client.set_job_active("thing", True)
+    client.reconnect()
+    assert client._keepalive == 300
+
+    client._state = mqtt_cs_connected
+    client.loop_misc()
+    assert client._keepalive == 30
+
+    client.set_job_active("thing", False)
+    client.loop_misc()
+    assert client._keepalive == 300
+
+
+def test_ping_rtt_degraded(mocker):
+    queue = Queue()
+    health = ConnectionHealth(30, 300, 10, degraded_pings=1)
+    client = MQTT("_", queue, health=health)
+    client._sock = mocker.Mock()
+    client._in_packet["remaining_length"] = 0
+
+    client._ping_t = time.monotonic() - 1
+    client._handle_pingresp()
+    assert not health.degraded
+
+    client._ping_t = time.monotonic() - 11
+    client._handle_pingresp()
+    assert health.degraded
+
+    assert client.loop_misc() == MQTT_ERR_CONN_LOST
+    assert client._sock is None
+    assert queue.get_nowait().name == MQTT_DISCONNECTED
+
+
+def test_on_connect_session_present(mocker, mqtt):
+    client, queue = mqtt
+    client._clean_session = False
+    client._subscribe = mocker.Mock(return_value=(MQTT_ERR_SUCCESS, None))
+
+    client.subscribe("acknowledged")
+    client.on_subscribe(None, None, MID, None)
+    client.subscribe("pending")
+    queue.get_nowait()
+
+    client.on_disconnect(None, None, MQTT_ERR_NO_CONN)
+    assert client.is_subscribed("acknowledged")
+    client._subscribe.reset_mock()
+
+    # session resumed → only subscribe what the broker hasn't acknowledged
+    client.on_connect(None, None, {"session present": 1}, CONNACK_ACCEPTED)
+    client._subscribe.assert_called_once_with([("pending", 0)], qos=0, mid=MID)
+
+    queue.get_nowait()
+    event = queue.get_nowait()
+    assert event.name == MQTT_CONNECTED
+    assert event.cargo == {MQTT_EVENT_SESSION_PRESENT: True}
+
+    # session lost → subscribe everything again
+    client._subscribe.reset_mock()
+    client.on_connect(None, None, {"session present": 0}, CONNACK_ACCEPTED)
+    assert not client.is_subscribed("acknowledged")
+    client._subscribe.assert_called_once_with(
+        [("acknowledged", 0), ("pending", 0)], qos=0, mid=MID
+    )
+
+
 def test_on_message(mocker, mqtt):
     client, queue = mqtt
 
     message = mocker.Mock()
     message.topic = "topic"
-    message.payload = "o/"
+    message.payload = b'{"o": "/"}'
 
     client.on_message(None, None, message)
 
@@ -194,11 +393,128 @@ def test_on_message(mocker, mqtt):
     event = queue.get_nowait()
     assert event.name == MQTT_MESSAGE_RECEIVED
     assert event.cargo == {
-        MQTT_EVENT_PAYLOAD: message.payload,
+        MQTT_EVENT_PAYLOAD: {"o": "/"},
         MQTT_EVENT_TOPIC: message.topic,
+        MQTT_EVENT_JOB_TOPIC: None,
+        MQTT_EVENT_JOB_ID: None,
     }
 
 
+def test_on_message_classified(mocker):
+    queue = Queue()
+    client = MQTT("_", queue, topic_index=JobTopicIndex("thing"))
+
+    message = mocker.Mock()
+    message.topic = "$aws/things/thing/jobs/upparat_1/get/accepted"
+    message.payload = b"{}"
+
+    client.on_message(None, None, message)
+
+    event = queue.get_nowait()
+    assert event.cargo[MQTT_EVENT_JOB_TOPIC] == JobTopic.DESCRIBE_ACCEPTED
+    assert event.cargo[MQTT_EVENT_JOB_ID] == "upparat_1"
+
+
+def test_on_message_invalid_json(mocker, mqtt):
+    client, queue = mqtt
+
+    message = mocker.Mock()
+    message.topic = "topic"
+    message.payload = b"o/"
+
+    client.on_message(None, None, message)
+
+    assert queue.empty()
+
+
+def job_message(mocker, client, levels, payload, thing_name="thing"):
+    message = mocker.Mock()
+    message.topic = f"$aws/things/{thing_name}/jobs/{levels}"
+    message.payload = dumps(payload)
+    client.on_message(None, None, message)
+
+
+def messages_dropped():
+    return metrics.snapshot().get(MQTT_MESSAGES_DROPPED, 0)
+
+
+def test_on_message_not_routed(mocker):
+    queue = Queue()
+    client = MQTT("_", queue, topic_index=JobTopicIndex("thing"))
+    client.set_routes({JobTopic.GET_ACCEPTED}, "thing")
+    dropped = messages_dropped()
+
+    job_message(mocker, client, "upparat_1/get/accepted", {})
+    job_message(mocker, client, "notify-next", {})
+    assert messages_dropped() == dropped + 2
+
+    job_message(mocker, client, "get/accepted", {})
+    assert queue.get_nowait().cargo[MQTT_EVENT_JOB_TOPIC] == JobTopic.GET_ACCEPTED
+    assert queue.empty()
+
+
+def test_on_message_routes_per_thing(mocker):
+    queue = Queue()
+    client = MQTT("_", queue, topic_index=JobTopicIndex("a", "b"))
+    client.set_routes({JobTopic.NOTIFY}, "a")
+    client.set_routes({JobTopic.GET_ACCEPTED}, "b")
+
+    job_message(mocker, client, "notify", {}, thing_name="a")
+    job_message(mocker, client, "notify", {}, thing_name="b")
+    job_message(mocker, client, "get/accepted", {}, thing_name="b")
+
+    topics = [queue.get_nowait().cargo[MQTT_EVENT_TOPIC] for _ in range(2)]
+    assert topics == ["$aws/things/a/jobs/notify", "$aws/things/b/jobs/get/accepted"]
+    assert queue.empty()
+
+
+def test_on_message_other_jobs(mocker):
+    queue = Queue()
+    client = MQTT("_", queue, topic_index=JobTopicIndex("thing"))
+    dropped = messages_dropped()
+
+    job_message(mocker, client, "other_1/get/accepted", {})
+    job_message(mocker, client, "notify-next", {})
+    job_message(mocker, client, "notify-next", {"execution": {"jobId": "other_1"}})
+    assert queue.empty()
+    assert messages_dropped() == dropped + 3
+
+    job_message(mocker, client, "$next/get/accepted", {})
+    job_message(mocker, client, "notify-next", {"execution": {"jobId": "upparat_1"}})
+    assert queue.qsize() == 2
+
+
+def test_on_message_notify_folded(mocker):
+    queue = Queue()
+    client = MQTT("_", queue, topic_index=JobTopicIndex("thing"))
+    dropped = messages_dropped()
+
+    upparat_job = {"jobId": "upparat_1"}
+    job_message(
+        mocker,
+        client,
+        "notify",
+        {"jobs": {"QUEUED": [upparat_job, {"jobId": "other_1"}]}},
+    )
+    event = queue.get_nowait()
+    assert event.cargo[MQTT_EVENT_PAYLOAD] == {"jobs": {"QUEUED": [upparat_job]}}
+
+    # only other jobs changed
+    job_message(mocker, client, "notify", {"jobs": {"QUEUED": [upparat_job]}})
+    assert queue.empty()
+    assert messages_dropped() == dropped + 1
+
+    # a new state gets the next notification
+    client.set_routes({JobTopic.NOTIFY}, "thing")
+    job_message(mocker, client, "notify", {"jobs": {"QUEUED": [upparat_job]}})
+    assert queue.qsize() == 1
+
+    # so does a reconnected client
+    client.on_disconnect(None, None, MQTT_ERR_SUCCESS)
+    job_message(mocker, client, "notify", {"jobs": {"QUEUED": [upparat_job]}})
+    assert queue.qsize() == 3
+
+
 def test_on_subscribe(mocker, mqtt):
     client, queue = mqtt
     client._subscribe = mocker.Mock(return_value=(MQTT_ERR_SUCCESS, None))
@@ -217,6 +533,65 @@ def test_on_subscribe(mocker, mqtt):
     assert event.cargo == {MQTT_EVENT_TOPIC: topic}
 
 
+def test_expire_mids(mocker, mqtt):
+    client, queue = mqtt
+    subscribe_timeouts = metrics.snapshot().get(MQTT_SUBSCRIBE_TIMEOUTS, 0)
+    unsubscribe_timeouts = metrics.snapshot().get(MQTT_UNSUBSCRIBE_TIMEOUTS, 0)
+    client._subscribe = mocker.Mock(return_value=(MQTT_ERR_SUCCESS, None))
+    client._unsubscribe = mocker.Mock(return_value=(MQTT_ERR_SUCCESS, None))
+    monotonic = mocker.patch("upparat.mqtt.time.monotonic", return_value=100)
+
+    client._mid_generate.side_effect = [1, 2, 3]
+    client.subscribe([("a", 1), ("b", 0)])
+    client.subscribe("c")
+    client.unsubscribe("c")
+
+    assert metrics.snapshot()[MQTT_SUBSCRIBES_PENDING] == 2
+
+    # not yet
+    monotonic.return_value = 129
+    client.loop_misc()
+    assert len(client._subscription_mid) == 2
+    assert queue.empty()
+
+    monotonic.return_value = 131
+    client.loop_misc()
+    assert len(client._subscription_mid) == 0
+    assert len(client._unsubscription_mid) == 0
+
+    # c is not wanted anymore
+    events = [queue.get_nowait() for _ in range(2)]
+    assert queue.empty()
+    assert [event.name for event in events] == [MQTT_SUBSCRIBE_TIMEOUT] * 2
+    assert [event.cargo for event in events] == [
+        {MQTT_EVENT_TOPIC: "a", MQTT_EVENT_QOS: 1},
+        {MQTT_EVENT_TOPIC: "b", MQTT_EVENT_QOS: 0},
+    ]
+
+    snapshot = metrics.snapshot()
+    assert snapshot[MQTT_SUBSCRIBES_PENDING] == 0
+    assert snapshot[MQTT_SUBSCRIBE_TIMEOUTS] == subscribe_timeouts + 2
+    assert snapshot[MQTT_UNSUBSCRIBE_TIMEOUTS] == unsubscribe_timeouts + 1
+
+
+def test_on_disconnect_drops_mids(mocker, mqtt):
+    client, _ = mqtt
+    client._subscribe = mocker.Mock(return_value=(MQTT_ERR_SUCCESS, None))
+    client._unsubscribe = mocker.Mock(return_value=(MQTT_ERR_SUCCESS, None))
+
+    client.subscribe("a")
+    client.unsubscribe("b")
+
+    client.on_disconnect(None, None, MQTT_ERR_NO_CONN)
+    assert len(client._subscription_mid) == 0
+    assert len(client._unsubscription_mid) == 0
+
+    # still subscribed again on connect
+    client._subscribe.reset_mock()
+    client.on_connect(None, None, None, CONNACK_ACCEPTED)
+    client._subscribe.assert_called_once_with([("a", 0)], qos=0, mid=MID)
+
+
 def test_on_unsubscribe(mocker, mqtt):
     client, queue = mqtt
     client._unsubscribe = mocker.Mock(return_value=(MQTT_ERR_SUCCESS, None))
@@ -236,3 +611,232 @@ def test_on_unsubscribe(mocker, mqtt):
 
     # check subscription state
     assert len(client._unsubscription_mid) == 0
+
+
+def test_is_subscribed(mocker, mqtt):
+    client, queue = mqtt
+    client._subscribe = mocker.Mock(return_value=(MQTT_ERR_SUCCESS, None))
+
+    topic = "topic"
+    client.subscribe(topic)
+    assert not client.is_subscribed(topic)
+
+    # acknowledged by the broker
+    client.on_subscribe(None, None, MID, None)
+    assert client.is_subscribed(topic)
+
+    # needs to be acknowledged again after a reconnect
+    client.on_disconnect(None, None, MQTT_ERR_NO_CONN)
+    assert not client.is_subscribed(topic)
+    assert client._subscriptions[topic] == 0
+
+
+UPDATE_TOPIC = "$aws/things/bobby/jobs/upparat_1/update"
+UPDATE_RESPONSE_FILTER = "$aws/things/bobby/jobs/+/update/+"
+
+
+@pytest.fixture
+def mqtt_outbox(mocker, tmpdir):
+    outbox = Outbox(
+        tmpdir / "outbox.sqlite",
+        "$aws/things/bobby/jobs/+/update",
+        UPDATE_RESPONSE_FILTER,
+    )
+    client = MQTT(
+        "_",
+        Queue(),
+        topic_index=JobTopicIndex("bobby"),
+        outbox=outbox,
+        max_inflight_updates=2,
+    )
+    client._subscribed.add(UPDATE_RESPONSE_FILTER)
+
+    publish = mocker.patch("paho.mqtt.client.Client.publish")
+    publish.return_value.mid = MID
+
+    mocker.patch("upparat.mqtt.uuid.uuid4").return_value.hex = "token"
+
+    return client, outbox, publish
+
+
+def update_response(mocker, client, response, client_token, job_id="upparat_1"):
+    message = mocker.Mock()
+    message.topic = f"$aws/things/bobby/jobs/{job_id}/update/{response}"
+    message.payload = dumps({"clientToken": client_token})
+    client.on_message(None, None, message)
+
+
+def test_publish_outbox(mocker, mqtt_outbox):
+    client, outbox, publish = mqtt_outbox
+
+    info = client.publish(UPDATE_TOPIC, dumps({"status": "SUCCEEDED"}))
+    assert info.rc == MQTT_ERR_SUCCESS
+
+    # sent at QoS 1 with a client token
+    payload = dumps({"status": "SUCCEEDED", "clientToken": "token"})
+    publish.assert_called_once_with(UPDATE_TOPIC, payload, qos=1)
+    assert len(outbox) == 1
+
+    # PUBACK → still waiting for the response
+    client.on_publish(None, None, MID)
+    assert len(outbox) == 1
+
+    update_response(mocker, client, "accepted", "token")
+    assert len(outbox) == 0
+    assert not client._inflight
+
+
+def test_publish_outbox_rejected(mocker, mqtt_outbox):
+    client, outbox, publish = mqtt_outbox
+
+    client.publish(UPDATE_TOPIC, dumps({"status": "SUCCEEDED"}))
+    update_response(mocker, client, "rejected", "token")
+
+    # retrying won't help
+    assert len(outbox) == 0
+
+
+def test_publish_outbox_unknown_response(mocker, mqtt_outbox):
+    client, outbox, publish = mqtt_outbox
+
+    client.publish(UPDATE_TOPIC, dumps({"status": "SUCCEEDED"}))
+    update_response(mocker, client, "accepted", "other")
+
+    assert len(outbox) == 1
+    assert client._queue.empty()
+
+
+def test_publish_outbox_inflight_window(mocker, mqtt_outbox):
+    client, outbox, publish = mqtt_outbox
+    tokens = mocker.patch("upparat.mqtt.uuid.uuid4")
+
+    for job in range(1, 4):
+        tokens.return_value.hex = f"token_{job}"
+        client.publish(f"$aws/things/bobby/jobs/upparat_{job}/update", "{}")
+
+    # window is full
+    assert publish.call_count == 2
+    assert len(outbox) == 3
+
+    update_response(mocker, client, "accepted", "token_1")
+
+    assert publish.call_count == 3
+    assert publish.call_args == mocker.call(
+        "$aws/things/bobby/jobs/upparat_3/update",
+        dumps({"clientToken": "token_3"}),
+        qos=1,
+    )
+
+
+def test_publish_outbox_one_update_per_job(mocker, mqtt_outbox):
+    client, outbox, publish = mqtt_outbox
+    tokens = mocker.patch("upparat.mqtt.uuid.uuid4")
+
+    tokens.return_value.hex = "token_1"
+    client.publish(UPDATE_TOPIC, dumps({"status": "IN_PROGRESS"}))
+    tokens.return_value.hex = "token_2"
+    client.publish(UPDATE_TOPIC, dumps({"status": "SUCCEEDED"}))
+
+    # the update in flight got replaced, send the last one afterwards
+    assert publish.call_count == 1
+    update_response(mocker, client, "accepted", "token_1")
+
+    assert publish.call_count == 2
+    assert len(outbox) == 1
+    update_response(mocker, client, "accepted", "token_2")
+    assert len(outbox) == 0
+
+
+def test_publish_outbox_not_subscribed(mqtt_outbox):
+    client, outbox, publish = mqtt_outbox
+    client._subscribed.clear()
+
+    client.publish(UPDATE_TOPIC, "{}")
+
+    # wait for the subscription to the responses
+    assert publish.call_count == 0
+    assert len(outbox) == 1
+
+    mid = client._mid_generate()
+    client._subscription_mid[mid] = ([UPDATE_RESPONSE_FILTER], time.monotonic())
+    client.on_subscribe(None, None, mid, None)
+
+    assert publish.call_count == 1
+
+
+def test_publish_not_in_outbox(mqtt_outbox):
+    client, outbox, publish = mqtt_outbox
+
+    client.publish("$aws/things/bobby/jobs/get", "payload")
+
+    publish.assert_called_once_with("$aws/things/bobby/jobs/get", "payload", 0, False)
+    assert len(outbox) == 0
+
+
+def test_replay_outbox_on_connect(mocker, mqtt_outbox):
+    client, outbox, publish = mqtt_outbox
+
+    outbox.put(UPDATE_TOPIC, "progress", "token_1")
+    outbox.put(UPDATE_TOPIC, "succeeded", "token_2")
+
+    # not connected yet
+    client.on_connect(None, None, None, CONNACK_REFUSED_SERVER_UNAVAILABLE)
+    assert publish.call_count == 0
+
+    client.on_connect(None, None, None, CONNACK_ACCEPTED)
+    assert publish.call_count == 0
+
+    # wait for the new subscription to the responses
+    mid = client._mid_generate()
+    client._subscription_mid[mid] = ([UPDATE_RESPONSE_FILTER], time.monotonic())
+    client.on_subscribe(None, None, mid, None)
+    publish.assert_called_once_with(UPDATE_TOPIC, "succeeded", qos=1)
+
+    update_response(mocker, client, "accepted", "token_2")
+    assert len(outbox) == 0
+
+
+def test_resume_outbox_on_session_present(mocker, mqtt_outbox):
+    client, outbox, publish = mqtt_outbox
+    client._clean_session = False
+
+    client.publish(UPDATE_TOPIC, "{}")
+    assert publish.call_count == 1
+
+    client.on_disconnect(None, None, MQTT_ERR_NO_CONN)
+    client.on_connect(None, None, {"session present": 1}, CONNACK_ACCEPTED)
+
+    # in flight, the response is queued by the broker
+    assert publish.call_count == 1
+
+    update_response(mocker, client, "accepted", "token")
+    assert len(outbox) == 0
+
+
+def test_publish_outbox_per_thing(mocker, tmpdir):
+    outbox = Outbox(
+        tmpdir / "outbox.sqlite",
+        "$aws/things/+/jobs/+/update",
+        "$aws/things/+/jobs/+/update/+",
+    )
+    client = MQTT("_", Queue(), outbox=outbox)
+    client._subscribed.add("$aws/things/a/jobs/+/update/+")
+
+    publish = mocker.patch("paho.mqtt.client.Client.publish")
+    publish.return_value.mid = MID
+
+    client.publish("$aws/things/a/jobs/upparat_1/update", "{}")
+    client.publish("$aws/things/b/jobs/upparat_1/update", "{}")
+
+    # b waits for the subscription to its responses
+    assert publish.call_count == 1
+    assert len(outbox) == 2
+
+    mid = client._mid_generate()
+    client._subscription_mid[mid] = (
+        ["$aws/things/b/jobs/+/update/+"],
+        time.monotonic(),
+    )
+    client.on_subscribe(None, None, mid, None)
+
+    assert publish.call_count == 2
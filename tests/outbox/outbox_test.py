@@ -0,0 +1,70 @@
+import pytest
+
+from upparat.outbox import Outbox
+
+TOPIC_FILTER = "$aws/things/bobby/jobs/+/update"
+RESPONSE_FILTER = "$aws/things/bobby/jobs/+/update/+"
+TOPIC_1 = "$aws/things/bobby/jobs/upparat_1/update"
+TOPIC_2 = "$aws/things/bobby/jobs/upparat_2/update"
+
+
+@pytest.fixture
+def outbox(tmpdir):
+    return Outbox(tmpdir / "outbox.sqlite", TOPIC_FILTER, RESPONSE_FILTER)
+
+
+def pending(outbox):
+    return [(topic, payload, token) for topic, payload, token, _ in outbox.pending()]
+
+
+def test_accepts(outbox):
+    assert outbox.accepts(TOPIC_1)
+    assert not outbox.accepts("$aws/things/bobby/jobs/get")
+
+
+def test_last_value_wins(outbox):
+    outbox.put(TOPIC_1, "progress", "token_1")
+    outbox.put(TOPIC_2, "progress", "token_2")
+    outbox.put(TOPIC_1, "succeeded", "token_3")
+
+    assert len(outbox) == 2
+    assert pending(outbox) == [
+        (TOPIC_2, "progress", "token_2"),
+        (TOPIC_1, "succeeded", "token_3"),
+    ]
+
+
+def test_delivered(mocker, outbox):
+    mocker.patch("upparat.outbox.time.time", return_value=42.0)
+    outbox.put(TOPIC_1, "progress", "token_1")
+
+    assert outbox.delivered(TOPIC_1, "token_1") == 42.0
+    assert outbox.pending() == []
+
+
+def test_delivered_replaced(mocker, outbox):
+    time = mocker.patch("upparat.outbox.time.time", return_value=42.0)
+    outbox.put(TOPIC_1, "progress", "token_1")
+
+    time.return_value = 43.0
+    outbox.put(TOPIC_1, "succeeded", "token_2")
+
+    # newer message must not be removed
+    assert outbox.delivered(TOPIC_1, "token_1") is None
+    assert pending(outbox) == [(TOPIC_1, "succeeded", "token_2")]
+
+    # but behind since the first message
+    assert outbox.delivered(TOPIC_1, "token_2") == 42.0
+
+
+def test_persistent(tmpdir, outbox):
+    outbox.put(TOPIC_1, "succeeded", "token_1")
+
+    # e.g. after a restart
+    restored = Outbox(tmpdir / "outbox.sqlite", TOPIC_FILTER, RESPONSE_FILTER)
+    restored.put(TOPIC_2, "progress", "token_2")
+
+    assert pending(restored) == [
+        (TOPIC_1, "succeeded", "token_1"),
+        (TOPIC_2, "progress", "token_2"),
+    ]
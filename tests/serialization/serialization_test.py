@@ -0,0 +1,31 @@
+import json
+
+import pytest
+
+from upparat import serialization
+
+PAYLOAD = {"status": "IN_PROGRESS", "statusDetails": {"state": "ü", "message": None}}
+
+
+@pytest.fixture(params=["orjson", "json"])
+def backend(request, mocker):
+    if request.param == "json":
+        mocker.patch.object(serialization, "orjson", None)
+    elif not serialization.orjson:
+        pytest.skip("orjson not installed")
+
+
+def test_dumps(backend):
+    encoded = serialization.dumps(PAYLOAD)
+    assert isinstance(encoded, str)
+    assert json.loads(encoded) == PAYLOAD
+
+
+@pytest.mark.parametrize("data", [json.dumps(PAYLOAD), json.dumps(PAYLOAD).encode()])
+def test_loads(backend, data):
+    assert serialization.loads(data) == PAYLOAD
+
+
+def test_loads_invalid(backend):
+    with pytest.raises(ValueError):
+        serialization.loads(b"o/")
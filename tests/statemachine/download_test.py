@@ -1,5 +1,8 @@
-import json
+import functools
+import http.server
+import itertools
 import socket
+import threading
 from http.client import RemoteDisconnected
 from pathlib import Path
 from queue import Queue
@@ -7,6 +10,7 @@ from urllib.error import HTTPError
 from urllib.error import URLError
 
 import pytest
+from pysm import Event
 
 from ..utils import create_hook_event  # noqa: F401
 from ..utils import create_mqtt_message_event  # noqa: F401
@@ -17,14 +21,30 @@ from upparat.events import DOWNLOAD_INTERRUPTED
 from upparat.events import HOOK_STATUS_COMPLETED
 from upparat.events import HOOK_STATUS_FAILED
 from upparat.events import HOOK_STATUS_TIMED_OUT
+from upparat.events import JOB
+from upparat.events import MQTT_CONNECTED
+from upparat.events import MQTT_EVENT_SESSION_PRESENT
+from upparat.events import MQTT_MESSAGE_RECEIVED
+from upparat.events import THING_NAME
+from upparat.jobs import get_pending_job_executions
 from upparat.jobs import Job
 from upparat.jobs import JobFailedStatus
 from upparat.jobs import JobProgressStatus
 from upparat.jobs import JobStatus
+from upparat.serialization import dumps
 from upparat.statemachine import UpparatStateMachine
 from upparat.statemachine.download import DownloadState
+from upparat.statemachine.download import Prefetch
+from upparat.statemachine.download import SharedDownload
 
 TIMEOUT = 1.5
+# Spawning the download process imports upparat first
+PROCESS_TIMEOUT = 15
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *_):
+        pass
 
 
 def create_http_error(status):
@@ -212,7 +232,7 @@ def test_download_job_progress_updates(mocker, download_state, urllib_urlopen_mo
     assert mqtt_client.publish.call_args_list == [
         mocker.call(
             expected_job_update_topic,
-            json.dumps(
+            dumps(
                 {
                     "status": JobStatus.IN_PROGRESS.value,
                     "statusDetails": {
@@ -224,36 +244,36 @@ def test_download_job_progress_updates(mocker, download_state, urllib_urlopen_mo
         ),
         mocker.call(
             expected_job_update_topic,
-            json.dumps(
+            dumps(
                 {
                     "status": JobStatus.IN_PROGRESS.value,
                     "statusDetails": {
                         "state": JobProgressStatus.DOWNLOAD_PROGRESS.value,
-                        "message": json.dumps({"downloaded_bytes": 2}),
+                        "message": dumps({"downloaded_bytes": 2}),
                     },
                 }
             ),
         ),
         mocker.call(
             expected_job_update_topic,
-            json.dumps(
+            dumps(
                 {
                     "status": JobStatus.IN_PROGRESS.value,
                     "statusDetails": {
                         "state": JobProgressStatus.DOWNLOAD_PROGRESS.value,
-                        "message": json.dumps({"downloaded_bytes": 4}),
+                        "message": dumps({"downloaded_bytes": 4}),
                     },
                 }
             ),
         ),
         mocker.call(
             expected_job_update_topic,
-            json.dumps(
+            dumps(
                 {
                     "status": JobStatus.IN_PROGRESS.value,
                     "statusDetails": {
                         "state": JobProgressStatus.DOWNLOAD_PROGRESS.value,
-                        "message": json.dumps({"downloaded_bytes": 6}),
+                        "message": dumps({"downloaded_bytes": 6}),
                     },
                 }
             ),
@@ -308,7 +328,12 @@ def test_download_hook_completed(
     state.on_handle_hooks(None, hook_event)
 
     # run_hook should be called by on_enter
-    run_hook.assert_called_once_with(settings.hooks.download, inbox, args=[""])
+    run_hook.assert_called_once_with(
+        settings.hooks.download,
+        inbox,
+        args=[""],
+        thing_name=settings.broker.thing_name,
+    )
 
     # wait for download to complete
     event = inbox.get(timeout=TIMEOUT)
@@ -359,7 +384,12 @@ def test_download_hook_failures(
     state.on_handle_hooks(None, hook_event)
 
     # run_hook should be called by on_enter
-    run_hook.assert_called_once_with(settings.hooks.download, inbox, args=[""])
+    run_hook.assert_called_once_with(
+        settings.hooks.download,
+        inbox,
+        args=[""],
+        thing_name=settings.broker.thing_name,
+    )
 
     event = inbox.get(timeout=TIMEOUT)
     assert event.name == DOWNLOAD_INTERRUPTED
@@ -371,7 +401,7 @@ def test_download_hook_failures(
 
     mqtt_client.publish.assert_called_once_with(
         expected_job_update_topic,
-        json.dumps(
+        dumps(
             {
                 "status": JobStatus.FAILED.value,
                 "statusDetails": {
@@ -381,3 +411,239 @@ def test_download_hook_failures(
             }
         ),
     )
+
+
+def test_download_in_process(mocker, download_state, tmpdir_factory):
+    # A spawned process doesn't see our mocks, serve the artifact
+    served = tmpdir_factory.mktemp("served")
+    served.join("artifact").write("112233")
+    handler = functools.partial(QuietHandler, directory=str(served))
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    state, inbox, mqtt_client, _, _ = download_state
+    state.job.file_url = f"http://127.0.0.1:{server.server_address[1]}/artifact"
+    settings.service.download_worker = "process"
+
+    try:
+        state.on_enter(None, None)
+
+        # completion is forwarded from the process over the pipe
+        event = inbox.get(timeout=PROCESS_TIMEOUT)
+        assert event.name == DOWNLOAD_COMPLETED
+        assert event.cargo["job"].id_ == state.job.id_
+    finally:
+        settings.service.download_worker = "thread"
+        server.shutdown()
+
+    with open(state.job.filepath, "r") as fd:
+        assert fd.read() == "112233"
+
+    # download start + progress update forwarded from the process
+    assert mqtt_client.publish.call_count == 2
+
+
+def test_shared_download(mocker, download_state, urllib_urlopen_mock):
+    joined = threading.Event()
+    chunks = iter([b"11", b"22", b""])
+
+    def read(_):
+        joined.wait(TIMEOUT)
+        return next(chunks)
+
+    urlopen_mock = urllib_urlopen_mock(read)
+    mocker.patch("urllib.request.urlopen", urlopen_mock)
+
+    state, inbox, mqtt_client, _, _ = download_state
+
+    # another thing of the gateway processing the same job
+    other_state = DownloadState()
+    other_state.job = Job(
+        id_=state.job.id_,
+        status=JobStatus.QUEUED,
+        file_url=state.job.file_url,
+        version=state.job.version,
+        force=False,
+        meta="",
+        status_details="",
+    )
+    other_inbox = Queue()
+    other_statemachine = UpparatStateMachine(
+        inbox=other_inbox, mqtt_client=mqtt_client, thing_name="other"
+    )
+    other_statemachine.add_state(other_state)
+
+    state.on_enter(None, None)
+    other_state.on_enter(None, None)
+    joined.set()
+
+    event = inbox.get(timeout=TIMEOUT)
+    other_event = other_inbox.get(timeout=TIMEOUT)
+
+    assert event.name == other_event.name == DOWNLOAD_COMPLETED
+    assert other_event.cargo[JOB] is other_state.job
+    assert other_event.cargo[THING_NAME] == "other"
+
+    # downloaded once
+    assert urlopen_mock.call_count == 1
+    with open(state.job.filepath, "r") as fd:
+        assert fd.read() == "1122"
+
+
+def test_prefetch(mocker, download_state, urllib_urlopen_mock):
+    started = threading.Event()
+    joined = threading.Event()
+    chunks = iter([b"11", b"22", b""])
+
+    def read(_):
+        started.set()
+        joined.wait(TIMEOUT)
+        return next(chunks)
+
+    urlopen_mock = urllib_urlopen_mock(read)
+    mocker.patch("urllib.request.urlopen", urlopen_mock)
+
+    state, inbox, mqtt_client, _, _ = download_state
+    settings.service.prefetch_downloads = 1
+
+    try:
+        # still queued, the current job installs
+        assert Prefetch.start(state.job, "bobby")
+        assert Prefetch.start(state.job, "bobby")
+        other_job = Job(
+            "upparat_other", "QUEUED", "https://foo.bar/baz", "1", False, "", ""
+        )
+        assert not Prefetch.start(other_job, "bobby")
+        started.wait(TIMEOUT)
+
+        # the job is processed now, its download state takes over
+        state.on_enter(None, None)
+        assert not Prefetch.filepaths()
+        joined.set()
+
+        assert inbox.get(timeout=TIMEOUT).name == DOWNLOAD_COMPLETED
+    finally:
+        settings.service.prefetch_downloads = 0
+
+    # downloaded once
+    assert urlopen_mock.call_count == 1
+    with open(state.job.filepath, "r") as fd:
+        assert fd.read() == "1122"
+
+
+def wait_for_downloads():
+    for _ in range(100):
+        if not SharedDownload.downloads:
+            break
+        threading.Event().wait(TIMEOUT / 100)
+
+
+def test_prefetch_completed(mocker, download_state, urllib_urlopen_mock):
+    mocker.patch("urllib.request.urlopen", urllib_urlopen_mock())
+    state, inbox, mqtt_client, _, _ = download_state
+    settings.service.prefetch_downloads = 1
+
+    try:
+        assert Prefetch.start(state.job, "bobby")
+        wait_for_downloads()
+
+        # kept until the job is processed
+        assert Prefetch.filepaths() == {state.job.filepath}
+
+        # e.g. canceled meanwhile
+        Prefetch.queued("bobby", [])
+        assert not Prefetch.filepaths()
+    finally:
+        settings.service.prefetch_downloads = 0
+
+    with open(state.job.filepath, "r") as fd:
+        assert fd.read() == "some-bytessome-more-bytes"
+
+    # the job is still queued
+    assert inbox.empty()
+    assert mqtt_client.publish.call_count == 0
+
+
+def test_prefetched_artifacts_kept(mocker, download_state, urllib_urlopen_mock):
+    # one chunk per download
+    chunks = itertools.cycle([b"11", b""])
+    mocker.patch("urllib.request.urlopen", urllib_urlopen_mock(lambda _: next(chunks)))
+    state, inbox, _, _, _ = download_state
+    settings.service.prefetch_downloads = 2
+
+    next_job, later_job = [
+        Job(job_id, "QUEUED", "https://foo.bar/baz", "1", False, "", "")
+        for job_id in ["upparat_next", "upparat_later"]
+    ]
+
+    try:
+        for job in [next_job, later_job]:
+            assert Prefetch.start(job, "bobby")
+            wait_for_downloads()
+
+        # the next job is processed, the later one still queued
+        state.job = next_job
+        state.on_enter(None, None)
+        assert inbox.get(timeout=TIMEOUT).name == DOWNLOAD_COMPLETED
+        assert Prefetch.filepaths() == {later_job.filepath}
+        assert Path(later_job.filepath).exists()
+
+        # after a restart only the queued jobs are known
+        Prefetch.prefetches.clear()
+        Prefetch.queued("bobby", [later_job.id_])
+        state.clean_previous_downloads()
+        assert Path(later_job.filepath).exists()
+
+        Prefetch.queued("bobby", [])
+        state.clean_previous_downloads()
+        assert not Path(later_job.filepath).exists()
+    finally:
+        settings.service.prefetch_downloads = 0
+        Prefetch.prefetches.clear()
+        Prefetch.queued_job_ids.clear()
+
+
+def test_job_progress_skipped_while_offline(download_state):
+    state, _, mqtt_client, statemachine, _ = download_state
+
+    statemachine.online = False
+    state.job_progress(JobProgressStatus.DOWNLOAD_START.value)
+    assert mqtt_client.publish.call_count == 0
+
+    statemachine.online = True
+    state.job_progress(JobProgressStatus.DOWNLOAD_START.value)
+    assert mqtt_client.publish.call_count == 1
+
+
+def test_reconcile_job_on_connected(mocker, download_state):
+    state, _, mqtt_client, _, _ = download_state
+
+    # session resumed → notifications are delivered
+    state.handlers[MQTT_CONNECTED](
+        None, Event(MQTT_CONNECTED, **{MQTT_EVENT_SESSION_PRESENT: True})
+    )
+    assert mqtt_client.publish.call_count == 0
+
+    state.handlers[MQTT_CONNECTED](
+        None, Event(MQTT_CONNECTED, **{MQTT_EVENT_SESSION_PRESENT: False})
+    )
+    mqtt_client.publish.assert_called_once_with(
+        get_pending_job_executions(settings.broker.thing_name), qos=1
+    )
+
+
+def test_job_cancelled_on_reconcile(mocker, download_state, create_mqtt_message_event):
+    state, inbox, _, _, _ = download_state
+    topic = f"$aws/things/{settings.broker.thing_name}/jobs/get/accepted"
+
+    # still queued → keep going
+    event = create_mqtt_message_event(
+        topic, payload={"queuedJobs": [{"jobId": state.job.id_}]}
+    )
+    state.handlers[MQTT_MESSAGE_RECEIVED](None, event)
+    assert inbox.empty()
+
+    # gone → cancelled
+    event = create_mqtt_message_event(topic, payload={"queuedJobs": []})
+    state.handlers[MQTT_MESSAGE_RECEIVED](None, event)
+    assert inbox.get(timeout=TIMEOUT).name == DOWNLOAD_INTERRUPTED
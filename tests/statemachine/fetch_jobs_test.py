@@ -1,18 +1,24 @@
-from queue import Queue
-
 import pytest
+from pysm import Event
 
 from ..utils import create_mqtt_message_event  # noqa: F401
 from ..utils import create_mqtt_subscription_event  # noqa: F401
 from ..utils import generate_random_job_id
 from upparat.config import settings
+from upparat.events import ENTER
+from upparat.events import JOB_SELECTED
 from upparat.events import JOBS_AVAILABLE
+from upparat.events import MQTT_DISCONNECTED
 from upparat.events import MQTT_MESSAGE_RECEIVED
 from upparat.events import MQTT_SUBSCRIBED
 from upparat.events import NO_JOBS_PENDING
+from upparat.inbox import PriorityInbox
 from upparat.jobs import get_pending_job_executions_response
+from upparat.metrics import metrics
+from upparat.metrics import STATE_DEADLINES_EXPIRED
 from upparat.statemachine import UpparatStateMachine
 from upparat.statemachine.fetch_jobs import FetchJobsState
+from upparat.timers import Timers
 
 NON_UPPARAT_IN_PROGRESS_JOBS = [
     {"jobId": "non_upparat_job_in_progress_1"},
@@ -25,11 +31,19 @@ NON_UPPARAT_QUEUED_JOBS = [
 ]
 
 
+def create_job_execution(job_id, status="QUEUED"):
+    return {
+        "jobId": job_id,
+        "status": status,
+        "jobDocument": {"file": "http://foo.bar/baz.bin", "version": "1.0.1"},
+    }
+
+
 @pytest.fixture
 def fetch_jobs_state(mocker):
     state = FetchJobsState()
 
-    inbox = Queue()
+    inbox = PriorityInbox()
     mqtt_client = mocker.Mock()
 
     statemachine = UpparatStateMachine(inbox=inbox, mqtt_client=mqtt_client)
@@ -38,17 +52,35 @@ def fetch_jobs_state(mocker):
     return state, inbox, mqtt_client, statemachine
 
 
-def test_on_enter_subscribes(fetch_jobs_state):
+def test_on_enter_subscribed(fetch_jobs_state):
     state, _, mqtt_client, __ = fetch_jobs_state
+    mqtt_client.is_subscribed.return_value = True
 
     settings.broker.thing_name = "bobby"
     state.on_enter(None, None)
 
-    mqtt_client.subscribe.assert_called_once_with(
-        f"$aws/things/{settings.broker.thing_name}/jobs/get/+", qos=1
+    # subscriptions are persistent → publish right away
+    assert mqtt_client.subscribe.call_count == 0
+    mqtt_client.is_subscribed.assert_called_once_with(
+        f"$aws/things/{settings.broker.thing_name}/jobs/get/+"
+    )
+    mqtt_client.publish.assert_called_once_with(
+        f"$aws/things/{settings.broker.thing_name}/jobs/get", qos=1
     )
 
 
+def test_on_enter_not_yet_subscribed(fetch_jobs_state):
+    state, _, mqtt_client, __ = fetch_jobs_state
+    mqtt_client.is_subscribed.return_value = False
+
+    settings.broker.thing_name = "bobby"
+    state.on_enter(None, None)
+
+    # wait for the subscription → on_subscription
+    assert mqtt_client.subscribe.call_count == 0
+    assert mqtt_client.publish.call_count == 0
+
+
 def test_on_subscription_topic_match(fetch_jobs_state, create_mqtt_subscription_event):
     state, _, mqtt_client, __ = fetch_jobs_state
 
@@ -73,7 +105,7 @@ def test_on_message_no_pending_jobs(fetch_jobs_state, create_mqtt_message_event)
     settings.broker.thing_name = "bobby"
     state.on_enter(None, None)
 
-    topic = f"$aws/things/{settings.broker.thing_name}/jobs/get/+"
+    topic = f"$aws/things/{settings.broker.thing_name}/jobs/get/accepted"
 
     payload = {
         "queuedJobs": NON_UPPARAT_QUEUED_JOBS,
@@ -87,7 +119,10 @@ def test_on_message_no_pending_jobs(fetch_jobs_state, create_mqtt_message_event)
     assert published_event.name == NO_JOBS_PENDING
 
 
-def test_on_message_pending_queued_jobs(fetch_jobs_state, create_mqtt_message_event):
+def test_on_message_pending_queued_jobs(
+    mocker, fetch_jobs_state, create_mqtt_message_event
+):
+    prefetch = mocker.patch("upparat.statemachine.fetch_jobs.Prefetch")
     state, inbox, _, __ = fetch_jobs_state
 
     # prepare get_pending_job_executions_response
@@ -95,7 +130,7 @@ def test_on_message_pending_queued_jobs(fetch_jobs_state, create_mqtt_message_ev
     state.on_enter(None, None)
 
     queued_job = {"jobId": generate_random_job_id()}
-    topic = f"$aws/things/{settings.broker.thing_name}/jobs/get/+"
+    topic = f"$aws/things/{settings.broker.thing_name}/jobs/get/accepted"
 
     payload = {
         "queuedJobs": NON_UPPARAT_QUEUED_JOBS + [queued_job],
@@ -115,6 +150,9 @@ def test_on_message_pending_queued_jobs(fetch_jobs_state, create_mqtt_message_ev
     queued = published_event.cargo["job_execution_summaries"]["queued"]
     assert queued == [queued_job]
 
+    # their prefetched artifacts are kept
+    prefetch.queued.assert_called_once_with("bobby", [queued_job["jobId"]])
+
 
 def test_on_message_pending_progress_jobs(fetch_jobs_state, create_mqtt_message_event):
     state, inbox, _, __ = fetch_jobs_state
@@ -124,7 +162,7 @@ def test_on_message_pending_progress_jobs(fetch_jobs_state, create_mqtt_message_
     state.on_enter(None, None)
 
     progress_job = {"jobId": generate_random_job_id()}
-    topic = f"$aws/things/{settings.broker.thing_name}/jobs/get/+"
+    topic = f"$aws/things/{settings.broker.thing_name}/jobs/get/accepted"
 
     payload = {
         "queuedJobs": NON_UPPARAT_QUEUED_JOBS,
@@ -145,9 +183,172 @@ def test_on_message_pending_progress_jobs(fetch_jobs_state, create_mqtt_message_
     assert len(queued) == 0
 
 
+def test_on_enter_fast_job_selection(mocker, fetch_jobs_state):
+    state, _, mqtt_client, __ = fetch_jobs_state
+    mocker.patch.object(settings.service, "fast_job_selection", True)
+    mqtt_client.is_subscribed.return_value = True
+
+    settings.broker.thing_name = "bobby"
+    state.on_enter(None, None)
+
+    mqtt_client.is_subscribed.assert_called_once_with(
+        f"$aws/things/{settings.broker.thing_name}/jobs/+/get/+"
+    )
+    mqtt_client.publish.assert_called_once_with(
+        f"$aws/things/{settings.broker.thing_name}/jobs/$next/get", qos=1
+    )
+
+
+def test_on_enter_fast_job_selection_supersede_jobs(mocker, fetch_jobs_state):
+    state, _, mqtt_client, __ = fetch_jobs_state
+    mocker.patch.object(settings.service, "fast_job_selection", True)
+    mocker.patch.object(settings.service, "supersede_jobs", True)
+    mqtt_client.is_subscribed.return_value = True
+
+    settings.broker.thing_name = "bobby"
+    state.on_enter(None, None)
+
+    # all pending jobs are needed to find the newest
+    mqtt_client.publish.assert_called_once_with(
+        f"$aws/things/{settings.broker.thing_name}/jobs/get", qos=1
+    )
+
+
+def test_on_message_next_job_queued(
+    mocker, fetch_jobs_state, create_mqtt_message_event
+):
+    state, inbox, mqtt_client, __ = fetch_jobs_state
+    mocker.patch.object(settings.service, "fast_job_selection", True)
+
+    settings.broker.thing_name = "bobby"
+    state.on_enter(None, None)
+
+    job_id = generate_random_job_id()
+    topic = f"$aws/things/{settings.broker.thing_name}/jobs/$next/get/accepted"
+    payload = {"execution": create_job_execution(job_id)}
+
+    state.on_message(None, create_mqtt_message_event(topic, payload))
+
+    published_event = inbox.get_nowait()
+    assert published_event.name == JOB_SELECTED
+    assert published_event.cargo["job"].id_ == job_id
+
+
+@pytest.mark.parametrize(
+    "job_execution",
+    [
+        create_job_execution(generate_random_job_id(), status="IN_PROGRESS"),
+        create_job_execution("non_upparat_job_queued_3"),
+    ],
+)
+def test_on_message_next_job_needs_selection(
+    mocker, fetch_jobs_state, create_mqtt_message_event, job_execution
+):
+    state, inbox, mqtt_client, __ = fetch_jobs_state
+    mocker.patch.object(settings.service, "fast_job_selection", True)
+
+    settings.broker.thing_name = "bobby"
+    topic = f"$aws/things/{settings.broker.thing_name}/jobs/$next/get/accepted"
+    payload = {"execution": job_execution}
+
+    state.on_message(None, create_mqtt_message_event(topic, payload))
+
+    # fall back to the full job selection
+    assert inbox.empty()
+    mqtt_client.publish.assert_called_once_with(
+        f"$aws/things/{settings.broker.thing_name}/jobs/get", qos=1
+    )
+
+
+def test_on_message_next_job_none(mocker, fetch_jobs_state, create_mqtt_message_event):
+    state, inbox, _, __ = fetch_jobs_state
+    mocker.patch.object(settings.service, "fast_job_selection", True)
+
+    settings.broker.thing_name = "bobby"
+    topic = f"$aws/things/{settings.broker.thing_name}/jobs/$next/get/accepted"
+
+    state.on_message(None, create_mqtt_message_event(topic, {"timestamp": 1}))
+
+    published_event = inbox.get_nowait()
+    assert published_event.name == NO_JOBS_PENDING
+
+
 def test_event_handlers_handle_mqtt(fetch_jobs_state):
     state, _, __, ___ = fetch_jobs_state
     event_handlers = state.event_handlers()
 
     assert MQTT_SUBSCRIBED in event_handlers
     assert MQTT_MESSAGE_RECEIVED in event_handlers
+
+
+def test_deadline(mocker):
+    metrics.reset()
+    now = [0]
+    inbox = PriorityInbox(timers=Timers(lambda: now[0]))
+    mqtt_client = mocker.Mock()
+    mqtt_client.is_subscribed.return_value = False
+
+    statemachine = UpparatStateMachine(inbox=inbox, mqtt_client=mqtt_client)
+    statemachine.add_state(FetchJobsState(), initial=True)
+    statemachine.initialize()
+    statemachine.dispatch(Event(ENTER))
+
+    # The SUBACK never arrives
+    assert inbox.timers.timeout() == settings.broker.fetch_jobs_deadline == 30
+    assert mqtt_client.publish.call_count == 0
+
+    now[0] += 30
+    statemachine.dispatch(inbox.get_nowait())
+    assert mqtt_client.publish.call_count == 1
+    assert metrics.snapshot()[STATE_DEADLINES_EXPIRED.format("fetch_jobs")] == 1
+
+    # Backoff
+    assert inbox.timers.timeout() == 60
+
+    # Nothing to retry while offline
+    statemachine.dispatch(Event(MQTT_DISCONNECTED))
+    now[0] += 60
+    statemachine.dispatch(inbox.get_nowait())
+    assert mqtt_client.publish.call_count == 1
+    assert metrics.snapshot()[STATE_DEADLINES_EXPIRED.format("fetch_jobs")] == 1
+    assert inbox.timers.timeout() == 60
+
+
+def test_rejected_retry(mocker, create_mqtt_message_event):
+    now = [0]
+    inbox = PriorityInbox(timers=Timers(lambda: now[0]))
+    mqtt_client = mocker.Mock()
+    mqtt_client.is_subscribed.return_value = True
+
+    statemachine = UpparatStateMachine(inbox=inbox, mqtt_client=mqtt_client)
+    statemachine.add_state(FetchJobsState(), initial=True)
+    statemachine.initialize()
+    statemachine.dispatch(Event(ENTER))
+    assert mqtt_client.publish.call_count == 1
+
+    # Throttled → ask again later, backing off
+    rejected = create_mqtt_message_event(
+        f"$aws/things/{statemachine.thing_name}/jobs/get/rejected",
+        payload={"code": "Throttled", "message": "Rate exceeded"},
+    )
+    statemachine.dispatch(rejected)
+    assert inbox.empty()
+    assert inbox.timers.timeout() == 60
+
+    now[0] += 60
+    statemachine.dispatch(inbox.get_nowait())
+    assert mqtt_client.publish.call_count == 2
+
+
+def test_rejected_without_deadline(mocker, fetch_jobs_state, create_mqtt_message_event):
+    state, inbox, _, statemachine = fetch_jobs_state
+    mocker.patch.object(settings.broker, "fetch_jobs_deadline", 0)
+
+    state.on_message(
+        None,
+        create_mqtt_message_event(
+            f"$aws/things/{statemachine.thing_name}/jobs/get/rejected",
+            payload={"message": "Rate exceeded"},
+        ),
+    )
+    assert inbox.get_nowait().name == NO_JOBS_PENDING
@@ -1,9 +1,9 @@
-import json
 from queue import Queue
 
 import pytest
 
 from ..utils import create_hook_event  # noqa: F401
+from ..utils import create_mqtt_message_event  # noqa: F401
 from ..utils import generate_random_job_id
 from upparat.config import settings
 from upparat.events import HOOK
@@ -13,10 +13,12 @@ from upparat.events import HOOK_STATUS_OUTPUT
 from upparat.events import HOOK_STATUS_TIMED_OUT
 from upparat.events import INSTALLATION_DONE
 from upparat.events import INSTALLATION_INTERRUPTED
+from upparat.events import MQTT_MESSAGE_RECEIVED
 from upparat.jobs import Job
 from upparat.jobs import JobFailedStatus
 from upparat.jobs import JobProgressStatus
 from upparat.jobs import JobStatus
+from upparat.serialization import dumps
 from upparat.statemachine import UpparatStateMachine
 from upparat.statemachine.install import InstallState
 
@@ -62,7 +64,15 @@ def test_on_enter_missing_installation_hook(install_state):
 
     mqtt_client.publish.assert_called_once_with(
         f"$aws/things/{settings.broker.thing_name}/jobs/{JOB_.id_}/update",
-        '{"status": "SUCCEEDED", "statusDetails": {"state": "no_installation_hook_provided", "message": "none"}}',  # noqa
+        dumps(
+            {
+                "status": "SUCCEEDED",
+                "statusDetails": {
+                    "state": "no_installation_hook_provided",
+                    "message": "none",
+                },
+            }
+        ),
     )
 
 
@@ -76,11 +86,19 @@ def test_on_enter_installation_hook(install_state):
 
     mqtt_client.publish.assert_called_once_with(
         f"$aws/things/{settings.broker.thing_name}/jobs/{JOB_.id_}/update",
-        '{"status": "IN_PROGRESS", "statusDetails": {"state": "installation_start", "message": "none"}}',  # noqa
+        dumps(
+            {
+                "status": "IN_PROGRESS",
+                "statusDetails": {"state": "installation_start", "message": "none"},
+            }
+        ),
     )
 
     run_hook.assert_called_once_with(
-        settings.hooks.install, inbox, args=[JOB_.meta, JOB_.filepath]
+        settings.hooks.install,
+        inbox,
+        args=[JOB_.meta, JOB_.filepath],
+        thing_name=settings.broker.thing_name,
     )
 
 
@@ -118,7 +136,7 @@ def test_hook_completed(install_state, create_hook_event):
 
     mqtt_client.publish.assert_called_once_with(
         f"$aws/things/{settings.broker.thing_name}/jobs/{JOB_.id_}/update",
-        json.dumps(
+        dumps(
             {
                 "status": JobStatus.IN_PROGRESS.value,
                 "statusDetails": {
@@ -145,7 +163,7 @@ def test_hook_failed(install_state, create_hook_event):
 
     mqtt_client.publish.assert_called_once_with(
         f"$aws/things/{settings.broker.thing_name}/jobs/{JOB_.id_}/update",
-        json.dumps(
+        dumps(
             {
                 "status": JobStatus.FAILED.value,
                 "statusDetails": {
@@ -172,7 +190,7 @@ def test_hook_timedout(install_state, create_hook_event):
 
     mqtt_client.publish.assert_called_once_with(
         f"$aws/things/{settings.broker.thing_name}/jobs/{JOB_.id_}/update",
-        json.dumps(
+        dumps(
             {
                 "status": JobStatus.FAILED.value,
                 "statusDetails": {
@@ -189,3 +207,63 @@ def test_event_handlers_handle_hook(install_state):
     event_handlers = state.event_handlers()
 
     assert HOOK in event_handlers
+
+
+def test_prefetch_next_jobs(mocker, install_state, create_mqtt_message_event):
+    state, _, mqtt_client, _, _ = install_state
+    prefetch = mocker.patch("upparat.statemachine.install.Prefetch")
+
+    settings.hooks.install = "./install.sh"
+    settings.service.prefetch_downloads = 1
+    try:
+        state.on_enter(None, None)
+        mqtt_client.publish.assert_called_with("$aws/things/bobby/jobs/get", qos=1)
+
+        # the oldest queued upparat job after the one installing
+        state.handlers[MQTT_MESSAGE_RECEIVED](
+            None,
+            create_mqtt_message_event(
+                "$aws/things/bobby/jobs/get/accepted",
+                payload={
+                    "inProgressJobs": [{"jobId": JOB_.id_}],
+                    "queuedJobs": [
+                        {"jobId": "upparat_new", "queuedAt": 3},
+                        {"jobId": "other_old", "queuedAt": 1},
+                        {"jobId": "upparat_next", "queuedAt": 2},
+                    ],
+                },
+            ),
+        )
+        mqtt_client.publish.assert_called_with(
+            "$aws/things/bobby/jobs/upparat_next/get", qos=1
+        )
+
+        for job_id in ["upparat_new", "upparat_next"]:
+            state.handlers[MQTT_MESSAGE_RECEIVED](
+                None,
+                create_mqtt_message_event(
+                    f"$aws/things/bobby/jobs/{job_id}/get/accepted",
+                    payload={
+                        "execution": {
+                            "jobId": job_id,
+                            "status": "QUEUED",
+                            "jobDocument": {
+                                "file": "http://foo.bar/next.bin",
+                                "version": "1.0.1",
+                            },
+                        }
+                    },
+                ),
+            )
+    finally:
+        settings.hooks.install = None
+        settings.service.prefetch_downloads = 0
+
+    # the queued jobs keep their prefetched artifacts
+    prefetch.queued.assert_called_once_with("bobby", ["upparat_next", "upparat_new"])
+
+    (job, thing_name), _ = prefetch.start.call_args
+    assert prefetch.start.call_count == 1
+    assert thing_name == "bobby"
+    assert job.id_ == "upparat_next"
+    assert job.file_url == "http://foo.bar/next.bin"
@@ -6,6 +6,7 @@ from ..utils import create_mqtt_message_event  # noqa: F401
 from ..utils import create_mqtt_subscription_event  # noqa: F401
 from ..utils import generate_random_job_id
 from upparat.config import settings
+from upparat.events import JOB_SELECTED
 from upparat.events import JOBS_AVAILABLE
 from upparat.events import MQTT_MESSAGE_RECEIVED
 from upparat.statemachine import UpparatStateMachine
@@ -22,6 +23,14 @@ NON_UPPARAT_QUEUED_JOBS = [
 ]
 
 
+def create_job_execution(job_id, status="QUEUED"):
+    return {
+        "jobId": job_id,
+        "status": status,
+        "jobDocument": {"file": "http://foo.bar/baz.bin", "version": "1.0.1"},
+    }
+
+
 @pytest.fixture
 def monitor_state(mocker):
     state = MonitorState()
@@ -35,29 +44,17 @@ def monitor_state(mocker):
     return state, inbox, mqtt_client, statemachine
 
 
-def test_on_enter_subscribes(monitor_state):
+def test_on_enter_exit_no_subscription_churn(monitor_state):
     state, _, mqtt_client, __ = monitor_state
 
     settings.broker.thing_name = "bobby"
-    state.on_enter(None, None)
-
-    mqtt_client.subscribe.assert_called_once_with(
-        f"$aws/things/{settings.broker.thing_name}/jobs/notify", qos=1
-    )
 
-
-def test_on_exit_unsubscribes(monitor_state):
-    state, _, mqtt_client, __ = monitor_state
-
-    settings.broker.thing_name = "bobby"
-
-    # can only unsubscribe if we subscribed (on_enter)
+    # subscriptions are persistent
     state.on_enter(None, None)
     state.on_exit(None, None)
 
-    mqtt_client.unsubscribe.assert_called_once_with(
-        f"$aws/things/{settings.broker.thing_name}/jobs/notify"
-    )
+    assert mqtt_client.subscribe.call_count == 0
+    assert mqtt_client.unsubscribe.call_count == 0
 
 
 def test_on_message_no_pending_jobs(monitor_state, create_mqtt_message_event):
@@ -138,6 +135,69 @@ def test_on_message_pending_progress_jobs(monitor_state, create_mqtt_message_eve
     assert len(queued) == 0
 
 
+def test_on_message_notify_next_queued(
+    mocker, monitor_state, create_mqtt_message_event
+):
+    mocker.patch.object(settings.service, "fast_job_selection", True)
+    state, inbox, _, __ = monitor_state
+
+    settings.broker.thing_name = "bobby"
+
+    job_id = generate_random_job_id()
+    topic = f"$aws/things/{settings.broker.thing_name}/jobs/notify-next"
+    payload = {"execution": create_job_execution(job_id)}
+
+    state.on_message(None, create_mqtt_message_event(topic, payload))
+
+    published_event = inbox.get_nowait()
+    assert published_event.name == JOB_SELECTED
+    assert published_event.cargo["job"].id_ == job_id
+
+
+def test_on_message_notify_next_non_upparat(
+    mocker, monitor_state, create_mqtt_message_event
+):
+    mocker.patch.object(settings.service, "fast_job_selection", True)
+    state, inbox, _, __ = monitor_state
+
+    settings.broker.thing_name = "bobby"
+
+    topic = f"$aws/things/{settings.broker.thing_name}/jobs/notify-next"
+    payload = {"execution": create_job_execution("non_upparat_job_queued_3")}
+
+    state.on_message(None, create_mqtt_message_event(topic, payload))
+
+    # not for upparat
+    assert inbox.empty()
+
+
+@pytest.mark.parametrize(
+    "fast_job_selection, event_name",
+    [(True, JOB_SELECTED), (False, JOBS_AVAILABLE)],
+)
+def test_on_message_new_job_handled_once(
+    mocker, monitor_state, create_mqtt_message_event, fast_job_selection, event_name
+):
+    mocker.patch.object(settings.service, "fast_job_selection", fast_job_selection)
+    state, inbox, _, __ = monitor_state
+
+    settings.broker.thing_name = "bobby"
+    job_id = generate_random_job_id()
+
+    # a new job is notified on both topics, in any order
+    for topic, payload in [
+        ("notify", {"jobs": {"QUEUED": [{"jobId": job_id}]}}),
+        ("notify-next", {"execution": create_job_execution(job_id)}),
+    ]:
+        state.on_message(
+            None,
+            create_mqtt_message_event(f"$aws/things/bobby/jobs/{topic}", payload),
+        )
+
+    assert inbox.get_nowait().name == event_name
+    assert inbox.empty()
+
+
 def test_event_handlers_handle_mqtt(monitor_state):
     state, _, __, ___ = monitor_state
     event_handlers = state.event_handlers()
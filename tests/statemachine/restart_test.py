@@ -1,4 +1,3 @@
-import json
 from queue import Queue
 
 import pytest
@@ -16,6 +15,7 @@ from upparat.jobs import JobFailedStatus
 from upparat.jobs import JobProgressStatus
 from upparat.jobs import JobStatus
 from upparat.jobs import JobSuccessStatus
+from upparat.serialization import dumps
 from upparat.statemachine import UpparatStateMachine
 from upparat.statemachine.restart import RestartState
 
@@ -64,7 +64,15 @@ def test_on_enter_no_restart_hook(restart_state):
 
     mqtt_client.publish.assert_called_once_with(
         f"$aws/things/{settings.broker.thing_name}/jobs/{JOB_.id_}/update",
-        '{"status": "SUCCEEDED", "statusDetails": {"state": "no_restart_hook_provided", "message": "none"}}',  # noqa
+        dumps(
+            {
+                "status": "SUCCEEDED",
+                "statusDetails": {
+                    "state": "no_restart_hook_provided",
+                    "message": "none",
+                },
+            }
+        ),
     )
 
 
@@ -78,7 +86,7 @@ def test_on_enter_restart_hook(restart_state):
 
     mqtt_client.publish.assert_called_once_with(
         f"$aws/things/{settings.broker.thing_name}/jobs/{JOB_.id_}/update",
-        json.dumps(
+        dumps(
             {
                 "status": JobStatus.IN_PROGRESS.value,
                 "statusDetails": {
@@ -90,7 +98,10 @@ def test_on_enter_restart_hook(restart_state):
     )
 
     run_hook.assert_called_once_with(
-        settings.hooks.restart, inbox, args=[JOB_.meta, JOB_.force]
+        settings.hooks.restart,
+        inbox,
+        args=[JOB_.meta, JOB_.force],
+        thing_name=settings.broker.thing_name,
     )
 
 
@@ -118,7 +129,7 @@ def test_hook_completed(restart_state, create_hook_event):
 
     mqtt_client.publish.assert_called_once_with(
         f"$aws/things/{settings.broker.thing_name}/jobs/{JOB_.id_}/update",
-        json.dumps(
+        dumps(
             {
                 "status": JobStatus.SUCCEEDED.value,
                 "statusDetails": {
@@ -143,7 +154,7 @@ def test_hook_failed(restart_state, create_hook_event):
 
     mqtt_client.publish.assert_called_once_with(
         f"$aws/things/{settings.broker.thing_name}/jobs/{JOB_.id_}/update",
-        json.dumps(
+        dumps(
             {
                 "status": JobStatus.FAILED.value,
                 "statusDetails": {
@@ -168,7 +179,7 @@ def test_hook_timedout(restart_state, create_hook_event):
 
     mqtt_client.publish.assert_called_once_with(
         f"$aws/things/{settings.broker.thing_name}/jobs/{JOB_.id_}/update",
-        json.dumps(
+        dumps(
             {
                 "status": JobStatus.FAILED.value,
                 "statusDetails": {
@@ -1,6 +1,3 @@
-import json
-from queue import Queue
-
 import pytest
 
 from ..utils import create_mqtt_message_event  # noqa: F401
@@ -11,6 +8,7 @@ from upparat.events import JOB_SELECTED
 from upparat.events import MQTT_MESSAGE_RECEIVED
 from upparat.events import MQTT_SUBSCRIBED
 from upparat.events import SELECT_JOB_INTERRUPTED
+from upparat.inbox import PriorityInbox
 from upparat.jobs import describe_job_execution_response
 from upparat.jobs import Job
 from upparat.jobs import JOB_ACCEPTED
@@ -18,6 +16,7 @@ from upparat.jobs import JOB_MESSAGE
 from upparat.jobs import JOB_REJECTED
 from upparat.jobs import JobProgressStatus
 from upparat.jobs import JobStatus
+from upparat.serialization import dumps
 from upparat.statemachine import UpparatStateMachine
 from upparat.statemachine.select_job import SelectJobState
 
@@ -26,7 +25,7 @@ from upparat.statemachine.select_job import SelectJobState
 def select_job_state(mocker):
     state = SelectJobState()
 
-    inbox = Queue()
+    inbox = PriorityInbox()
     mqtt_client = mocker.Mock()
 
     statemachine = UpparatStateMachine(inbox=inbox, mqtt_client=mqtt_client)
@@ -79,10 +78,45 @@ def test_exactly_job_in_progress(select_job_state, create_enter_event, mocker):
     state.on_enter(None, event)
 
     assert state.current_job_id == job_id
-    # check that we subscribe, so that the
-    # job will eventually end up in prepare
-    mqtt_client.subscribe.assert_called_once_with(
-        f"$aws/things/{thing_name}/jobs/{job_id}/get/+", qos=1
+    # check that we describe the job, so that
+    # it will eventually end up in prepare
+    assert mqtt_client.subscribe.call_count == 0
+    mqtt_client.publish.assert_called_once_with(
+        f"$aws/things/{thing_name}/jobs/{job_id}/get", qos=1
+    )
+
+
+def test_exactly_job_in_progress_not_yet_subscribed(
+    select_job_state, create_enter_event, mocker
+):
+    state, _, mqtt_client, __ = select_job_state
+    mqtt_client.is_subscribed.return_value = False
+
+    job_id = generate_random_job_id()
+    settings.broker.thing_name = "bobby"
+
+    event = create_enter_event(jobs_queued=[], jobs_in_progress=[{"jobId": job_id}])
+
+    state.on_enter(None, event)
+
+    # wait for the subscription → on_subscription
+    assert state.current_job_id == job_id
+    assert mqtt_client.publish.call_count == 0
+
+
+def test_deadline_describe_again(select_job_state, create_enter_event, mocker):
+    state, inbox, mqtt_client, _ = select_job_state
+    mqtt_client.is_subscribed.return_value = False
+
+    job_id = generate_random_job_id()
+    event = create_enter_event(jobs_queued=[], jobs_in_progress=[{"jobId": job_id}])
+
+    state.on_enter(None, event)
+    assert inbox.timers.timeout() > 0
+
+    state.on_deadline(None, None)
+    mqtt_client.publish.assert_called_once_with(
+        f"$aws/things/{state.thing_name}/jobs/{job_id}/get", qos=1
     )
 
 
@@ -115,7 +149,7 @@ def test_more_than_one_job_in_progress(select_job_state, create_enter_event, moc
     assert mqtt_client.publish.call_args_list == [
         mocker.call(
             f"$aws/things/bobby/jobs/{job_id_1}/update",
-            json.dumps(
+            dumps(
                 {
                     "status": JobStatus.FAILED.value,
                     "statusDetails": {
@@ -127,7 +161,7 @@ def test_more_than_one_job_in_progress(select_job_state, create_enter_event, moc
         ),
         mocker.call(
             f"$aws/things/bobby/jobs/{job_id_2}/update",
-            json.dumps(
+            dumps(
                 {
                     "status": JobStatus.FAILED.value,
                     "statusDetails": {
@@ -260,7 +294,7 @@ def test_on_subscription_topic_match(select_job_state, create_mqtt_subscription_
     settings.broker.thing_name = "bobby"
     state.current_job_id = generate_random_job_id()
     state.describe_job_execution_response = describe_job_execution_response(
-        settings.broker.thing_name, state.current_job_id
+        settings.broker.thing_name, "+"
     )
 
     event = create_mqtt_subscription_event(state.describe_job_execution_response)
@@ -299,3 +333,135 @@ def test_event_handlers_handle_mqtt(select_job_state):
 
     assert MQTT_SUBSCRIBED in event_handlers
     assert MQTT_MESSAGE_RECEIVED in event_handlers
+
+
+def test_supersede_jobs(
+    mocker, select_job_state, create_enter_event, create_mqtt_message_event
+):
+    state, inbox, mqtt_client, __ = select_job_state
+    mocker.patch.object(settings.service, "supersede_jobs", True)
+    settings.broker.thing_name = "bobby"
+
+    versions = {
+        "upparat_1": "1.9.0",
+        "upparat_2": "1.9.5",
+        "upparat_3": "1.10.0",
+        # queued after the newest, e.g. a downgrade
+        "upparat_4": "1.2.0",
+    }
+
+    job_ids = list(versions) + ["upparat_5"]
+    event = create_enter_event(
+        jobs_queued=[
+            {"jobId": job_id, "queuedAt": queued_at}
+            for queued_at, job_id in enumerate(job_ids)
+        ],
+        jobs_in_progress=[],
+    )
+    state.on_enter(None, event)
+
+    # every queued job is described
+    assert [c[0][0] for c in mqtt_client.publish.call_args_list] == [
+        f"$aws/things/bobby/jobs/{job_id}/get" for job_id in job_ids
+    ]
+
+    for job_id, version in versions.items():
+        state.on_message(
+            None,
+            create_mqtt_message_event(
+                f"$aws/things/bobby/jobs/{job_id}/get/accepted",
+                payload={
+                    "execution": {
+                        "jobId": job_id,
+                        "status": "QUEUED",
+                        "jobDocument": {"file": "http://foo.bar", "version": version},
+                    }
+                },
+            ),
+        )
+
+    # waits for the missing description
+    assert inbox.empty()
+    mqtt_client.publish.reset_mock()
+    state.on_deadline(None, None)
+    mqtt_client.publish.assert_called_once_with(
+        "$aws/things/bobby/jobs/upparat_5/get", qos=1
+    )
+
+    # canceled meanwhile
+    state.on_message(
+        None,
+        create_mqtt_message_event(
+            "$aws/things/bobby/jobs/upparat_5/get/rejected",
+            payload={JOB_MESSAGE: "not found"},
+        ),
+    )
+
+    published_event = inbox.get_nowait()
+    assert published_event.name == JOB_SELECTED
+
+    # the others stay queued until the selected job succeeded
+    assert published_event.cargo["job"].id_ == "upparat_3"
+    assert mqtt_client.publish.call_count == 1
+
+
+def test_supersede_jobs_not_newer_than_succeeded(
+    mocker, select_job_state, create_enter_event, create_mqtt_message_event
+):
+    state, inbox, mqtt_client, statemachine = select_job_state
+    mocker.patch.object(settings.service, "supersede_jobs", True)
+    settings.broker.thing_name = "bobby"
+
+    statemachine.succeeded_job = Job(
+        "upparat_0", "SUCCEEDED", "http://foo.bar", "1.9.5", False, "", None
+    )
+    versions = {"upparat_1": "1.9.0", "upparat_2": "1.9.5", "upparat_3": "1.10.0"}
+
+    # also a single queued job is described
+    for job_ids in (["upparat_1"], list(versions)):
+        state.on_enter(
+            None,
+            create_enter_event(
+                jobs_queued=[
+                    {"jobId": job_id, "queuedAt": queued_at}
+                    for queued_at, job_id in enumerate(job_ids)
+                ],
+                jobs_in_progress=[],
+            ),
+        )
+        mqtt_client.publish.reset_mock()
+
+        for job_id in job_ids:
+            state.on_message(
+                None,
+                create_mqtt_message_event(
+                    f"$aws/things/bobby/jobs/{job_id}/get/accepted",
+                    payload={
+                        "execution": {
+                            "jobId": job_id,
+                            "status": "QUEUED",
+                            "jobDocument": {
+                                "file": "http://foo.bar",
+                                "version": versions[job_id],
+                            },
+                        }
+                    },
+                ),
+            )
+
+    # superseded right away, the newer one is selected
+    message = "Superseded by upparat_0 (version 1.9.5)"
+    assert mqtt_client.publish.call_args_list == [
+        mocker.call(
+            f"$aws/things/bobby/jobs/{job_id}/update",
+            dumps(
+                {
+                    "status": JobStatus.SUCCEEDED.value,
+                    "statusDetails": {"state": "superseded", "message": message},
+                }
+            ),
+        )
+        for job_id in ("upparat_1", "upparat_2")
+    ]
+    assert inbox.get_nowait().name == SELECT_JOB_INTERRUPTED
+    assert inbox.get_nowait().cargo["job"].id_ == "upparat_3"
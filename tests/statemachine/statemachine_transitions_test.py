@@ -2,21 +2,47 @@ from queue import Queue
 
 import pytest
 from pysm import Event
+from pysm import State
+from pysm import StateMachine
+from pysm.pysm import StateMachineException
 
+from ..utils import create_mqtt_message_event  # noqa: F401
 from upparat.cli import create_statemachine
+from upparat.config import settings
 from upparat.events import DOWNLOAD_COMPLETED
 from upparat.events import DOWNLOAD_INTERRUPTED
+from upparat.events import EXIT_SIGNAL_SENT
 from upparat.events import INSTALLATION_DONE
 from upparat.events import INSTALLATION_INTERRUPTED
+from upparat.events import JOB_EXECUTION_SUMMARIES
+from upparat.events import JOB_EXECUTION_SUMMARIES_PROGRESS
+from upparat.events import JOB_EXECUTION_SUMMARIES_QUEUED
 from upparat.events import JOB_INSTALLATION_COMPLETE
 from upparat.events import JOB_INSTALLATION_DONE
 from upparat.events import JOB_REVOKED
 from upparat.events import JOB_SELECTED
 from upparat.events import JOB_VERIFIED
 from upparat.events import JOBS_AVAILABLE
+from upparat.events import MQTT_CONNECTED
+from upparat.events import MQTT_DISCONNECTED
+from upparat.events import MQTT_EVENT_QOS
+from upparat.events import MQTT_EVENT_SESSION_PRESENT
+from upparat.events import MQTT_EVENT_TOPIC
+from upparat.events import MQTT_MESSAGE_RECEIVED
+from upparat.events import MQTT_SUBSCRIBE_TIMEOUT
 from upparat.events import NO_JOBS_PENDING
 from upparat.events import RESTART_INTERRUPTED
 from upparat.events import SELECT_JOB_INTERRUPTED
+from upparat.events import THING_NAME
+from upparat.inbox import PriorityInbox
+from upparat.jobs import Job
+from upparat.jobs import JobProgressStatus
+from upparat.jobs import JobStatus
+from upparat.jobs import JobSuccessStatus
+from upparat.jobs import JobTopic
+from upparat.journal import Journal
+from upparat.serialization import dumps
+from upparat.statemachine import UpparatStateMachine
 from upparat.statemachine.download import DownloadState
 from upparat.statemachine.fetch_jobs import FetchJobsState
 from upparat.statemachine.install import InstallState
@@ -30,14 +56,21 @@ from upparat.statemachine.verify_job import VerifyJobState
 
 @pytest.fixture
 def statemachine(mocker):
-    mocker.patch("upparat.statemachine.machine.FetchJobsState", autospec=True)
-    mocker.patch("upparat.statemachine.machine.MonitorState", autospec=True)
-    mocker.patch("upparat.statemachine.machine.SelectJobState", autospec=True)
-    mocker.patch("upparat.statemachine.machine.VerifyJobState", autospec=True)
-    mocker.patch("upparat.statemachine.machine.DownloadState", autospec=True)
-    mocker.patch("upparat.statemachine.machine.InstallState", autospec=True)
-    mocker.patch("upparat.statemachine.machine.RestartState", autospec=True)
-    mocker.patch("upparat.statemachine.machine.VerifyInstallationState", autospec=True)
+    for state in (
+        "FetchJobsState",
+        "MonitorState",
+        "SelectJobState",
+        "VerifyJobState",
+        "DownloadState",
+        "InstallState",
+        "RestartState",
+        "VerifyInstallationState",
+    ):
+        state_class = mocker.patch(
+            f"upparat.statemachine.machine.{state}", autospec=True
+        )
+        # Set in State.__init__, see UpparatStateMachine.compile
+        state_class.return_value.handlers = {}
 
     inbox = Queue()
     mqtt_client = mocker.Mock()
@@ -111,6 +144,20 @@ def test_statemachine_initial_state(statemachine):
     assert isinstance(statemachine.initial_state, FetchJobsState)
 
 
+def test_statemachine_persistent_subscriptions(mocker, statemachine):
+    thing_name = settings.broker.thing_name
+
+    # all in one SUBSCRIBE
+    statemachine.mqtt_client.subscribe.assert_called_once_with(
+        [
+            (f"$aws/things/{thing_name}/jobs/notify", 1),
+            (f"$aws/things/{thing_name}/jobs/get/+", 1),
+            (f"$aws/things/{thing_name}/jobs/+/get/+", 1),
+            (f"$aws/things/{thing_name}/jobs/+/update/+", 1),
+        ]
+    )
+
+
 def test_fetch_jobs_no_pending_jobs_found(fetch_jobs_state):
     statemachine, _ = fetch_jobs_state
     statemachine.dispatch(Event(NO_JOBS_PENDING))
@@ -125,6 +172,80 @@ def test_fetch_jobs_pending_jobs_found(fetch_jobs_state):
     return statemachine, statemachine.state
 
 
+def test_fetch_jobs_next_job_selected(fetch_jobs_state):
+    statemachine, _ = fetch_jobs_state
+    statemachine.dispatch(Event(JOB_SELECTED))
+    assert isinstance(statemachine.state, VerifyJobState)
+
+
+def test_monitor_next_job_selected(monitor_state):
+    statemachine, _ = monitor_state
+    statemachine.dispatch(Event(JOB_SELECTED))
+    assert isinstance(statemachine.state, VerifyJobState)
+
+
+def test_monitor_reconnected(monitor_state):
+    statemachine, _ = monitor_state
+    statemachine.dispatch(Event(MQTT_CONNECTED))
+    assert isinstance(statemachine.state, FetchJobsState)
+
+
+def test_monitor_session_resumed(monitor_state):
+    statemachine, _ = monitor_state
+    statemachine.dispatch(Event(MQTT_CONNECTED, **{MQTT_EVENT_SESSION_PRESENT: True}))
+    assert isinstance(statemachine.state, MonitorState)
+
+
+def test_subscribe_timeout_retry(mocker):
+    # not handled by the state → handled by the state machine
+    statemachine = UpparatStateMachine(Queue(), mocker.Mock())
+    statemachine.add_state(MonitorState(), initial=True)
+    statemachine.initialize()
+
+    statemachine.dispatch(
+        Event(MQTT_SUBSCRIBE_TIMEOUT, **{MQTT_EVENT_TOPIC: "topic", MQTT_EVENT_QOS: 1})
+    )
+
+    statemachine.mqtt_client.subscribe.assert_called_once_with("topic", qos=1)
+
+
+def test_routes(mocker):
+    mqtt_client = mocker.Mock()
+    statemachine = create_statemachine(Queue(), mqtt_client)
+
+    # routed before fetch_jobs published its request
+    assert mqtt_client.method_calls[0] == mocker.call.set_routes(
+        FetchJobsState.job_topics, settings.broker.thing_name
+    )
+
+    statemachine.dispatch(Event(NO_JOBS_PENDING))
+    mqtt_client.set_routes.assert_called_with(
+        frozenset({JobTopic.NOTIFY}), settings.broker.thing_name
+    )
+
+
+def test_job_active(mocker):
+    mqtt_client = mocker.Mock()
+    statemachine = create_statemachine(Queue(), mqtt_client)
+    mqtt_client.set_job_active.assert_called_with(settings.broker.thing_name, False)
+
+    # Job processing states keep the keepalive short
+    statemachine._route(DownloadState())
+    mqtt_client.set_job_active.assert_called_with(settings.broker.thing_name, True)
+
+
+def test_connection_state(monitor_state):
+    statemachine, _ = monitor_state
+    assert statemachine.online
+
+    statemachine.dispatch(Event(MQTT_DISCONNECTED))
+    assert not statemachine.online
+    assert isinstance(statemachine.state, MonitorState)
+
+    statemachine.dispatch(Event(MQTT_CONNECTED))
+    assert statemachine.online
+
+
 def test_select_found_job_to_processs(select_job_state):
     statemachine, _ = select_job_state
     statemachine.dispatch(Event(JOB_SELECTED))
@@ -200,3 +321,194 @@ def test_restarted_failure(restart_state):
     statemachine.dispatch(Event(RESTART_INTERRUPTED))
     assert isinstance(statemachine.state, FetchJobsState)
     return statemachine, statemachine.state
+
+
+def test_transition_added_after_compile(fetch_jobs_state):
+    statemachine, state = fetch_jobs_state
+    statemachine.dispatch(Event(NO_JOBS_PENDING))
+    monitor_state = statemachine.state
+
+    statemachine.add_transition(monitor_state, state, events=[EXIT_SIGNAL_SENT])
+    statemachine.dispatch(Event(EXIT_SIGNAL_SENT))
+    assert statemachine.state is state
+
+
+def test_dispatch_like_pysm(mocker):
+    on = mocker.spy(State, "_on")
+    handle = mocker.spy(UpparatStateMachine, "_handle")
+    subscribe_timeout = {MQTT_EVENT_TOPIC: "topic", MQTT_EVENT_QOS: 1}
+    events = [
+        (NO_JOBS_PENDING, {}),
+        (MQTT_SUBSCRIBE_TIMEOUT, subscribe_timeout),
+        (MQTT_DISCONNECTED, {}),
+        (MQTT_CONNECTED, {MQTT_EVENT_SESSION_PRESENT: True}),
+        (MQTT_CONNECTED, {MQTT_EVENT_SESSION_PRESENT: False}),
+        (NO_JOBS_PENDING, {}),
+        (NO_JOBS_PENDING, {}),
+    ]
+
+    def run(dispatch, received):
+        mqtt_client = mocker.Mock()
+        statemachine = create_statemachine(Queue(), mqtt_client)
+        steps = []
+        for name, cargo in events:
+            on.reset_mock()
+            handle.reset_mock()
+            mqtt_client.reset_mock()
+            dispatch(statemachine, Event(name, **cargo))
+
+            # enter / exit, handlers and what they did
+            state = statemachine.state.name
+            steps.append((state, received(statemachine), mqtt_client.mock_calls))
+        return steps
+
+    def received_by_state(statemachine):
+        # pysm propagates unhandled events to the machine
+        calls = [c[0] for c in on.call_args_list if c[0][0] is not statemachine]
+        return [(state.name, event.name) for state, event in calls]
+
+    def handled(statemachine):
+        return [(c[0][1].name, c[0][2].name) for c in handle.call_args_list]
+
+    compiled = run(UpparatStateMachine.dispatch, handled)
+    assert not on.called
+    assert compiled == run(StateMachine.dispatch, received_by_state)
+    assert ("fetch_jobs", "exit") in compiled[0][1]
+
+
+def test_job_processing_handlers_bound(mocker):
+    statemachine = create_statemachine(Queue(), mocker.Mock())
+    statemachine.compile()
+    state = next(s for s in statemachine.states if isinstance(s, InstallState))
+
+    # No per-event wrapper, the state's own handler is called on cancel checks
+    owner, handler = statemachine._handlers[(state, MQTT_MESSAGE_RECEIVED)]
+    assert owner is state
+    assert handler == state._handle_job_cancel
+    assert state._mqtt_message_handler == state.on_message
+
+
+def test_nested_statemachine_not_supported(statemachine):
+    statemachine.add_state(StateMachine("nested"))
+
+    with pytest.raises(StateMachineException):
+        statemachine.dispatch(Event(NO_JOBS_PENDING))
+
+
+def test_timers_cancelled_on_exit(mocker):
+    inbox = PriorityInbox()
+    statemachine = create_statemachine(inbox, mocker.Mock())
+    fetch_jobs_state = statemachine.state
+
+    timer = fetch_jobs_state.schedule(0, Event(NO_JOBS_PENDING))
+    event = inbox.get_nowait()
+    assert event.cargo[THING_NAME] == statemachine.thing_name
+
+    statemachine.dispatch(event)
+    assert isinstance(statemachine.state, MonitorState)
+    assert timer.done
+
+    # Only the timers of the state left are cancelled
+    monitor_timer = statemachine.state.schedule(60, Event(JOBS_AVAILABLE))
+    periodic = fetch_jobs_state.schedule(60, Event(JOBS_AVAILABLE), interval=60)
+    statemachine.dispatch(Event(MQTT_CONNECTED))
+
+    assert isinstance(statemachine.state, FetchJobsState)
+    assert monitor_timer.cancelled
+    assert periodic.active
+    # and the deadline of fetch_jobs
+    assert len(inbox.timers) == 2
+
+
+def test_resume_from_journal(mocker, tmpdir):
+    journal = Journal(tmpdir / "journal.json")
+    job = Job("upparat_1", "QUEUED", "http://foo.bar/baz.bin", "1.0.0", False, "", None)
+    journal.record(
+        settings.broker.thing_name, job, JobProgressStatus.REBOOT_START.value
+    )
+
+    # Restarted, the journaled job is verified right away
+    inbox = Queue()
+    mqtt_client = mocker.Mock()
+    statemachine = create_statemachine(inbox, mqtt_client, journal=journal)
+    assert isinstance(statemachine.state, VerifyJobState)
+    assert statemachine.state.job.id_ == job.id_
+
+    event = inbox.get_nowait()
+    assert event.name == JOB_INSTALLATION_DONE
+    statemachine.dispatch(event)
+    assert isinstance(statemachine.state, VerifyInstallationState)
+
+    # No version hook: done, nothing to resume anymore
+    assert inbox.get_nowait().name == JOB_INSTALLATION_COMPLETE
+    assert journal.job(settings.broker.thing_name) is None
+
+
+def test_supersede_after_resume(mocker, tmpdir, create_mqtt_message_event):
+    mocker.patch.object(settings.service, "supersede_jobs", True)
+    thing_name = settings.broker.thing_name
+
+    journal = Journal(tmpdir / "journal.json")
+    job = Job("upparat_3", "QUEUED", "http://foo.bar/baz.bin", "3.0.0", False, "", None)
+    journal.record(thing_name, job, JobProgressStatus.REBOOT_START.value)
+
+    # Restarted, nothing is known about the jobs it was selected among
+    inbox = Queue()
+    mqtt_client = mocker.Mock()
+    statemachine = create_statemachine(inbox, mqtt_client, journal=journal)
+    statemachine.dispatch(inbox.get_nowait())
+
+    event = inbox.get_nowait()
+    assert event.name == JOB_INSTALLATION_COMPLETE
+    statemachine.dispatch(event)
+    assert isinstance(statemachine.state, FetchJobsState)
+
+    statemachine.dispatch(
+        Event(
+            JOBS_AVAILABLE,
+            **{
+                JOB_EXECUTION_SUMMARIES: {
+                    JOB_EXECUTION_SUMMARIES_PROGRESS: [],
+                    JOB_EXECUTION_SUMMARIES_QUEUED: [
+                        {"jobId": "upparat_1", "queuedAt": 1},
+                        {"jobId": "upparat_2", "queuedAt": 2},
+                    ],
+                }
+            },
+        )
+    )
+    assert isinstance(statemachine.state, SelectJobState)
+
+    mqtt_client.publish.reset_mock()
+    for job_id, version in (("upparat_1", "1.0.0"), ("upparat_2", "3.0.0")):
+        statemachine.dispatch(
+            create_mqtt_message_event(
+                f"$aws/things/{thing_name}/jobs/{job_id}/get/accepted",
+                payload={
+                    "execution": {
+                        "jobId": job_id,
+                        "status": "QUEUED",
+                        "jobDocument": {"file": "http://foo.bar", "version": version},
+                    }
+                },
+            )
+        )
+
+    # Both would be a downgrade (or a reinstall)
+    message = "Superseded by upparat_3 (version 3.0.0)"
+    assert mqtt_client.publish.call_args_list == [
+        mocker.call(
+            f"$aws/things/{thing_name}/jobs/{job_id}/update",
+            dumps(
+                {
+                    "status": JobStatus.SUCCEEDED.value,
+                    "statusDetails": {
+                        "state": JobSuccessStatus.SUPERSEDED.value,
+                        "message": message,
+                    },
+                }
+            ),
+        )
+        for job_id in ("upparat_1", "upparat_2")
+    ]
+    assert inbox.get_nowait().name == SELECT_JOB_INTERRUPTED
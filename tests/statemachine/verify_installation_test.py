@@ -1,4 +1,3 @@
-import json
 from queue import Queue
 
 import pytest
@@ -15,6 +14,7 @@ from upparat.jobs import Job
 from upparat.jobs import JobFailedStatus
 from upparat.jobs import JobStatus
 from upparat.jobs import JobSuccessStatus
+from upparat.serialization import dumps
 from upparat.statemachine import UpparatStateMachine
 from upparat.statemachine.verify_installation import VerifyInstallationState
 
@@ -65,7 +65,7 @@ def test_on_enter_no_hook(verify_installation_state):
 
     mqtt_client.publish.assert_called_once_with(
         f"$aws/things/{settings.broker.thing_name}/jobs/{state.job.id_}/update",
-        json.dumps(
+        dumps(
             {
                 "status": JobStatus.SUCCEEDED.value,
                 "statusDetails": {
@@ -77,6 +77,19 @@ def test_on_enter_no_hook(verify_installation_state):
     )
 
 
+@pytest.mark.parametrize("supersede_jobs", [True, False])
+def test_succeeded_job_supersedes(mocker, verify_installation_state, supersede_jobs):
+    state, _, _, statemachine, _ = verify_installation_state
+    mocker.patch.object(settings.service, "supersede_jobs", supersede_jobs)
+
+    # not until the job succeeded
+    state.job_failed(JobFailedStatus.VERSION_MISMATCH.value)
+    assert statemachine.succeeded_job is None
+
+    state.on_enter(None, None)
+    assert statemachine.succeeded_job is (state.job if supersede_jobs else None)
+
+
 @pytest.mark.parametrize("force", [True, False])
 def test_on_enter_hook_executed(verify_installation_state, force):
     state, inbox, _, _, run_hook = verify_installation_state
@@ -88,7 +101,10 @@ def test_on_enter_hook_executed(verify_installation_state, force):
 
     assert inbox.empty()
     run_hook.assert_called_once_with(
-        settings.hooks.version, inbox, args=[state.job.meta]
+        settings.hooks.version,
+        inbox,
+        args=[state.job.meta],
+        thing_name=settings.broker.thing_name,
     )
 
 
@@ -144,7 +160,12 @@ def test_hook_version_ready_hook_version_match(
     assert inbox.empty()
     assert mqtt_client.publish.call_count == 0
 
-    run_hook.assert_called_once_with(settings.hooks.ready, inbox, args=[state.job.meta])
+    run_hook.assert_called_once_with(
+        settings.hooks.ready,
+        inbox,
+        args=[state.job.meta],
+        thing_name=settings.broker.thing_name,
+    )
 
 
 def test_hook_version_ready_hook_version_mismatch(
@@ -173,7 +194,7 @@ def test_hook_version_ready_hook_version_mismatch(
 
     mqtt_client.publish.assert_called_once_with(
         f"$aws/things/{settings.broker.thing_name}/jobs/{state.job.id_}/update",
-        json.dumps(
+        dumps(
             {
                 "status": JobStatus.FAILED.value,
                 "statusDetails": {
@@ -200,7 +221,7 @@ def test_hook_version_failed(verify_installation_state, create_hook_event):
 
     mqtt_client.publish.assert_called_once_with(
         f"$aws/things/{settings.broker.thing_name}/jobs/{state.job.id_}/update",
-        json.dumps(
+        dumps(
             {
                 "status": JobStatus.FAILED.value,
                 "statusDetails": {
@@ -227,7 +248,7 @@ def test_hook_version_timed_out(verify_installation_state, create_hook_event):
 
     mqtt_client.publish.assert_called_once_with(
         f"$aws/things/{settings.broker.thing_name}/jobs/{state.job.id_}/update",
-        json.dumps(
+        dumps(
             {
                 "status": JobStatus.FAILED.value,
                 "statusDetails": {
@@ -259,7 +280,7 @@ def test_hook_ready_conpleted(verify_installation_state, create_hook_event):
 
     mqtt_client.publish.assert_called_once_with(
         f"$aws/things/{settings.broker.thing_name}/jobs/{state.job.id_}/update",
-        json.dumps(
+        dumps(
             {
                 "status": JobStatus.SUCCEEDED.value,
                 "statusDetails": {
@@ -286,7 +307,7 @@ def test_hook_ready_failed(verify_installation_state, create_hook_event):
 
     mqtt_client.publish.assert_called_once_with(
         f"$aws/things/{settings.broker.thing_name}/jobs/{state.job.id_}/update",
-        json.dumps(
+        dumps(
             {
                 "status": JobStatus.FAILED.value,
                 "statusDetails": {
@@ -313,7 +334,7 @@ def test_hook_version_timed_out(verify_installation_state, create_hook_event):
 
     mqtt_client.publish.assert_called_once_with(
         f"$aws/things/{settings.broker.thing_name}/jobs/{state.job.id_}/update",
-        json.dumps(
+        dumps(
             {
                 "status": JobStatus.FAILED.value,
                 "statusDetails": {
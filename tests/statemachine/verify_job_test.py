@@ -1,9 +1,9 @@
-import json
 from queue import Queue
 
 import pytest
 
 from ..utils import create_hook_event  # noqa: F401
+from ..utils import create_mqtt_message_event  # noqa: F401
 from ..utils import generate_random_job_id
 from upparat.config import settings
 from upparat.events import HOOK
@@ -17,6 +17,7 @@ from upparat.jobs import Job
 from upparat.jobs import JobFailedStatus
 from upparat.jobs import JobProgressStatus
 from upparat.jobs import JobStatus
+from upparat.serialization import dumps
 from upparat.statemachine import UpparatStateMachine
 from upparat.statemachine.verify_job import VerifyJobState
 
@@ -98,7 +99,10 @@ def test_on_enter_queued_hook_executed(verify_job_state):
 
     assert inbox.empty()
     run_hook.assert_called_once_with(
-        settings.hooks.version, inbox, args=[state.job.meta]
+        settings.hooks.version,
+        inbox,
+        args=[state.job.meta],
+        thing_name=settings.broker.thing_name,
     )
 
 
@@ -162,6 +166,37 @@ def test_on_job_cancelled(verify_job_state):
     assert state.stop_version_hook.is_set()
 
 
+def test_notify_job_queued_not_cancelled(verify_job_state, create_mqtt_message_event):
+    state, inbox, _, _, _ = verify_job_state
+    state.job = create_job_with(status=JobStatus.QUEUED)
+
+    # e.g. selected from notify-next before the notify arrived
+    state._handle_job_cancel(
+        None,
+        create_mqtt_message_event(
+            f"$aws/things/{settings.broker.thing_name}/jobs/notify",
+            {"jobs": {"QUEUED": [{"jobId": state.job.id_}]}},
+        ),
+    )
+
+    assert inbox.empty()
+
+
+def test_notify_job_gone_cancelled(verify_job_state, create_mqtt_message_event):
+    state, inbox, _, _, _ = verify_job_state
+    state.job = create_job_with(status=JobStatus.QUEUED)
+
+    state._handle_job_cancel(
+        None,
+        create_mqtt_message_event(
+            f"$aws/things/{settings.broker.thing_name}/jobs/notify", {"jobs": {}}
+        ),
+    )
+
+    published_event = inbox.get_nowait()
+    assert published_event.name == JOB_REVOKED
+
+
 def test_event_handlers_handle_hook(verify_job_state):
     state, _, _, _, _ = verify_job_state
     event_handlers = state.event_handlers()
@@ -184,7 +219,15 @@ def test_hook_completed_version_match(verify_job_state, create_hook_event):
 
     mqtt_client.publish.assert_called_once_with(
         f"$aws/things/{settings.broker.thing_name}/jobs/{state.job.id_}/update",
-        '{"status": "SUCCEEDED", "statusDetails": {"state": "version_already_installed", "message": "none"}}',  # noqa
+        dumps(
+            {
+                "status": "SUCCEEDED",
+                "statusDetails": {
+                    "state": "version_already_installed",
+                    "message": "none",
+                },
+            }
+        ),
     )
 
 
@@ -234,7 +277,7 @@ def test_hook_failed(verify_job_state, create_hook_event):
 
     mqtt_client.publish.assert_called_once_with(
         f"$aws/things/{settings.broker.thing_name}/jobs/{state.job.id_}/update",
-        json.dumps(
+        dumps(
             {
                 "status": JobStatus.FAILED.value,
                 "statusDetails": {
@@ -261,7 +304,7 @@ def test_hook_timedout(verify_job_state, create_hook_event):
 
     mqtt_client.publish.assert_called_once_with(
         f"$aws/things/{settings.broker.thing_name}/jobs/{state.job.id_}/update",
-        json.dumps(
+        dumps(
             {
                 "status": JobStatus.FAILED.value,
                 "statusDetails": {
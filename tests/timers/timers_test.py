@@ -0,0 +1,64 @@
+import pytest
+from pysm import Event
+
+from upparat.timers import Timers
+
+
+@pytest.fixture
+def clock():
+    now = [100.0]
+
+    def _clock():
+        return now[0]
+
+    _clock.now = now
+    return _clock
+
+
+def test_due_in_order(clock):
+    timers = Timers(clock)
+    assert timers.timeout() is None
+
+    later = timers.schedule(5, Event("later"))
+    first = timers.schedule(1, Event("first"))
+    timers.schedule(1, Event("second"))
+    assert timers.timeout() == 1
+    assert timers.due() == []
+
+    clock.now[0] += 1
+    due = timers.due()
+    assert [timer.fire().name for timer in due] == ["first", "second"]
+    assert due[0] is first and not first.active
+    assert timers.timeout() == 4
+
+    later.cancel()
+    assert timers.timeout() is None
+    assert len(timers) == 0
+
+
+def test_periodic(clock):
+    timers = Timers(clock)
+    timer = timers.schedule(1, Event("tick"), interval=2)
+
+    clock.now[0] += 1
+    assert timers.due() == [timer]
+    first = timer.fire()
+
+    clock.now[0] += 2
+    assert timers.due() == [timer]
+    assert timer.fire() is not first
+    assert timer.active
+
+    # Missed ticks are skipped
+    clock.now[0] += 7
+    assert timers.due() == [timer]
+    assert timers.timeout() == 2
+
+    timer.cancel()
+    clock.now[0] += 2
+    assert timers.due() == []
+
+
+def test_interval_positive(clock):
+    with pytest.raises(ValueError):
+        Timers(clock).schedule(1, Event("tick"), interval=0)
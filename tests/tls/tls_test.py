@@ -0,0 +1,99 @@
+import socket
+import ssl
+import threading
+from pathlib import Path
+
+import pytest
+
+from upparat.metrics import metrics
+from upparat.metrics import MQTT_TLS_HANDSHAKE
+from upparat.metrics import MQTT_TLS_SESSIONS_RESUMED
+from upparat.tls import create_context
+from upparat.tls import ResumingContext
+
+# Self-signed for localhost
+CERTFILE = (Path(__file__).parent / "cert.pem").as_posix()
+KEYFILE = (Path(__file__).parent / "key.pem").as_posix()
+
+
+@pytest.fixture
+def server():
+    """ Accepts TLS connections, sends a byte and waits for the close. """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(CERTFILE, KEYFILE)
+
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen()
+
+    def _serve():
+        while True:
+            try:
+                connection, _ = listener.accept()
+            except OSError:
+                return
+
+            try:
+                with context.wrap_socket(connection, server_side=True) as sock:
+                    sock.sendall(b"x")
+                    sock.recv(1)
+            except OSError:
+                connection.close()
+
+    threading.Thread(target=_serve, daemon=True).start()
+    yield listener.getsockname()[1]
+    listener.close()
+
+
+def connect(context, port):
+    # Like Paho's reconnect()
+    sock = context.wrap_socket(
+        socket.create_connection(("127.0.0.1", port)),
+        server_hostname="localhost",
+        do_handshake_on_connect=False,
+    )
+    sock.do_handshake()
+    sock.recv(1)
+    return sock
+
+
+def test_session_resumed_on_reconnect(server):
+    metrics.reset()
+    context = ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.load_verify_locations(cafile=CERTFILE)
+
+    sock = connect(context, server)
+    assert not sock.session_reused
+    sock.close()
+
+    sock = connect(context, server)
+    assert sock.session_reused
+    sock.close()
+
+    snapshot = metrics.snapshot()
+    assert snapshot[MQTT_TLS_HANDSHAKE]["count"] == 2
+    assert snapshot[MQTT_TLS_SESSIONS_RESUMED] == 1
+
+
+def test_session_forgotten_on_failed_handshake(mocker, server):
+    context = ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.load_verify_locations(cafile=CERTFILE)
+    connect(context, server).close()
+    assert "localhost" in context._sessions
+
+    mocker.patch("ssl.SSLSocket.do_handshake", side_effect=ssl.SSLError)
+
+    with pytest.raises(ssl.SSLError):
+        connect(context, server)
+
+    # The next attempt does a full handshake
+    assert "localhost" not in context._sessions
+
+
+def test_create_context():
+    context = create_context(CERTFILE, CERTFILE, KEYFILE)
+
+    assert isinstance(context, ResumingContext)
+    assert context.verify_mode == ssl.CERT_REQUIRED
+    assert context.check_hostname
+    assert context.get_ca_certs()
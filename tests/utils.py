@@ -1,17 +1,20 @@
-import json
 import uuid
 
 import pytest
 from pysm import Event
 
+from upparat.config import settings
 from upparat.events import HOOK_COMMAND
 from upparat.events import HOOK_MESSAGE
 from upparat.events import HOOK_STATUS
+from upparat.events import MQTT_EVENT_JOB_ID
+from upparat.events import MQTT_EVENT_JOB_TOPIC
 from upparat.events import MQTT_EVENT_PAYLOAD
 from upparat.events import MQTT_EVENT_TOPIC
 from upparat.events import MQTT_MESSAGE_RECEIVED
 from upparat.events import MQTT_SUBSCRIBED
 from upparat.jobs import is_upparat_job_id
+from upparat.jobs import JobTopicIndex
 from upparat.jobs import UPPARAT_JOB_PREFIX
 
 
@@ -22,9 +25,16 @@ def create_mqtt_message_event(mocker):
         if not payload:
             payload = {}
 
+        job_topic, job_id = JobTopicIndex(settings.broker.thing_name).classify(topic)
+
         return Event(
             MQTT_MESSAGE_RECEIVED,
-            **{MQTT_EVENT_TOPIC: topic, MQTT_EVENT_PAYLOAD: json.dumps(payload)},
+            **{
+                MQTT_EVENT_TOPIC: topic,
+                MQTT_EVENT_PAYLOAD: payload,
+                MQTT_EVENT_JOB_TOPIC: job_topic,
+                MQTT_EVENT_JOB_ID: job_id,
+            },
         )
 
     return _create_mqtt_message_event